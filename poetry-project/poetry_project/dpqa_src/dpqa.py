@@ -1,11 +1,18 @@
-import cirq
+import copy
 import math
+import time
+import numpy as np
 
-from dpqa_src.dpqa_traps import SLMTrap, AODTrap
-from dpqa_src.dpqa_plotter import show_current_state
-from dpqa_src.dpqa_instructions import Instruction, ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, Initialize, MoveAODCol, MoveAODRow, RydbergLaser
+from dpqa_src.dpqa_traps import SLMTrapView, AODTrapView
+from dpqa_src.dpqa_state import DPQAState, EMPTY
+from dpqa_src.dpqa_spatial import UniformGridIndex
+from dpqa_src.dpqa_instructions import Instruction, ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, Initialize, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_program import Program, OP_ACTIVATE_AOD_COL, OP_ACTIVATE_AOD_ROW, OP_DEACTIVATE_AOD_COL, OP_DEACTIVATE_AOD_ROW, OP_DRAW_STATE, OP_MOVE_AOD_COL, OP_MOVE_AOD_ROW, OP_RYDBERG_LASER, OP_RYDBERG_PULSE, OP_RYDBERG_PULSE_SITES, OP_MOVE_AOD_ROWS, OP_MOVE_AOD_COLS
 
-class DPQA(cirq.Device):
+# the device is a plain class so that it imports without cirq. cirq is only
+# needed where circuits come in (the compilers) and qubits are made, and
+# matplotlib only once a state is drawn.
+class DPQA:
 
     def __init__(
         self,
@@ -26,136 +33,204 @@ class DPQA(cirq.Device):
         
         self.previous_rydberg_laser_pos = (-1, -1)
         self.previous_rydberg_laser_op = "none"
-
-        self.aod_traps = []  # qubit on row i, col j is aod_qubits[i][j]
-        self.slm_traps = [] 
-        self.flat_aod_traps = []
+        self.previous_rydberg_pulse_positions = []
 
         self.aod_rows = aod_rows
         self.aod_cols = aod_cols
 
-        for i in range(aod_rows):
-            aod_row = []
-            for j in range(aod_cols):
-                aod_trap = AODTrap(i, j)
-                aod_row.append(aod_trap)
-                self.flat_aod_traps.append(aod_trap)
-            self.aod_traps.append(aod_row)
-
-        for pos in slm_positions_xy:
-            assert(pos[0] >= 0 and pos[0] <= max_dim_x)
-            assert(pos[1] >= 0 and pos[1] <= max_dim_y)
-            slm_trap = SLMTrap(pos[0], pos[1])
-            self.slm_traps.append(slm_trap)
+        # positions and occupancy of every trap live in numpy arrays, the trap
+        # objects in aod_traps/flat_aod_traps/slm_traps are views into them
+        self.state = DPQAState(aod_rows, aod_cols, slm_positions_xy)
+        self._aod_traps = None
+        self._flat_aod_traps = None
+        self._slm_traps = None
+
+        assert(np.all((self.state.slm_x >= 0) & (self.state.slm_x <= max_dim_x)))
+        assert(np.all((self.state.slm_y >= 0) & (self.state.slm_y <= max_dim_y)))
+
+        self.slm_positions_xy = list(zip(self.state.slm_x.tolist(), self.state.slm_y.tolist()))
+
+        # slm traps never move, so the lookup grids for trap transfers and
+        # rydberg pulses are built once. cells twice the query radius wide keep
+        # a query down to at most 2x2 cells.
+        self.slm_trap_index = UniformGridIndex(
+            self.slm_positions_xy,
+            cell_size=2 * trap_transfer_radius)
+        self.slm_rydberg_index = UniformGridIndex(
+            self.slm_positions_xy,
+            cell_size=2 * rydberg_radius)
+
+    @property
+    def aod_traps(self):
+        # qubit on row i, col j is aod_traps[i][j]
+        if self._aod_traps is None:
+            self._aod_traps = [[AODTrapView(self.state, i, j) for j in range(self.aod_cols)]
+                               for i in range(self.aod_rows)]
+        return self._aod_traps
+
+    @property
+    def flat_aod_traps(self):
+        if self._flat_aod_traps is None:
+            self._flat_aod_traps = [aod_trap for aod_row in self.aod_traps for aod_trap in aod_row]
+        return self._flat_aod_traps
+
+    @property
+    def slm_traps(self):
+        if self._slm_traps is None:
+            self._slm_traps = [SLMTrapView(self.state, i) for i in range(self.state.nof_slm_traps)]
+        return self._slm_traps
+    
+    def copy(self):
+        # same traps, independent copy of the state. the slm lookup grids never
+        # change and are shared between the copies.
+        device = copy.copy(self)
+        device.state = self.state.copy()
+        device._aod_traps = None
+        device._flat_aod_traps = None
+        device._slm_traps = None
+        return device
     
+    def checkpoint(self):
+        # cheap branch point for trying instructions on this device: the state
+        # keeps an undo log from here on, so a rollback costs as much as the
+        # changes made since, not as a copy of the arrays
+        return (self.state.checkpoint(), self.nof_qubits, self.previous_rydberg_laser_pos,
+                self.previous_rydberg_laser_op, self.previous_rydberg_pulse_positions)
+
+    def rollback(self, checkpoint):
+        # back to the checkpoint, which stays open
+        (marker, self.nof_qubits, self.previous_rydberg_laser_pos,
+         self.previous_rydberg_laser_op, self.previous_rydberg_pulse_positions) = checkpoint
+        self.state.rollback(marker)
+
+    def commit(self, checkpoint):
+        # keep everything done since the checkpoint and close it
+        self.state.commit(checkpoint[0])
+
     def add_qubits_to_aod_traps(self, qubits, aod_trap_positions_rowcol):
         assert(len(qubits) == len(aod_trap_positions_rowcol))
         for i in range(len(qubits)):
             q = qubits[i]
             aod_trap_pos = aod_trap_positions_rowcol[i]
-            aod_trap = self.aod_traps[aod_trap_pos[0]][aod_trap_pos[1]]
-            aod_trap.add_qubits(q)
+            self.state.place_on_aod(aod_trap_pos[0], aod_trap_pos[1], self.state.register_qubit(q))
             self.nof_qubits += 1
     
     def add_qubits_to_slm_traps(self, qubits, slm_trap_indices):
         assert(len(qubits) == len(slm_trap_indices))
         for i in range(len(qubits)):
             q = qubits[i]
-            slm_trap = self.slm_traps[slm_trap_indices[i]]
-            slm_trap.add_qubits(q)
+            self.state.place_on_slm(slm_trap_indices[i], self.state.register_qubit(q))
             self.nof_qubits += 1
 
     def move_aod_row_by(self, aod_row_index, offset):
-        aod_row = self.aod_traps[aod_row_index]
-        current_y = aod_row[0].get_position_xy()[1]
+        aod_row_y = self.state.aod_row_y
+        current_y = aod_row_y[aod_row_index]
         new_y = current_y + offset
 
         assert new_y <= self.max_dim_y and new_y >= -self.max_dim_y
 
         if offset < 0 and aod_row_index != 0:
-            aod_y_below_this = self.aod_traps[aod_row_index - 1][0].get_position_xy()[
-                1
-            ]
+            aod_y_below_this = aod_row_y[aod_row_index - 1]
             assert new_y > aod_y_below_this
         if offset > 0 and aod_row_index != self.aod_rows - 1:
-            aod_y_below_this = self.aod_traps[aod_row_index + 1][0].get_position_xy()[
-                1
-            ]
+            aod_y_below_this = aod_row_y[aod_row_index + 1]
             assert new_y < aod_y_below_this
 
-        for aod_qubit in aod_row:
-            aod_qubit.move_trap_by(0, offset)
+        self.state.move_row(aod_row_index, offset)
 
     def move_aod_col_by(self, aod_col_index, offset):
-        aod_col = [aod_row[aod_col_index] for aod_row in self.aod_traps]
-        current_x = aod_col[0].get_position_xy()[0]
+        aod_col_x = self.state.aod_col_x
+        current_x = aod_col_x[aod_col_index]
         new_x = current_x + offset
 
         assert new_x <= self.max_dim_x and new_x >= -self.max_dim_x
 
         if offset < 0 and aod_col_index != 0:
-            aod_x_left_of_this = self.aod_traps[0][
-                aod_col_index - 1
-            ].get_position_xy()[0]
+            aod_x_left_of_this = aod_col_x[aod_col_index - 1]
             assert new_x > aod_x_left_of_this
         if offset > 0 and aod_col_index != self.aod_cols - 1:
-            aod_x_right_of_this = self.aod_traps[0][
-                aod_col_index + 1
-            ].get_position_xy()[0]
+            aod_x_right_of_this = aod_col_x[aod_col_index + 1]
             assert new_x < aod_x_right_of_this
 
-        for aod_qubit in aod_col:
-            aod_qubit.move_trap_by(offset, 0)
+        self.state.move_col(aod_col_index, offset)
     
 
+    def move_aod_rows_by(self, aod_row_indices, offsets):
+        # the rows move simultaneously, so the ordering is checked once on the
+        # final positions: if the lines are strictly ordered before and after,
+        # they stay ordered during the whole motion
+        rows = np.asarray(aod_row_indices, dtype=np.int64)
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=np.float64), rows.shape)
+        assert len(np.unique(rows)) == len(rows)
+        new_y = self.state.aod_row_y.copy()
+        new_y[rows] += offsets
+        assert np.all(new_y[rows] <= self.max_dim_y) and np.all(new_y[rows] >= -self.max_dim_y)
+        assert np.all(np.diff(new_y) > 0)
+        self.state.move_rows(rows, offsets)
+
+    def move_aod_cols_by(self, aod_col_indices, offsets):
+        cols = np.asarray(aod_col_indices, dtype=np.int64)
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=np.float64), cols.shape)
+        assert len(np.unique(cols)) == len(cols)
+        new_x = self.state.aod_col_x.copy()
+        new_x[cols] += offsets
+        assert np.all(new_x[cols] <= self.max_dim_x) and np.all(new_x[cols] >= -self.max_dim_x)
+        assert np.all(np.diff(new_x) > 0)
+        self.state.move_cols(cols, offsets)
+
     def activate_aod_row(self, aod_row_index):
-        aod_row = self.aod_traps[aod_row_index]
-        for aod_trap in aod_row:
-            if len(aod_trap.qubits) == 0:
-                for slm_trap in self.slm_traps:
-                    p1 = aod_trap.get_position_xy()
-                    p2 = slm_trap.get_position_xy()
-                    if self.distance_between_points(p1, p2) <= self.trap_transfer_radius and len(slm_trap.qubits) > 0:
-                        q = slm_trap.remove_qubits()
-                        aod_trap.add_qubits(q)
-                        break
+        y = self.state.aod_row_y[aod_row_index].item()
+        aod_col_x = self.state.aod_col_x
+        aod_row_qubit_ids = self.state.aod_qubit_ids[aod_row_index]
+        for col in np.flatnonzero(aod_row_qubit_ids == EMPTY).tolist():
+            self.pick_up_qubit_from_slm(aod_row_index, col, (aod_col_x[col].item(), y))
 
     
     def activate_aod_col(self, aod_col_index):
-        aod_col = [aod_row[aod_col_index] for aod_row in self.aod_traps]
-        for aod_trap in aod_col:
-            if len(aod_trap.qubits) == 0:
-                for slm_trap in self.slm_traps:
-                    p1 = aod_trap.get_position_xy()
-                    p2 = slm_trap.get_position_xy()
-                    if self.distance_between_points(p1, p2) <= self.trap_transfer_radius and len(slm_trap.qubits) > 0:
-                        q = slm_trap.remove_qubits()
-                        aod_trap.add_qubits(q)
-                        break
+        x = self.state.aod_col_x[aod_col_index].item()
+        aod_row_y = self.state.aod_row_y
+        aod_col_qubit_ids = self.state.aod_qubit_ids[:, aod_col_index]
+        for row in np.flatnonzero(aod_col_qubit_ids == EMPTY).tolist():
+            self.pick_up_qubit_from_slm(row, aod_col_index, (x, aod_row_y[row].item()))
 
     def deactivate_aod_row(self, aod_row_index):
-        aod_row = self.aod_traps[aod_row_index]
-        for aod_trap in aod_row:
-            if len(aod_trap.qubits) > 0:
-                q = aod_trap.remove_qubits()
-                for slm_trap in self.slm_traps:
-                    p1 = aod_trap.get_position_xy()
-                    p2 = slm_trap.get_position_xy()
-                    if self.distance_between_points(p1, p2) < self.trap_transfer_radius and len(slm_trap.qubits) == 0:
-                        slm_trap.add_qubits(q)
-                        break
+        y = self.state.aod_row_y[aod_row_index].item()
+        aod_col_x = self.state.aod_col_x
+        aod_row_qubit_ids = self.state.aod_qubit_ids[aod_row_index]
+        for col in np.flatnonzero(aod_row_qubit_ids != EMPTY).tolist():
+            self.drop_qubit_to_slm(aod_row_index, col, (aod_col_x[col].item(), y))
 
     def deactivate_aod_col(self, aod_col_index):
-        aod_col = [aod_row[aod_col_index] for aod_row in self.aod_traps]
-        for aod_trap in aod_col:
-            if len(aod_trap.qubits) > 0:
-                q = aod_trap.remove_qubits()
-                for slm_trap in self.slm_traps:
-                    p1 = aod_trap.get_position_xy()
-                    p2 = slm_trap.get_position_xy()
-                    if self.distance_between_points(p1, p2) < self.trap_transfer_radius and len(slm_trap.qubits) == 0:
-                        slm_trap.add_qubits(q)
-                        break
+        x = self.state.aod_col_x[aod_col_index].item()
+        aod_row_y = self.state.aod_row_y
+        aod_col_qubit_ids = self.state.aod_qubit_ids[:, aod_col_index]
+        for row in np.flatnonzero(aod_col_qubit_ids != EMPTY).tolist():
+            self.drop_qubit_to_slm(row, aod_col_index, (x, aod_row_y[row].item()))
+
+    def pick_up_qubit_from_slm(self, aod_row_index, aod_col_index, p1):
+        # the first occupied slm trap (in slm_traps order) within the transfer radius
+        slm_positions = self.slm_positions_xy
+        slm_qubit_ids = self.state.slm_qubit_ids
+        for slm_index in self.slm_trap_index.candidates(p1, self.trap_transfer_radius):
+            p2 = slm_positions[slm_index]
+            if self.distance_between_points(p1, p2) <= self.trap_transfer_radius and slm_qubit_ids[slm_index] != EMPTY:
+                q = self.state.take_from_slm(slm_index)
+                self.state.place_on_aod(aod_row_index, aod_col_index, q)
+                break
+
+    def drop_qubit_to_slm(self, aod_row_index, aod_col_index, p1):
+        # the first empty slm trap (in slm_traps order) strictly within the transfer radius
+        q = self.state.take_from_aod(aod_row_index, aod_col_index)
+        slm_positions = self.slm_positions_xy
+        slm_qubit_ids = self.state.slm_qubit_ids
+        for slm_index in self.slm_trap_index.candidates(p1, self.trap_transfer_radius):
+            p2 = slm_positions[slm_index]
+            if self.distance_between_points(p1, p2) < self.trap_transfer_radius and slm_qubit_ids[slm_index] == EMPTY:
+                self.state.place_on_slm(slm_index, q)
+                break
+        else:
+            if self.state.trace is not None:
+                self.state.trace.lost(q)
 
     def distance_between_points(self, p1, p2):
         distance_vector = [p1[0] - p2[0], p1[1] - p2[1]]
@@ -165,62 +240,302 @@ class DPQA(cirq.Device):
         )
         return distance
     
+    def traps_in_rydberg_range(self, laser_pos_xy):
+        # all traps strictly within rydberg_radius of laser_pos_xy, as
+        # (aod row indices, aod col indices, slm indices). aod traps come in
+        # row-major order and slm traps in slm_traps order.
+        lx, ly = laser_pos_xy
+        reach = self.rydberg_radius * (1 + 1e-9) + 1e-12
+
+        # aod rows and cols are kept strictly ordered by move_aod_row_by and
+        # move_aod_col_by, so the lines near the laser are a contiguous slice
+        aod_row_y = self.state.aod_row_y
+        aod_col_x = self.state.aod_col_x
+        row_start = np.searchsorted(aod_row_y, ly - reach, side='left')
+        row_stop = np.searchsorted(aod_row_y, ly + reach, side='right')
+        col_start = np.searchsorted(aod_col_x, lx - reach, side='left')
+        col_stop = np.searchsorted(aod_col_x, lx + reach, side='right')
+        dy = aod_row_y[row_start:row_stop] - ly
+        dx = aod_col_x[col_start:col_stop] - lx
+        aod_distances = np.sqrt((dx * dx)[None, :] + (dy * dy)[:, None])
+        aod_rows_hit, aod_cols_hit = np.nonzero(aod_distances < self.rydberg_radius)
+        aod_rows_hit += row_start
+        aod_cols_hit += col_start
+
+        slm_candidates = np.asarray(self.slm_rydberg_index.candidates(laser_pos_xy, self.rydberg_radius),
+                                    dtype=np.int64)
+        dx = self.state.slm_x[slm_candidates] - lx
+        dy = self.state.slm_y[slm_candidates] - ly
+        slm_hit = slm_candidates[np.sqrt(dx * dx + dy * dy) < self.rydberg_radius]
+
+        return (aod_rows_hit, aod_cols_hit, slm_hit)
+
+    def qubit_ids_in_rydberg_range(self, laser_pos_xy):
+        # ids of the qubits a pulse at laser_pos_xy would act on, sorted
+        aod_rows_hit, aod_cols_hit, slm_hit = self.traps_in_rydberg_range(laser_pos_xy)
+        ids = (self.state.aod_qubit_ids[aod_rows_hit, aod_cols_hit].tolist()
+               + self.state.slm_qubit_ids[slm_hit].tolist())
+        return sorted(i for i in ids if i != EMPTY)
+
     def rydberg_interaction_on_position(self, laser_pos_xy, operation):
-        affected_qubits = []
-        affected_traps = []
-        for trap in (self.flat_aod_traps + self.slm_traps):
-            trap_pos = trap.get_position_xy()
-            if self.distance_between_points(trap_pos, laser_pos_xy) < self.rydberg_radius:
-                for q in trap.qubits:
-                    affected_qubits.append(q)
-                affected_traps.append(trap)
+        aod_rows_hit, aod_cols_hit, slm_hit = self.traps_in_rydberg_range(laser_pos_xy)
+        nof_affected_qubits = (np.count_nonzero(self.state.aod_qubit_ids[aod_rows_hit, aod_cols_hit] != EMPTY)
+                               + np.count_nonzero(self.state.slm_qubit_ids[slm_hit] != EMPTY))
+        if self.state.trace is not None:
+            ids = (self.state.aod_qubit_ids[aod_rows_hit, aod_cols_hit].tolist()
+                   + self.state.slm_qubit_ids[slm_hit].tolist())
+            self.state.trace.pulsed(laser_pos_xy, [i for i in ids if i != EMPTY])
         
         # do the operation on affected qubits
         self.previous_rydberg_laser_pos = laser_pos_xy
         self.previous_rydberg_laser_op = operation
         if operation == 'SWAP':
-            assert(len(affected_qubits) <= 2)
-            if len(affected_qubits) == 2:
-                q1 = affected_traps[0].remove_qubits()
-                q2 = affected_traps[1].remove_qubits()
-                affected_traps[0].add_qubits(q2)
-                affected_traps[1].add_qubits(q1)
+            assert(nof_affected_qubits <= 2)
+            if nof_affected_qubits == 2:
+                # the first two affected traps, aod traps before slm traps
+                affected_traps = ([('aod', r, c) for r, c in zip(aod_rows_hit[:2].tolist(), aod_cols_hit[:2].tolist())]
+                                  + [('slm', i, None) for i in slm_hit[:2].tolist()])[:2]
+                q1 = self._take_from_trap(affected_traps[0])
+                q2 = self._take_from_trap(affected_traps[1])
+                self._place_on_trap(affected_traps[0], q2)
+                self._place_on_trap(affected_traps[1], q1)
+
+    def rydberg_pulse_on_positions(self, laser_positions_xy, operations):
+        # the sites of one pulse never share a trap, so they are applied one by one
+        for laser_pos_xy, operation in zip(laser_positions_xy, operations):
+            self.rydberg_interaction_on_position(laser_pos_xy, operation)
+        self.previous_rydberg_laser_pos = (-1, -1)
+        self.previous_rydberg_pulse_positions = list(laser_positions_xy)
+
+    def _take_from_trap(self, trap):
+        kind, i, j = trap
+        if kind == 'aod':
+            return self.state.take_from_aod(i, j)
+        return self.state.take_from_slm(i)
+
+    def _place_on_trap(self, trap, qubit_id):
+        kind, i, j = trap
+        if kind == 'aod':
+            self.state.place_on_aod(i, j, qubit_id)
+        else:
+            self.state.place_on_slm(i, qubit_id)
 
     def clear_movement_vectors(self):
-        for aod_trap in self.flat_aod_traps:
-            aod_trap.movement_vector = (0,0)
+        self.state.clear_movement_vectors()
+
+    @classmethod
+    def register_instruction(cls, instruction_type, handler, draws_state=False):
+        # handler is called as handler(device, instruction). instructions that
+        # only draw (draws_state=True) are skipped by headless execution.
+        # a subclass of DPQA gets its own copies of the registry on its first
+        # registration, so it never changes the handlers of DPQA or of its
+        # siblings. until then it shares the registry of its base class.
+        assert(issubclass(instruction_type, Instruction))
+        if 'instruction_handlers' not in cls.__dict__:
+            cls.instruction_handlers = dict(cls.instruction_handlers)
+            cls.drawing_instruction_types = set(cls.drawing_instruction_types)
+            cls._resolved_handlers = {}
+            cls._resolved_headless_handlers = {}
+        cls.instruction_handlers[instruction_type] = handler
+        if draws_state:
+            cls.drawing_instruction_types.add(instruction_type)
+        else:
+            cls.drawing_instruction_types.discard(instruction_type)
+        cls._resolved_handlers.clear()
+        cls._resolved_headless_handlers.clear()
+
+    @classmethod
+    def handler_for(cls, instruction_type, headless=False):
+        resolved = cls._resolved_headless_handlers if headless else cls._resolved_handlers
+        if instruction_type in resolved:
+            return resolved[instruction_type]
+        assert(issubclass(instruction_type, Instruction))
+        # subclasses of a registered instruction use the closest registered handler
+        handler = None
+        for base in instruction_type.__mro__:
+            if base in cls.instruction_handlers:
+                if not (headless and base in cls.drawing_instruction_types):
+                    handler = cls.instruction_handlers[base]
+                break
+        resolved[instruction_type] = handler
+        return handler
 
     def execute_instructions(self,
                              instructions,
                              draw_states_between_instructions=True,
-                             print_instructions=True):
+                             print_instructions=True,
+                             headless=False,
+                             trace=None,
+                             listener=None):
+        # trace: a TraceRecorder that records the run. listener: a
+        # dpqa_profiler.Listener told about every instruction, headless only
+        if headless:
+            return self.execute_instructions_headless(instructions, trace, listener)
+        assert(listener is None), "listeners are for headless runs"
+        if isinstance(instructions, Program):
+            instructions = iter(instructions)
+        if trace is not None:
+            instructions = trace.steps(self, instructions)
         indx = 0
         for inst in instructions:
             assert(isinstance(inst, Instruction))
-            if isinstance(inst, ActivateAODRow):
-                self.activate_aod_row(inst.row_index)
-            elif isinstance(inst, ActivateAODCol):
-                self.activate_aod_col(inst.col_index)
-            elif isinstance(inst, DeactivateAODRow):
-                self.deactivate_aod_row(inst.row_index)
-            elif isinstance(inst, DeactivateAODCol):
-                self.deactivate_aod_col(inst.col_index)
-            elif isinstance(inst, RydbergLaser):
-                self.rydberg_interaction_on_position(inst.target_pos, inst.operation)
-            elif isinstance(inst, MoveAODRow):
-                self.move_aod_row_by(inst.row_index, inst.offset)
-            elif isinstance(inst, MoveAODCol):
-                self.move_aod_col_by(inst.col_index, inst.offset)
-            elif isinstance(inst, Initialize):
-                self.add_qubits_to_aod_traps(inst.aod_qubits, inst.aod_qubit_positions_rowcol)
-                self.add_qubits_to_slm_traps(inst.slm_qubits, inst.slm_trap_indices)
-            elif isinstance(inst, DrawState):
-                show_current_state(self, draw_movement_lines=True)
-            else:
-                # unknown instruction
-                pass
+            handler = self.handler_for(type(inst))
+            if handler is not None:
+                handler(self, inst)
             if print_instructions:
                 print(inst)
             if draw_states_between_instructions:
-                show_current_state(self, draw_movement_lines=True, indx=indx)
-            indx += 1
\ No newline at end of file
+                _show_current_state(self, draw_movement_lines=True, indx=indx)
+            indx += 1
+
+    def execute_instructions_headless(self, instructions, trace=None, listener=None):
+        # no printing and no plotting, DrawState instructions are skipped
+        if listener is not None:
+            return self.execute_instructions_listened(instructions, listener, trace)
+        if isinstance(instructions, Program):
+            return self.execute_program(instructions, trace)
+        if trace is not None:
+            instructions = trace.steps(self, instructions)
+        resolved = self._resolved_headless_handlers
+        handler_for = self.handler_for
+        nof_instructions = 0
+        start = time.perf_counter()
+        for inst in instructions:
+            inst_type = type(inst)
+            if inst_type in resolved:
+                handler = resolved[inst_type]
+            else:
+                handler = handler_for(inst_type, headless=True)
+            if handler is not None:
+                handler(self, inst)
+            nof_instructions += 1
+        return ExecutionStats(nof_instructions, time.perf_counter() - start)
+
+    def execute_instructions_listened(self, instructions, listener, trace=None):
+        # headless execution that times every instruction and reports it,
+        # with the aod travel, transfers and pulses, to listener. kept apart
+        # from the other loops so they pay nothing for it.
+        if isinstance(instructions, Program):
+            instructions = iter(instructions)
+        if trace is not None:
+            instructions = trace.steps(self, instructions)
+        handler_for = self.handler_for
+        clock = time.perf_counter
+        nof_instructions = 0
+        run_start = clock()
+        for inst in instructions:
+            inst_type = type(inst)
+            handler = handler_for(inst_type, headless=True)
+            transfers = isinstance(inst, (ActivateAODRow, ActivateAODCol, DeactivateAODRow, DeactivateAODCol))
+            if transfers:
+                on_aod = np.count_nonzero(self.state.aod_qubit_ids != EMPTY)
+            start = clock()
+            if handler is not None:
+                handler(self, inst)
+            listener.instruction_executed(inst_type.__name__, start, clock() - start)
+            if transfers:
+                change = int(np.count_nonzero(self.state.aod_qubit_ids != EMPTY) - on_aod)
+                listener.qubits_transferred(max(change, 0), max(-change, 0))
+            elif isinstance(inst, (MoveAODRow, MoveAODCol)):
+                listener.aod_moved(abs(inst.offset))
+            elif isinstance(inst, (MoveAODRows, MoveAODCols)):
+                listener.aod_moved(float(np.sum(np.abs(inst.offsets))))
+            elif isinstance(inst, RydbergLaser):
+                listener.pulsed(1)
+            elif isinstance(inst, RydbergPulse):
+                listener.pulsed(len(inst.target_positions))
+            nof_instructions += 1
+        elapsed = clock() - run_start
+        listener.phase('execute', 'execute', run_start, elapsed)
+        return ExecutionStats(nof_instructions, elapsed)
+
+    def execute_program(self, program, trace=None):
+        # headless execution of a columnar Program, straight from its records
+        payloads = program.payloads
+        records = program.records
+        line_indices = program.line_indices
+        line_offsets = program.line_offsets
+        chunk_size = 1 << 16
+        start = time.perf_counter()
+        for chunk_start in range(0, len(records), chunk_size):
+            chunk = records[chunk_start:chunk_start + chunk_size]
+            chunk_records = zip(chunk['opcode'].tolist(), chunk['index'].tolist(), chunk['offset'].tolist(),
+                                chunk['laser_x'].tolist(), chunk['laser_y'].tolist(), chunk['payload'].tolist())
+            if trace is not None:
+                chunk_records = trace.steps(self, chunk_records)
+            for opcode, index, offset, laser_x, laser_y, payload in chunk_records:
+                if opcode == OP_MOVE_AOD_ROW:
+                    self.move_aod_row_by(index, offset)
+                elif opcode == OP_MOVE_AOD_COL:
+                    self.move_aod_col_by(index, offset)
+                elif opcode == OP_ACTIVATE_AOD_ROW:
+                    self.activate_aod_row(index)
+                elif opcode == OP_ACTIVATE_AOD_COL:
+                    self.activate_aod_col(index)
+                elif opcode == OP_DEACTIVATE_AOD_ROW:
+                    self.deactivate_aod_row(index)
+                elif opcode == OP_DEACTIVATE_AOD_COL:
+                    self.deactivate_aod_col(index)
+                elif opcode == OP_RYDBERG_LASER:
+                    self.rydberg_interaction_on_position((laser_x, laser_y), payloads[payload])
+                elif opcode == OP_MOVE_AOD_ROWS:
+                    self.move_aod_rows_by(line_indices[index:index + payload], line_offsets[index:index + payload])
+                elif opcode == OP_MOVE_AOD_COLS:
+                    self.move_aod_cols_by(line_indices[index:index + payload], line_offsets[index:index + payload])
+                elif opcode == OP_RYDBERG_PULSE_SITES:
+                    self.rydberg_pulse_on_positions(*program.pulse_sites(index, payload))
+                elif opcode == OP_RYDBERG_PULSE:
+                    inst = payloads[payload]
+                    self.rydberg_pulse_on_positions(inst.target_positions, inst.operations)
+                elif opcode == OP_DRAW_STATE:
+                    pass
+                else:
+                    inst = payloads[payload]
+                    handler = self.handler_for(type(inst), headless=True)
+                    if handler is not None:
+                        handler(self, inst)
+        return ExecutionStats(len(records), time.perf_counter() - start)
+
+
+def _show_current_state(device, **kwargs):
+    from dpqa_src.dpqa_plotter import show_current_state
+    show_current_state(device, **kwargs)
+
+def _initialize(device, inst):
+    device.add_qubits_to_aod_traps(inst.aod_qubits, inst.aod_qubit_positions_rowcol)
+    device.add_qubits_to_slm_traps(inst.slm_qubits, inst.slm_trap_indices)
+
+
+DPQA.instruction_handlers = {
+    ActivateAODRow: lambda device, inst: device.activate_aod_row(inst.row_index),
+    ActivateAODCol: lambda device, inst: device.activate_aod_col(inst.col_index),
+    DeactivateAODRow: lambda device, inst: device.deactivate_aod_row(inst.row_index),
+    DeactivateAODCol: lambda device, inst: device.deactivate_aod_col(inst.col_index),
+    RydbergLaser: lambda device, inst: device.rydberg_interaction_on_position(inst.target_pos, inst.operation),
+    RydbergPulse: lambda device, inst: device.rydberg_pulse_on_positions(inst.target_positions, inst.operations),
+    MoveAODRow: lambda device, inst: device.move_aod_row_by(inst.row_index, inst.offset),
+    MoveAODCol: lambda device, inst: device.move_aod_col_by(inst.col_index, inst.offset),
+    MoveAODRows: lambda device, inst: device.move_aod_rows_by(inst.row_indices, inst.offsets),
+    MoveAODCols: lambda device, inst: device.move_aod_cols_by(inst.col_indices, inst.offsets),
+    Initialize: _initialize,
+    DrawState: lambda device, inst: _show_current_state(device, draw_movement_lines=True),
+}
+DPQA.drawing_instruction_types = {DrawState}
+DPQA._resolved_handlers = {}
+DPQA._resolved_headless_handlers = {}
+
+
+class ExecutionStats:
+    def __init__(self, nof_instructions, elapsed_seconds):
+        self.nof_instructions = nof_instructions
+        self.elapsed_seconds = elapsed_seconds
+
+    @property
+    def instructions_per_second(self):
+        if self.elapsed_seconds == 0:
+            return float('inf')
+        return self.nof_instructions / self.elapsed_seconds
+
+    def __str__(self):
+        return (f"executed {self.nof_instructions} instructions in {self.elapsed_seconds:.3f} s "
+                f"({self.instructions_per_second:.0f} instructions/s)")
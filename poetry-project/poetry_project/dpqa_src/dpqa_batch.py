@@ -0,0 +1,80 @@
+import itertools
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from dpqa_src.dpqa_binary import dump_program, parse_program
+from dpqa_src.dpqa_compiler import compile_overlapping_traps
+from dpqa_src.dpqa_program import Program
+
+
+class BatchResult:
+    # one compiled circuit of a batch. index is the circuit's position in the
+    # input. if the circuit did not compile, error is the message and
+    # error_type the class name of the exception it raised (device and
+    # program are None then).
+    def __init__(self, index, device, program, error=None, error_type=None):
+        self.index = index
+        self.device = device
+        self.program = program
+        self.error = error
+        self.error_type = error_type
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _compile_chunk(compile_function, compile_kwargs, chunk):
+    # runs in a worker. programs go back as program file bytes, not as pickled
+    # instruction objects. a circuit that fails only fails its own result.
+    results = []
+    for index, circuit in chunk:
+        try:
+            device, instructions = compile_function(circuit, **compile_kwargs)
+            data = dump_program(device, Program.from_instructions(instructions))
+        except Exception as error:
+            results.append((index, None, str(error) or repr(error), type(error).__name__))
+            continue
+        results.append((index, data, None, None))
+    return results
+
+
+def compile_batch(circuits, compile_function=None, max_workers=None, chunksize=1, max_in_flight=None,
+                  **compile_kwargs):
+    # compiles every circuit of the iterable with compile_function (default
+    # compile_overlapping_traps) on a pool of max_workers processes (default
+    # one per core) and yields a BatchResult per circuit as it finishes, so
+    # not in input order. circuits are sent in chunks of chunksize, and at
+    # most max_in_flight chunks (default 2 per worker) are submitted at a
+    # time: the input is read lazily and memory stays bounded however long
+    # the batch is. compile_function must be a module level function so the
+    # workers can unpickle it.
+    if compile_function is None:
+        compile_function = compile_overlapping_traps
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    assert(chunksize >= 1 and max_in_flight >= 1)
+
+    indexed = enumerate(circuits)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                chunk = list(itertools.islice(indexed, chunksize))
+                if not chunk:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(_compile_chunk, compile_function, compile_kwargs, chunk))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for index, data, error, error_type in future.result():
+                    if data is None:
+                        yield BatchResult(index, None, None, error, error_type)
+                    else:
+                        device, program = parse_program(data)
+                        yield BatchResult(index, device, program)
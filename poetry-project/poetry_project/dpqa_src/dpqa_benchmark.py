@@ -0,0 +1,509 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import traceback
+import tracemalloc
+
+import cirq
+import numpy as np
+
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_timing import analyze_timing
+
+DEFAULT_BASELINE = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                                                'benchmarks', 'baseline.json'))
+PYPROJECT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pyproject.toml'))
+
+# the packages whose versions go with the results. the pinned ones must
+# match pyproject.toml for a baseline to be reproducible from the repo.
+ENVIRONMENT_PACKAGES = ('python', 'numpy', 'cirq')
+PINNED_PACKAGES = ('numpy', 'cirq')
+
+# circuit families. the compilers take line qubits 0..n-1 that all appear in
+# the circuit, and compile only the two qubit gates.
+
+def random_layers_circuit(nof_qubits, depth=8, seed=0):
+    # depth layers of cz gates on a random perfect matching of the qubits
+    rng = random.Random(seed)
+    qubits = cirq.LineQubit.range(nof_qubits)
+    circuit = cirq.Circuit(cirq.H.on_each(*qubits))
+    for _ in range(depth):
+        order = list(range(nof_qubits))
+        rng.shuffle(order)
+        circuit.append(cirq.CZ(qubits[a], qubits[b]) for a, b in zip(order[0::2], order[1::2]))
+    return circuit
+
+def qft_circuit(nof_qubits):
+    # textbook qft without the final swaps, n(n-1)/2 controlled phases
+    qubits = cirq.LineQubit.range(nof_qubits)
+    circuit = cirq.Circuit()
+    for i in range(nof_qubits):
+        circuit.append(cirq.H(qubits[i]))
+        for j in range(i + 1, nof_qubits):
+            circuit.append(cirq.CZPowGate(exponent=1 / 2**(j - i))(qubits[j], qubits[i]))
+    return circuit
+
+def qaoa_circuit(nof_qubits, degree=3, layers=1, seed=0):
+    # maxcut qaoa on a random graph with degree * n / 2 edges
+    rng = random.Random(seed)
+    qubits = cirq.LineQubit.range(nof_qubits)
+    nof_edges = min(degree * nof_qubits // 2, nof_qubits * (nof_qubits - 1) // 2)
+    edges = set()
+    while len(edges) < nof_edges:
+        a, b = rng.sample(range(nof_qubits), 2)
+        edges.add((min(a, b), max(a, b)))
+    edges = sorted(edges)
+    circuit = cirq.Circuit(cirq.H.on_each(*qubits))
+    for layer in range(layers):
+        gamma = 0.4 + 0.1 * layer
+        circuit.append(cirq.ZZPowGate(exponent=gamma)(qubits[a], qubits[b]) for a, b in edges)
+        circuit.append(cirq.rx(0.7).on_each(*qubits))
+    return circuit
+
+def ghz_ladder_circuit(nof_qubits):
+    # hadamard and a chain of cnots down the line
+    qubits = cirq.LineQubit.range(nof_qubits)
+    circuit = cirq.Circuit(cirq.H(qubits[0]))
+    circuit.append(cirq.CNOT(qubits[i], qubits[i + 1]) for i in range(nof_qubits - 1))
+    return circuit
+
+CIRCUIT_FAMILIES = {
+    'random_layers': random_layers_circuit,
+    'qft': qft_circuit,
+    'qaoa': qaoa_circuit,
+    'ghz_ladder': ghz_ladder_circuit,
+}
+
+# (family, sizes). qft grows quadratically and stops at 256 qubits (32640 gates)
+DEFAULT_SUITE = [
+    ('random_layers', (4, 16, 64, 256, 1024)),
+    ('qft', (4, 16, 64, 256)),
+    ('qaoa', (4, 16, 64, 256, 1024)),
+    ('ghz_ladder', (4, 16, 64, 256, 1024)),
+]
+
+QUICK_SUITE = [(family, tuple(n for n in sizes if n <= 64)) for family, sizes in DEFAULT_SUITE]
+
+DEFAULT_COMPILERS = (compile, compile_overlapping_traps)
+
+# cases that are known to fail, with the reason. they are recorded with
+# their error like any other failing case, but a failure that is not listed
+# here is never taken into a baseline (see main).
+_COMPILE_OUT_OF_BOUNDS = "compile moves aod lines past max_dim on large grids"
+KNOWN_FAILURES = {
+    ('random_layers', 64, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('random_layers', 256, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('random_layers', 1024, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('qft', 64, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('qft', 256, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('qaoa', 256, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('qaoa', 1024, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('ghz_ladder', 256, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+    ('ghz_ladder', 1024, 'compile'): _COMPILE_OUT_OF_BOUNDS,
+}
+
+# a metric regresses when it grows past baseline * (1 + relative) + absolute.
+# the counts are deterministic and must not grow at all, the timings and the
+# memory get room for noise (and an absolute floor for the smallest cases).
+DEFAULT_TOLERANCES = {
+    'instructions': (0.0, 0),
+    'hardware_duration': (1e-9, 1e-6),
+    'compile_seconds': (0.5, 0.02),
+    'execute_seconds': (0.5, 0.02),
+    'peak_memory_bytes': (0.25, 1 << 20),
+    'import_seconds': (0.5, 0.05),
+}
+
+# modules that must import quickly, and the slow dependencies none of them
+# may load: cirq comes with the circuits, matplotlib with drawing and z3 with
+# the first smt window
+IMPORT_MODULES = (
+    'dpqa_src.dpqa',
+    'dpqa_src.dpqa_compiler',
+    'dpqa_src.dpqa_program',
+    'dpqa_src.dpqa_binary',
+    'dpqa_src.dpqa_validator',
+    'dpqa_src.dpqa_timing',
+    'dpqa_src.dpqa_cache',
+    'dpqa_src.dpqa_batch',
+    'dpqa_src.dpqa_trace',
+    'dpqa_src.dpqa_sweep',
+)
+HEAVY_MODULES = ('cirq', 'matplotlib', 'z3')
+
+_IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+def case_key(result):
+    return (result['family'], result['nof_qubits'], result['compiler'])
+
+def unexpected_failures(results):
+    # the failing cases that are not in KNOWN_FAILURES
+    return [result for result in results['results']
+            if result['error'] is not None and case_key(result) not in KNOWN_FAILURES]
+
+def error_fields(stage, error):
+    # what a failed case records: the stage it failed in (compile, timing,
+    # execute or memory), the exception and the line that raised it (for a
+    # bare assert the only hint of what broke)
+    frame = traceback.extract_tb(error.__traceback__)[-1]
+    return {
+        'error': str(error) or type(error).__name__,
+        'error_type': type(error).__name__,
+        'error_stage': stage,
+        'error_location': f"{os.path.basename(frame.filename)}:{frame.lineno}",
+        'error_line': frame.line,
+    }
+
+def describe_error(result):
+    # older results only have the message
+    if result.get('error_stage') is None:
+        return result['error']
+    error = result['error_type']
+    if result['error'] != error:
+        error = f"{error}: {result['error']}"
+    return f"{result['error_stage']} failed at {result['error_location']} ({result['error_line']}): {error}"
+
+def run_case(family, nof_qubits, compile_function, repeats=1, memory=True):
+    # compiles the circuit, estimates its hardware duration and executes it
+    # headless. the timings are the best of repeats runs. peak_memory_bytes
+    # is the tracemalloc peak of one more compile (it holds the whole program,
+    # executing it adds little), done apart so tracing does not slow the
+    # timed runs. a case that raises records the error (see error_fields)
+    # instead of its metrics.
+    circuit = CIRCUIT_FAMILIES[family](nof_qubits)
+    result = {
+        'family': family,
+        'nof_qubits': nof_qubits,
+        'compiler': compile_function.__name__,
+        'gates': sum(1 for oper in circuit.all_operations() if len(oper.qubits) == 2),
+        'error': None,
+    }
+    compile_seconds = math.inf
+    execute_seconds = math.inf
+    stage = None
+    try:
+        for _ in range(repeats):
+            stage = 'compile'
+            start = time.perf_counter()
+            device, instructions = compile_function(circuit)
+            compile_seconds = min(compile_seconds, time.perf_counter() - start)
+            # the timing analysis needs the device as compiled, before executing
+            stage = 'timing'
+            hardware_duration = analyze_timing(device, instructions, per_qubit=False).total_duration
+            stage = 'execute'
+            stats = device.execute_instructions(instructions, headless=True)
+            execute_seconds = min(execute_seconds, stats.elapsed_seconds)
+        peak_memory_bytes = None
+        if memory:
+            stage = 'memory'
+            tracemalloc.start()
+            compile_function(circuit)
+            peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    except Exception as error:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        result.update(error_fields(stage, error))
+        result['known_failure'] = KNOWN_FAILURES.get(case_key(result))
+        return result
+    result.update({
+        'instructions': len(instructions),
+        'hardware_duration': hardware_duration,
+        'compile_seconds': compile_seconds,
+        'execute_seconds': execute_seconds,
+        'peak_memory_bytes': peak_memory_bytes,
+    })
+    return result
+
+def pinned_versions(path=PYPROJECT):
+    # the exact versions pyproject.toml pins for PINNED_PACKAGES
+    with open(path) as f:
+        text = f.read()
+    pins = {}
+    for name in PINNED_PACKAGES:
+        match = re.search(rf'^{name} = "([0-9.]+)"', text, re.MULTILINE)
+        if match is not None:
+            pins[name] = match.group(1)
+    return pins
+
+def _same_version(a, b):
+    # 1.2 and 1.2.0 are the same version
+    def parts(version):
+        numbers = [int(number) for number in re.findall(r'\d+', version)]
+        while numbers and numbers[-1] == 0:
+            numbers.pop()
+        return numbers
+    return parts(a) == parts(b)
+
+def unpinned_versions(results, pins=None):
+    # 'name recorded (pinned pin)' for every package of results that differs
+    # from its pin in pyproject.toml
+    if pins is None:
+        pins = pinned_versions()
+    environment = results.get('environment', {})
+    return [f"{name} {environment.get(name)} (pinned {pin})" for name, pin in pins.items()
+            if environment.get(name) is None or not _same_version(environment[name], pin)]
+
+def environment_differences(baseline, current):
+    # 'name baseline -> current' for every package of ENVIRONMENT_PACKAGES
+    # the two runs have different versions of
+    old = baseline.get('environment', {})
+    new = current.get('environment', {})
+    return [f"{name} {old.get(name)} -> {new.get(name)}" for name in ENVIRONMENT_PACKAGES
+            if old.get(name) != new.get(name)]
+
+def run_import_case(module, repeats=5):
+    # imports module in fresh interpreters, the best of repeats (after one
+    # run that leaves the bytecode cached). import_seconds includes numpy.
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, environment.get('PYTHONPATH')]))
+    script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    best = None
+    for run in range(repeats + 1):
+        output = subprocess.run([sys.executable, '-c', script], env=environment, check=True,
+                                capture_output=True, text=True).stdout
+        measured = json.loads(output.strip().splitlines()[-1])
+        if run > 0 and (best is None or measured['seconds'] < best['seconds']):
+            best = measured
+    return {'module': module, 'import_seconds': best['seconds'], 'heavy_modules': best['heavy']}
+
+def run_suite(suite=None, compilers=None, repeats=1, memory=True, imports=True, log=None):
+    # runs every (family, size, compiler) case, and the import cases. log
+    # is called with every finished case's result.
+    import_results = []
+    if imports:
+        for module in IMPORT_MODULES:
+            result = run_import_case(module)
+            import_results.append(result)
+            if log is not None:
+                log(result)
+    if suite is None:
+        suite = DEFAULT_SUITE
+    if compilers is None:
+        compilers = DEFAULT_COMPILERS
+    results = []
+    for family, sizes in suite:
+        for nof_qubits in sizes:
+            for compile_function in compilers:
+                result = run_case(family, nof_qubits, compile_function, repeats=repeats, memory=memory)
+                results.append(result)
+                if log is not None:
+                    log(result)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cirq': cirq.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+        },
+        'repeats': repeats,
+        'imports': import_results,
+        'results': results,
+    }
+
+def save_results(path, results):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Regression:
+    # a case of the baseline that got worse. metric is None when the case
+    # stopped compiling.
+    def __init__(self, case, metric, baseline, current):
+        self.case = case
+        self.metric = metric
+        self.baseline = baseline
+        self.current = current
+
+    def __str__(self):
+        name = case_name(self.case)
+        if self.metric is None:
+            return f"{name}: {self.current}"
+        ratio = self.current / self.baseline if self.baseline else math.inf
+        return f"{name}: {self.metric} {self.baseline:.6g} -> {self.current:.6g} ({ratio:.2f}x)"
+
+
+class StatusChange:
+    # a case that failed in one run and not in the other. broken cases are
+    # regressions as well, fixed ones are only reported.
+    def __init__(self, case, baseline_error, current_error):
+        self.case = case
+        self.baseline_error = baseline_error
+        self.current_error = current_error
+
+    @property
+    def fixed(self):
+        return self.current_error is None
+
+    def __str__(self):
+        if self.fixed:
+            return f"{case_name(self.case)}: fixed, failed with {self.baseline_error}"
+        return f"{case_name(self.case)}: broken, {self.current_error}"
+
+
+def case_name(case):
+    if isinstance(case, str):
+        return f"import {case}"
+    family, nof_qubits, compiler = case
+    return f"{family} n={nof_qubits} {compiler}"
+
+
+def status_changes(baseline, current):
+    # the cases both ran that went from compiling to failing or back
+    current_results = {case_key(result): result for result in current['results']}
+    changes = []
+    for old in baseline['results']:
+        new = current_results.get(case_key(old))
+        if new is None or (old['error'] is None) == (new['error'] is None):
+            continue
+        changes.append(StatusChange(case_key(old), None if old['error'] is None else describe_error(old),
+                                    None if new['error'] is None else describe_error(new)))
+    return changes
+
+
+def compare_results(baseline, current, tolerances=None):
+    # the regressions of current against baseline, for the cases both ran
+    # (so a run of part of the suite compares that part). a case that
+    # compiled in the baseline and fails now is a regression too (see
+    # status_changes for both directions), and so is a module that now
+    # loads one of HEAVY_MODULES on import. timings are only compared when
+    # both runs are from the same machine type with the same package versions
+    # (see environment_differences), counts always.
+    if tolerances is None:
+        tolerances = DEFAULT_TOLERANCES
+    same_machine = (baseline.get('environment', {}).get('machine') == current.get('environment', {}).get('machine')
+                    and not environment_differences(baseline, current))
+    current_results = {case_key(result): result for result in current['results']}
+    regressions = [Regression(change.case, None, None, change.current_error)
+                   for change in status_changes(baseline, current) if not change.fixed]
+    for old in baseline['results']:
+        key = case_key(old)
+        new = current_results.get(key)
+        if new is None or old['error'] is not None or new['error'] is not None:
+            continue
+        for metric, (relative, absolute) in tolerances.items():
+            if metric.endswith('_seconds') and not same_machine:
+                continue
+            if old.get(metric) is None or new.get(metric) is None:
+                continue
+            if new[metric] > old[metric] * (1 + relative) + absolute:
+                regressions.append(Regression(key, metric, old[metric], new[metric]))
+
+    # a heavy module loaded on import is a regression on any machine
+    current_imports = {result['module']: result for result in current.get('imports', [])}
+    for old in baseline.get('imports', []):
+        new = current_imports.get(old['module'])
+        if new is None:
+            continue
+        if new['heavy_modules']:
+            regressions.append(Regression(old['module'], None, None, f"loads {', '.join(new['heavy_modules'])}"))
+        relative, absolute = tolerances.get('import_seconds', (math.inf, 0))
+        if same_machine and new['import_seconds'] > old['import_seconds'] * (1 + relative) + absolute:
+            regressions.append(Regression(old['module'], 'import_seconds', old['import_seconds'], new['import_seconds']))
+    return regressions
+
+def format_result(result):
+    if 'module' in result:
+        heavy = f" loads {', '.join(result['heavy_modules'])}" if result['heavy_modules'] else ""
+        return f"{'import':>13} {result['module']:<33} {result['import_seconds'] * 1000:8.1f} ms{heavy}"
+    name = f"{result['family']:>13} n={result['nof_qubits']:<5} {result['compiler']:<26}"
+    if result['error'] is not None:
+        known = f" (known failure: {result['known_failure']})" if result.get('known_failure') else ""
+        return f"{name} error: {describe_error(result)}{known}"
+    memory = result['peak_memory_bytes']
+    memory = f"{memory / 2**20:8.1f} MB" if memory is not None else ""
+    return (f"{name} {result['instructions']:>8} instructions {result['compile_seconds']:8.3f} s compile "
+            f"{result['execute_seconds']:8.3f} s execute {result['hardware_duration']:12.1f} us {memory}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="compile and execution benchmarks of the dpqa compilers")
+    parser.add_argument('--output', help="write the results as json to this file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="results to compare against")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="write the results to the baseline, from the pinned versions without new failures")
+    parser.add_argument('--allow-unpinned', action='store_true',
+                        help="update the baseline with versions other than the pinned ones")
+    parser.add_argument('--quick', action='store_true', help="only the cases up to 64 qubits")
+    parser.add_argument('--families', nargs='+', choices=sorted(CIRCUIT_FAMILIES))
+    parser.add_argument('--sizes', nargs='+', type=int, help="only these sizes of the suite")
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory runs")
+    parser.add_argument('--no-imports', action='store_true', help="skip the import time runs")
+    args = parser.parse_args(argv)
+
+    suite = QUICK_SUITE if args.quick else DEFAULT_SUITE
+    if args.families:
+        suite = [(family, sizes) for family, sizes in suite if family in args.families]
+    if args.sizes:
+        suite = [(family, tuple(n for n in sizes if n in args.sizes)) for family, sizes in suite]
+
+    results = run_suite(suite, repeats=args.repeats, memory=not args.no_memory, imports=not args.no_imports,
+                        log=lambda result: print(format_result(result), flush=True))
+    if args.output:
+        save_results(args.output, results)
+    if args.update_baseline:
+        refused = False
+        unpinned = unpinned_versions(results)
+        if unpinned and not args.allow_unpinned:
+            print(f"not writing the baseline, not the pinned versions: {', '.join(unpinned)}", file=sys.stderr)
+            refused = True
+        for result in unexpected_failures(results):
+            print(f"not writing the baseline, {format_result(result)} is not a known failure", file=sys.stderr)
+            refused = True
+        if refused:
+            return 1
+        save_results(args.baseline, results)
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, nothing to compare")
+        return 0
+    baseline = load_results(args.baseline)
+    unpinned = unpinned_versions(baseline)
+    if unpinned:
+        print(f"warning: the baseline is not from the pinned versions: {', '.join(unpinned)}", file=sys.stderr)
+    differences = environment_differences(baseline, results)
+    if differences:
+        print(f"warning: other versions than the baseline, timings not compared: {', '.join(differences)}",
+              file=sys.stderr)
+    for change in status_changes(baseline, results):
+        if change.fixed:
+            print(change)
+    regressions = compare_results(baseline, results)
+    if regressions:
+        print(f"{len(regressions)} regressions against {args.baseline}:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        return 1
+    print(f"no regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
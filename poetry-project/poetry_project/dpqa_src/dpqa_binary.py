@@ -0,0 +1,417 @@
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from dpqa_src.dpqa import DPQA
+from dpqa_src.dpqa_instructions import Initialize, RydbergPulse
+from dpqa_src.dpqa_program import INSTRUCTION_DTYPE, LINE_INDEX_DTYPE, LINE_OFFSET_DTYPE, OP_MOVE_AOD_COLS, OP_MOVE_AOD_ROWS, OP_RYDBERG_PULSE_SITES, SITE_OPERATION_DTYPE, SITE_POSITION_DTYPE, Program, ProgramBuilder
+
+# binary program file:
+#   header (HEADER_FORMAT)
+#   slm positions, float64 (nof_slm_traps, 2)
+#   instruction records, INSTRUCTION_DTYPE (nof_records,)
+#   line indices of the collective moves, LINE_INDEX_DTYPE (nof_lines,)
+#   line offsets of the collective moves, LINE_OFFSET_DTYPE (nof_lines,)
+#   pulse site positions, SITE_POSITION_DTYPE (nof_sites, 2)
+#   pulse site operations, SITE_OPERATION_DTYPE (nof_sites,)
+#   payload table, utf-8 json
+# every section starts on an 8 byte boundary. the records are read through
+# np.memmap, so a program is never parsed into instruction objects on load.
+# version 1 files (no line sections) and version 2 files (no site sections,
+# rydberg pulses in the payload table) can still be loaded.
+MAGIC = b'DPQAPRG\0'
+FORMAT_VERSION = 3
+HEADER_FORMAT = '<8sIIqqqddddqqqqqqqqqq'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_FIELDS = (
+    'magic', 'version', 'record_itemsize',
+    'aod_rows', 'aod_cols', 'nof_slm_traps',
+    'max_dim_x', 'max_dim_y', 'rydberg_radius', 'trap_transfer_radius',
+    'nof_records', 'records_offset', 'payload_offset', 'payload_nbytes',
+    'nof_lines', 'line_indices_offset', 'line_offsets_offset',
+    'nof_sites', 'site_positions_offset', 'site_operations_offset',
+)
+HEADER_FORMATS = {
+    1: ('<8sIIqqqddddqqqq', HEADER_FIELDS[:14]),
+    2: ('<8sIIqqqddddqqqqqqq', HEADER_FIELDS[:17]),
+    3: (HEADER_FORMAT, HEADER_FIELDS),
+}
+
+
+def _aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+def device_description(device):
+    return {
+        'aod_rows': device.aod_rows,
+        'aod_cols': device.aod_cols,
+        'slm_positions_xy': device.state.slm_positions_xy().astype(np.float64),
+        'max_dim_x': device.max_dim_x,
+        'max_dim_y': device.max_dim_y,
+        'rydberg_radius': device.rydberg_radius,
+        'trap_transfer_radius': device.trap_transfer_radius,
+    }
+
+
+# payloads that are neither plain json, cirq json nor one of the instructions
+# below (e.g. user registered instructions) need a codec, registered with
+# register_payload_codec. nothing else is written, and a file naming any
+# other kind is refused, so loading a program never runs code from it.
+# rydberg_pulse entries are only written for subclasses of RydbergPulse, in
+# files of version 2 and before they held every pulse.
+PAYLOAD_CODECS = {}
+_CODEC_KINDS = {}
+_BUILTIN_KINDS = ('json', 'cirq', 'initialize', 'rydberg_pulse')
+
+
+def register_payload_codec(kind, payload_type, encode, decode):
+    # encode(payload) returns a json value, decode(value) the payload again.
+    # subclasses of payload_type use the codec unless they have their own.
+    assert(kind not in _BUILTIN_KINDS), f"payload kind {kind!r} is built in"
+    PAYLOAD_CODECS[payload_type] = (kind, encode)
+    _CODEC_KINDS[kind] = decode
+
+
+def _payload_codec(payload):
+    for base in type(payload).__mro__:
+        if base in PAYLOAD_CODECS:
+            return PAYLOAD_CODECS[base]
+    return None
+
+
+def _encode_payload(payload):
+    import cirq
+    if isinstance(payload, Initialize):
+        return {'kind': 'initialize',
+                'aod_qubits': cirq.to_json(list(payload.aod_qubits)),
+                'aod_qubit_positions_rowcol': [list(pos) for pos in payload.aod_qubit_positions_rowcol],
+                'slm_qubits': cirq.to_json(list(payload.slm_qubits)),
+                'slm_trap_indices': [int(i) for i in payload.slm_trap_indices]}
+    if isinstance(payload, RydbergPulse):
+        return {'kind': 'rydberg_pulse',
+                'target_positions': [[float(x), float(y)] for x, y in payload.target_positions],
+                'operations': [_encode_payload(op) for op in payload.operations]}
+    if payload is None or isinstance(payload, (str, int, float, bool)):
+        return {'kind': 'json', 'value': payload}
+    codec = _payload_codec(payload)
+    if codec is not None:
+        kind, encode = codec
+        return {'kind': kind, 'value': encode(payload)}
+    try:
+        return {'kind': 'cirq', 'json': cirq.to_json(payload)}
+    except (TypeError, ValueError):
+        pass
+    assert(False), (f"cannot write a {type(payload).__name__} payload, "
+                    "register a codec for it with register_payload_codec")
+
+
+def _decode_payload(entry):
+    kind = entry['kind']
+    if kind == 'json':
+        return entry['value']
+    if kind == 'rydberg_pulse':
+        return RydbergPulse([tuple(pos) for pos in entry['target_positions']],
+                            [_decode_payload(op) for op in entry['operations']])
+    if kind in _CODEC_KINDS:
+        return _CODEC_KINDS[kind](entry['value'])
+    assert(kind in ('cirq', 'initialize')), f"unknown payload kind {kind!r}"
+    import cirq
+    if kind == 'cirq':
+        return cirq.read_json(json_text=entry['json'])
+    return Initialize(aod_qubits=cirq.read_json(json_text=entry['aod_qubits']),
+                      aod_qubit_positions_rowcol=[tuple(pos) for pos in entry['aod_qubit_positions_rowcol']],
+                      slm_qubits=cirq.read_json(json_text=entry['slm_qubits']),
+                      slm_trap_indices=entry['slm_trap_indices'])
+
+
+def _write_program(f, device, program):
+    if not isinstance(program, Program):
+        program = Program.from_instructions(program)
+    description = device_description(device)
+    slm_positions = np.ascontiguousarray(description['slm_positions_xy'], dtype='<f8')
+    records = np.ascontiguousarray(program.records, dtype=INSTRUCTION_DTYPE)
+    line_indices = np.ascontiguousarray(program.line_indices, dtype=LINE_INDEX_DTYPE)
+    line_offsets = np.ascontiguousarray(program.line_offsets, dtype=LINE_OFFSET_DTYPE)
+    assert(len(line_indices) == len(line_offsets))
+    site_positions = np.ascontiguousarray(program.site_positions, dtype=SITE_POSITION_DTYPE)
+    site_operations = np.ascontiguousarray(program.site_operations, dtype=SITE_OPERATION_DTYPE)
+    assert(len(site_positions) == len(site_operations))
+    payload_bytes = json.dumps([_encode_payload(p) for p in program.payloads]).encode('utf-8')
+
+    slm_offset = _aligned(HEADER_SIZE)
+    records_offset = _aligned(slm_offset + slm_positions.nbytes)
+    line_indices_offset = _aligned(records_offset + records.nbytes)
+    line_offsets_offset = _aligned(line_indices_offset + line_indices.nbytes)
+    site_positions_offset = _aligned(line_offsets_offset + line_offsets.nbytes)
+    site_operations_offset = _aligned(site_positions_offset + site_positions.nbytes)
+    payload_offset = _aligned(site_operations_offset + site_operations.nbytes)
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, INSTRUCTION_DTYPE.itemsize,
+                         description['aod_rows'], description['aod_cols'], len(slm_positions),
+                         description['max_dim_x'], description['max_dim_y'],
+                         description['rydberg_radius'], description['trap_transfer_radius'],
+                         len(records), records_offset, payload_offset, len(payload_bytes),
+                         len(line_indices), line_indices_offset, line_offsets_offset,
+                         len(site_operations), site_positions_offset, site_operations_offset)
+    # offsets are relative to the start of the program, f may already hold data
+    start = f.tell()
+    f.write(header)
+    f.write(b'\0' * (start + slm_offset - f.tell()))
+    f.write(slm_positions.data)
+    f.write(b'\0' * (start + records_offset - f.tell()))
+    f.write(records.data)
+    f.write(b'\0' * (start + line_indices_offset - f.tell()))
+    f.write(line_indices.data)
+    f.write(b'\0' * (start + line_offsets_offset - f.tell()))
+    f.write(line_offsets.data)
+    f.write(b'\0' * (start + site_positions_offset - f.tell()))
+    f.write(site_positions.data)
+    f.write(b'\0' * (start + site_operations_offset - f.tell()))
+    f.write(site_operations.data)
+    f.write(b'\0' * (start + payload_offset - f.tell()))
+    f.write(payload_bytes)
+
+
+def _temporary_path(path):
+    # files are written next to their final name and renamed when complete,
+    # so a failed write never leaves a truncated program behind
+    return f"{os.fspath(path)}.{os.getpid()}.tmp"
+
+
+def save_program(path, device, program):
+    # program may be a Program or any iterable of instructions. anything but
+    # a Program is streamed to the file by a ProgramWriter.
+    if not isinstance(program, Program):
+        with ProgramWriter(path, device) as writer:
+            writer.extend(program)
+        return
+    temporary_path = _temporary_path(path)
+    f = open(temporary_path, 'wb')
+    try:
+        with f:
+            _write_program(f, device, program)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, path)
+
+
+class ProgramWriter:
+    # writes a program file from instructions appended one at a time, e.g. a
+    # compile stream, holding at most chunk_size records in memory. records
+    # go to the file in chunks, the line and site sections and the encoded
+    # payload table (known only at the end) to temporary files that are
+    # copied after the records, and the header is written last. what stays
+    # in memory for the whole run is one payload entry per distinct rydberg
+    # operation, the ones later instructions may share.
+    #
+    # the file is written under a temporary name and renamed to path by
+    # close(). leaving a with block on an exception (or calling discard())
+    # removes it instead, so path only ever holds a complete program.
+    def __init__(self, path, device, chunk_size=1 << 16):
+        self.path = path
+        self.temporary_path = _temporary_path(path)
+        self.device = device
+        self.chunk_size = chunk_size
+        self.builder = ProgramBuilder(chunk_size)
+        self.nof_records = 0
+        self.nof_lines = 0
+        self.nof_sites = 0
+        self.f = open(self.temporary_path, 'wb')
+        self.line_indices_file = tempfile.TemporaryFile()
+        self.line_offsets_file = tempfile.TemporaryFile()
+        self.site_positions_file = tempfile.TemporaryFile()
+        self.site_operations_file = tempfile.TemporaryFile()
+        self.payload_file = tempfile.TemporaryFile()
+
+        description = device_description(device)
+        self.slm_positions = np.ascontiguousarray(description['slm_positions_xy'], dtype='<f8')
+        self.slm_offset = _aligned(HEADER_SIZE)
+        self.records_offset = _aligned(self.slm_offset + self.slm_positions.nbytes)
+        self.f.write(b'\0' * self.slm_offset)
+        self.f.write(self.slm_positions.data)
+        self.f.write(b'\0' * (self.records_offset - self.f.tell()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        # drops the partly written file
+        for f in (self.f, self.line_indices_file, self.line_offsets_file, self.site_positions_file,
+                  self.site_operations_file, self.payload_file):
+            f.close()
+        if os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+
+    def append(self, inst):
+        self.builder.append(inst)
+        if self.builder.nof_records == self.chunk_size:
+            self.flush()
+
+    def extend(self, instructions):
+        for inst in instructions:
+            self.append(inst)
+
+    def flush(self):
+        builder = self.builder
+        records = builder.records[:builder.nof_records]
+        # the builder numbers lines and sites from the start of the chunk
+        collective = (records['opcode'] == OP_MOVE_AOD_ROWS) | (records['opcode'] == OP_MOVE_AOD_COLS)
+        records['index'][collective] += self.nof_lines
+        records['index'][records['opcode'] == OP_RYDBERG_PULSE_SITES] += self.nof_sites
+        self.f.write(records.data)
+        self.line_indices_file.write(np.array(builder.line_indices, dtype=LINE_INDEX_DTYPE).data)
+        self.line_offsets_file.write(np.array(builder.line_offsets, dtype=LINE_OFFSET_DTYPE).data)
+        self.site_positions_file.write(np.array(builder.site_positions, dtype=SITE_POSITION_DTYPE).data)
+        self.site_operations_file.write(np.array(builder.site_operations, dtype=SITE_OPERATION_DTYPE).data)
+        # payload ids go on from chunk to chunk, the entries are written as
+        # the items of one json list
+        for payload in builder.payloads:
+            separator = ', ' if builder.first_payload_id > 0 else ''
+            self.payload_file.write((separator + json.dumps(_encode_payload(payload))).encode('utf-8'))
+            builder.first_payload_id += 1
+        self.nof_records += builder.nof_records
+        self.nof_lines += len(builder.line_indices)
+        self.nof_sites += len(builder.site_operations)
+        builder.nof_records = 0
+        builder.line_indices = []
+        builder.line_offsets = []
+        builder.site_positions = []
+        builder.site_operations = []
+        builder.payloads = []
+
+    def close(self):
+        self.flush()
+        f = self.f
+        line_indices_offset = _aligned(self.records_offset + self.nof_records * INSTRUCTION_DTYPE.itemsize)
+        line_offsets_offset = _aligned(line_indices_offset + self.nof_lines * LINE_INDEX_DTYPE.itemsize)
+        site_positions_offset = _aligned(line_offsets_offset + self.nof_lines * LINE_OFFSET_DTYPE.itemsize)
+        site_operations_offset = _aligned(site_positions_offset + self.nof_sites * 2 * SITE_POSITION_DTYPE.itemsize)
+        payload_offset = _aligned(site_operations_offset + self.nof_sites * SITE_OPERATION_DTYPE.itemsize)
+        for offset, section_file in ((line_indices_offset, self.line_indices_file),
+                                     (line_offsets_offset, self.line_offsets_file),
+                                     (site_positions_offset, self.site_positions_file),
+                                     (site_operations_offset, self.site_operations_file)):
+            f.write(b'\0' * (offset - f.tell()))
+            section_file.seek(0)
+            shutil.copyfileobj(section_file, f)
+            section_file.close()
+        f.write(b'\0' * (payload_offset - f.tell()))
+        f.write(b'[')
+        self.payload_file.seek(0)
+        shutil.copyfileobj(self.payload_file, f)
+        self.payload_file.close()
+        f.write(b']')
+        payload_nbytes = f.tell() - payload_offset
+
+        description = device_description(self.device)
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, INSTRUCTION_DTYPE.itemsize,
+                            description['aod_rows'], description['aod_cols'], len(self.slm_positions),
+                            description['max_dim_x'], description['max_dim_y'],
+                            description['rydberg_radius'], description['trap_transfer_radius'],
+                            self.nof_records, self.records_offset, payload_offset, payload_nbytes,
+                            self.nof_lines, line_indices_offset, line_offsets_offset,
+                            self.nof_sites, site_positions_offset, site_operations_offset))
+        f.close()
+        os.replace(self.temporary_path, self.path)
+
+
+def dump_program(device, program):
+    # the program file as bytes, e.g. to send a program between processes
+    f = io.BytesIO()
+    _write_program(f, device, program)
+    return f.getvalue()
+
+
+def _parse_header(raw):
+    assert len(raw) >= 12 and raw[:8] == MAGIC, "not a dpqa program file"
+    version = struct.unpack('<I', raw[8:12])[0]
+    assert version in HEADER_FORMATS, f"unsupported program format version {version}"
+    header_format, header_fields = HEADER_FORMATS[version]
+    header_size = struct.calcsize(header_format)
+    assert len(raw) >= header_size, "not a dpqa program file"
+    header = dict(zip(header_fields, struct.unpack(header_format, raw[:header_size])))
+    header.setdefault('nof_lines', 0)
+    header.setdefault('nof_sites', 0)
+    header['slm_offset'] = _aligned(header_size)
+    assert header['record_itemsize'] == INSTRUCTION_DTYPE.itemsize
+    return header
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    return _parse_header(raw)
+
+
+def _program_from_sections(header, read_array, payload_bytes):
+    slm_positions = np.zeros((0, 2))
+    if header['nof_slm_traps'] > 0:
+        slm_positions = read_array('<f8', header['slm_offset'], (header['nof_slm_traps'], 2))
+    records = np.zeros(0, dtype=INSTRUCTION_DTYPE)
+    if header['nof_records'] > 0:
+        records = read_array(INSTRUCTION_DTYPE, header['records_offset'], (header['nof_records'],))
+    line_indices = np.zeros(0, dtype=LINE_INDEX_DTYPE)
+    line_offsets = np.zeros(0, dtype=LINE_OFFSET_DTYPE)
+    if header['nof_lines'] > 0:
+        line_indices = read_array(LINE_INDEX_DTYPE, header['line_indices_offset'], (header['nof_lines'],))
+        line_offsets = read_array(LINE_OFFSET_DTYPE, header['line_offsets_offset'], (header['nof_lines'],))
+    site_positions = np.zeros((0, 2), dtype=SITE_POSITION_DTYPE)
+    site_operations = np.zeros(0, dtype=SITE_OPERATION_DTYPE)
+    if header['nof_sites'] > 0:
+        site_positions = read_array(SITE_POSITION_DTYPE, header['site_positions_offset'], (header['nof_sites'], 2))
+        site_operations = read_array(SITE_OPERATION_DTYPE, header['site_operations_offset'], (header['nof_sites'],))
+    payloads = [_decode_payload(entry) for entry in json.loads(payload_bytes.decode('utf-8'))]
+
+    device = DPQA(aod_rows=header['aod_rows'],
+                  aod_cols=header['aod_cols'],
+                  slm_positions_xy=np.array(slm_positions),
+                  max_dim_x=header['max_dim_x'],
+                  max_dim_y=header['max_dim_y'],
+                  rydberg_radius=header['rydberg_radius'],
+                  trap_transfer_radius=header['trap_transfer_radius'])
+    return (device, Program(records, payloads, line_indices, line_offsets, site_positions, site_operations))
+
+
+def load_program(path):
+    # returns (device, program). the program records are memory mapped from
+    # the file, only the payload table is read into memory.
+    header = read_header(path)
+
+    def read_array(dtype, offset, shape):
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    with open(path, 'rb') as f:
+        f.seek(header['payload_offset'])
+        payload_bytes = f.read(header['payload_nbytes'])
+    return _program_from_sections(header, read_array, payload_bytes)
+
+
+def parse_program(data):
+    # (device, program) from the bytes of dump_program. the records are read
+    # only views into data, nothing is copied but the payload table.
+    header = _parse_header(data)
+
+    def read_array(dtype, offset, shape):
+        dtype = np.dtype(dtype)
+        return np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+    payload_bytes = bytes(data[header['payload_offset']:header['payload_offset'] + header['payload_nbytes']])
+    return _program_from_sections(header, read_array, payload_bytes)
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from dpqa_src.dpqa_binary import FORMAT_VERSION, dump_program, parse_program
+from dpqa_src.dpqa_compiler import COMPILER_VERSION, compile, compile_overlapping_traps
+from dpqa_src.dpqa_optimizer import collect_moves, optimize_instructions
+from dpqa_src.dpqa_program import Program
+
+# options of the whole stream passes, applied after the blocks are joined
+STREAM_OPTIONS = ('optimize', 'collective_moves')
+
+
+def option_key(value):
+    # a json value for an option that changes when the option does. arrays
+    # are hashed whole (repr would elide the middle of a long one).
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = np.ascontiguousarray(value)
+        return {'dtype': value.dtype.str, 'shape': list(value.shape),
+                'sha256': hashlib.sha256(value.tobytes()).hexdigest()}
+    if isinstance(value, (list, tuple)):
+        return [type(value).__name__, [option_key(item) for item in value]]
+    if isinstance(value, dict):
+        return {repr(name): option_key(item) for name, item in value.items()}
+    return repr(value)
+
+
+def circuit_key(circuit, compile_function, compile_kwargs):
+    # sha256 of what the compilers read from a circuit: the number of qubits
+    # and the two qubit gates of every moment, in order, plus the compile
+    # function and its options. single qubit gates are not compiled, they
+    # only change the key where they add moments (windows of compile_smt
+    # count moments). the device is built from the number of qubits, so it
+    # is covered too. a listener does not change the program and is left out.
+    # the compiler and program format versions are part of the key, so a
+    # new compiler never gets the programs of an old one from disk.
+    moments = []
+    for moment in circuit:
+        gates = [[oper.qubits[0].x, oper.qubits[1].x, repr(oper.gate)]
+                 for oper in moment.operations if len(oper.qubits) == 2]
+        moments.append(gates)
+    description = {
+        'nof_qubits': len(circuit.all_qubits()),
+        'moments': moments,
+        'compiler': f"{compile_function.__module__}.{compile_function.__qualname__}",
+        'options': {name: option_key(value) for name, value in sorted(compile_kwargs.items()) if name != 'listener'},
+        'versions': [COMPILER_VERSION, FORMAT_VERSION],
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _writable(device_program):
+    # parse_program gives read only views into the cached bytes
+    device, program = device_program
+    return (device, Program(program.records.copy(), program.payloads,
+                            program.line_indices.copy(), program.line_offsets.copy(),
+                            program.site_positions.copy(), program.site_operations.copy()))
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def lookups(self):
+        return self.hits + self.disk_hits + self.misses
+
+    @property
+    def hit_rate(self):
+        return (self.hits + self.disk_hits) / self.lookups if self.lookups else 0.0
+
+    def __str__(self):
+        return (f"{self.lookups} lookups, {self.hits} memory hits, {self.disk_hits} disk hits, "
+                f"{self.misses} misses, {self.evictions} evictions")
+
+
+class CompilationCache:
+    # compiled programs keyed by circuit_key. the memory tier holds program
+    # file bytes (dump_program) in lru order, bounded by max_entries and
+    # max_bytes (None = no bound). with a directory, every compiled program
+    # is also saved there as <key>.dpqa and programs evicted from memory are
+    # found again on disk, also by later processes.
+    #
+    # compile() returns (device, Program), a fresh device and program on
+    # every call, so callers can execute and modify them freely.
+    #
+    # with block_moments, a circuit that is not in the cache is compiled
+    # block_moments moments at a time and every block is cached on its own,
+    # so circuits sharing blocks (e.g. repeated QAOA layers) share their
+    # compiled blocks. this needs a compiler that emits every moment
+    # independently of the others: compile, or compile_overlapping_traps
+    # without stateful or smt_window. optimize and collective_moves run on
+    # the joined stream.
+    def __init__(self, max_entries=128, max_bytes=None, directory=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.stats = CacheStats()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries or (self.directory is not None and os.path.exists(self._path(key)))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.dpqa')
+
+    def compile(self, circuit, compile_function=None, block_moments=None, **compile_kwargs):
+        if compile_function is None:
+            compile_function = compile_overlapping_traps
+        key = circuit_key(circuit, compile_function, compile_kwargs)
+
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return _writable(parse_program(data))
+
+        if self.directory is not None and os.path.exists(self._path(key)):
+            self.stats.disk_hits += 1
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            self._insert(key, data)
+            return _writable(parse_program(data))
+
+        self.stats.misses += 1
+        if block_moments is not None and len(circuit) > block_moments:
+            device, instructions = self._compile_blocks(circuit, compile_function, block_moments, compile_kwargs)
+        else:
+            device, instructions = compile_function(circuit, **compile_kwargs)
+        program = Program.from_instructions(instructions)
+        data = dump_program(device, program)
+        if self.directory is not None:
+            # written next to the final name and renamed, so a concurrent
+            # reader never sees half a file
+            path = self._path(key)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+        self._insert(key, data)
+        return (device, program)
+
+    def _compile_blocks(self, circuit, compile_function, block_moments, compile_kwargs):
+        assert(compile_function in (compile, compile_overlapping_traps)
+               and not compile_kwargs.get('stateful') and not compile_kwargs.get('smt_window')), \
+            "blocks are only compiled independently by compile and stateless compile_overlapping_traps"
+        import cirq
+        # every block starts with an identity on every qubit, so that its
+        # device and Initialize are those of the whole circuit
+        qubits = sorted(circuit.all_qubits())
+        block_kwargs = {name: value for name, value in compile_kwargs.items() if name not in STREAM_OPTIONS}
+        moments = list(circuit)
+        device = None
+        instructions = []
+        for start in range(0, len(moments), block_moments):
+            block = cirq.Circuit([cirq.Moment(cirq.I.on_each(*qubits))] + moments[start:start + block_moments])
+            block_device, block_program = self.compile(block, compile_function, **block_kwargs)
+            block_instructions = list(block_program)
+            if device is None:
+                device = block_device
+                instructions.extend(block_instructions)
+            else:
+                instructions.extend(block_instructions[1:])
+        if compile_kwargs.get('optimize'):
+            instructions = optimize_instructions(device, instructions)
+        if compile_kwargs.get('collective_moves'):
+            instructions = collect_moves(instructions)
+        return (device, instructions)
+
+    def _insert(self, key, data):
+        self.entries[key] = data
+        self.nbytes += len(data)
+        while self.entries and ((self.max_entries is not None and len(self.entries) > self.max_entries)
+                                or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+            self.stats.evictions += 1
+
+    def clear(self):
+        # empties the memory tier, the files on disk are kept
+        self.entries.clear()
+        self.nbytes = 0
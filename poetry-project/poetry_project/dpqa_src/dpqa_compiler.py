@@ -1,7 +1,24 @@
 import math
-import cirq
+import time
 from dpqa_src.dpqa import DPQA
-from dpqa_src.dpqa_instructions import Instruction, ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, Initialize, MoveAODCol, MoveAODRow, RydbergLaser
+from dpqa_src.dpqa_optimizer import collect_moves, collected_moves, optimize_instructions
+from dpqa_src.dpqa_placement import anneal_placement, default_placement, grid_shape, interaction_graph, placement_cost
+from dpqa_src.dpqa_routing import StatefulRouter
+from dpqa_src.dpqa_timing import analyze_timing
+from dpqa_src.dpqa_scheduler import GateBlock, MomentScheduler, stage_instructions
+from dpqa_src.dpqa_smt import SMTScheduler
+from dpqa_src.dpqa_instructions import Instruction, ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, Initialize, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser, RydbergPulse
+
+# part of the compilation cache keys: bumped whenever a compiler changes the
+# program it emits for a circuit, so cached programs of older compilers are
+# not served again
+COMPILER_VERSION = 1
+
+def line_qubits(nof_qubits):
+    # cirq is imported here and not with the module: it is already loaded by
+    # whoever built the circuit, and the compiler modules import without it
+    import cirq
+    return cirq.LineQubit.range(nof_qubits)
 
 
 def get_grid(start_pos_rowcol, rows, cols):
@@ -12,7 +29,111 @@ def get_grid(start_pos_rowcol, rows, cols):
                          start_pos_rowcol[1] + c))
     return grid
 
-def compile(circuit: cirq.Circuit):
+def compilation_report(instructions):
+    # instruction count and aod travel of a compiled stream. a multi-site
+    # pulse is one pulse but runs several gates.
+    report = {
+        'instructions': 0,
+        'moves': 0,
+        'move_distance': 0.0,
+        'transfers': 0,
+        'rydberg_pulses': 0,
+        'gates': 0,
+    }
+    for instr in instructions:
+        report['instructions'] += 1
+        if isinstance(instr, (MoveAODRow, MoveAODCol)):
+            report['moves'] += 1
+            report['move_distance'] += abs(instr.offset)
+        elif isinstance(instr, (MoveAODRows, MoveAODCols)):
+            report['moves'] += 1
+            report['move_distance'] += sum(abs(offset) for offset in instr.offsets)
+        elif isinstance(instr, (ActivateAODRow, ActivateAODCol, DeactivateAODRow, DeactivateAODCol)):
+            report['transfers'] += 1
+        elif isinstance(instr, RydbergLaser):
+            report['rydberg_pulses'] += 1
+            report['gates'] += 1
+        elif isinstance(instr, RydbergPulse):
+            report['rydberg_pulses'] += 1
+            report['gates'] += len(instr.operations)
+    return report
+
+def compare_placements(circuit, compile_function=None, time_budget=1.0, seed=0, **compile_kwargs):
+    # compiles the circuit with the default placement and with an annealed
+    # one, returns both reports and what the annealed placement saves
+    if compile_function is None:
+        compile_function = compile_overlapping_traps
+    start = time.perf_counter()
+    placement = anneal_placement(circuit, time_budget=time_budget, seed=seed)
+    listener = compile_kwargs.get('listener')
+    if listener is not None:
+        listener.phase('compile', 'placement', start, time.perf_counter() - start)
+    weights = interaction_graph(circuit)
+    nof_qubits = len(circuit.all_qubits())
+    default = default_placement(nof_qubits, *grid_shape(nof_qubits))
+    default_report = compilation_report(compile_function(circuit, **compile_kwargs)[1])
+    placed_report = compilation_report(compile_function(circuit, placement=placement, **compile_kwargs)[1])
+    return {
+        'placement': placement,
+        'default_cost': placement_cost(weights, default),
+        'placed_cost': placement_cost(weights, placement),
+        'default': default_report,
+        'placed': placed_report,
+        'instructions_saved': default_report['instructions'] - placed_report['instructions'],
+        'move_distance_saved': default_report['move_distance'] - placed_report['move_distance'],
+    }
+
+def fastest_compilation(circuit, timing_model=None, candidates=None):
+    # compiles the circuit with every (compile function, keyword arguments)
+    # candidate and returns (compile function, device, instructions, timing
+    # report) of the one with the shortest estimated run time. candidates
+    # whose stream does not execute on their device are skipped.
+    if candidates is None:
+        candidates = [(compile, {}), (compile_overlapping_traps, {})]
+    best = None
+    for compile_function, compile_kwargs in candidates:
+        try:
+            device, instructions = compile_function(circuit, **compile_kwargs)
+            report = analyze_timing(device, instructions, timing_model)
+        except AssertionError:
+            continue
+        if best is None or report.total_duration < best[3].total_duration:
+            best = (compile_function, device, instructions, report)
+    assert(best is not None), "no candidate compiles the circuit"
+    return best
+
+def compile(circuit: 'cirq.Circuit', optimize=False, placement=None, collective_moves=False, listener=None):
+    # listener: a dpqa_profiler.Listener told about the phases of the compile
+    # and the branch every gate took
+    start = time.perf_counter()
+    device, stream = compile_stream(circuit, placement=placement, listener=listener)
+    compiled_instructions = list(stream)
+    compiled_instructions = _finish(device, compiled_instructions, optimize, collective_moves, listener)
+    if listener is not None:
+        listener.phase('compile', 'compile', start, time.perf_counter() - start)
+    return (device, compiled_instructions)
+
+def _finish(device, compiled_instructions, optimize, collective_moves, listener):
+    # the passes over the whole stream of compile and compile_overlapping_traps
+    start = time.perf_counter()
+    if optimize:
+        compiled_instructions = optimize_instructions(device, compiled_instructions)
+        if listener is not None:
+            listener.phase('compile', 'optimize', start, time.perf_counter() - start)
+    # collective_moves: every run of line moves becomes one instruction per axis
+    start = time.perf_counter()
+    if collective_moves:
+        compiled_instructions = collect_moves(compiled_instructions)
+        if listener is not None:
+            listener.phase('compile', 'collect_moves', start, time.perf_counter() - start)
+    return compiled_instructions
+
+def compile_stream(circuit: 'cirq.Circuit', placement=None, collective_moves=False, listener=None):
+    # (device, iterator over the instructions of compile). the instructions
+    # are generated moment by moment while the iterator is consumed, so a
+    # stream of any length can be executed, validated or written to disk
+    # without holding it. optimize needs the whole stream and is not offered.
+    setup_start = time.perf_counter()
 
     nof_qubits = len(circuit.all_qubits())
 
@@ -45,12 +166,18 @@ def compile(circuit: cirq.Circuit):
         row = math.floor(i / device.aod_rows)
         col = i % device.aod_cols
         qubit_positions_rowcol.append((row,col))
+    # placement: (row, col) of every qubit, e.g. from anneal_placement
+    if placement is not None:
+        assert(len(placement) == nof_qubits)
+        qubit_positions_rowcol = [tuple(pos) for pos in placement]
 
-    init = Initialize(aod_qubits=cirq.LineQubit.range(nof_qubits),
+    init = Initialize(aod_qubits=line_qubits(nof_qubits),
                aod_qubit_positions_rowcol=qubit_positions_rowcol,
                slm_qubits=[],
                slm_trap_indices=[])
     compiled_instructions.append(init)
+    if listener is not None:
+        listener.phase('compile', 'setup', setup_start, time.perf_counter() - setup_start)
 
     def reverseDir(instr):
         if isinstance(instr, MoveAODCol):
@@ -58,168 +185,233 @@ def compile(circuit: cirq.Circuit):
         else:
             return MoveAODRow(instr.row_index, -instr.offset)
 
-    for moment in circuit:
-        for oper in moment.operations:
-            if len(oper.qubits) == 2:
-                q1 = oper.qubits[0].x
-                q2 = oper.qubits[1].x
-                (pos1, pos2) = (qubit_positions_rowcol[q1], qubit_positions_rowcol[q2])
-                if pos1[0] == pos2[0]: #same row
-                    col_diff = pos2[1] - pos1[1]
-                    if abs(col_diff) == 1: #neighboring columns
-                        compiled_instructions.append(MoveAODCol(pos1[1], 0.8*col_diff))
-                        compiled_instructions.append(RydbergLaser((pos2[1], pos2[0]),
-                                                                   operation=oper.gate))
-                        compiled_instructions.append(MoveAODCol(pos1[1], -0.8*col_diff))
-                    else:
-                        # same row but not neighbors
-                        first_qubit_to_move = 0
-                        second_qubit_to_move = 0
-                        if pos1[1] > pos2[1]:
-                            first_qubit_to_move = q1
-                            second_qubit_to_move = q2
-                        else:
-                            first_qubit_to_move = q2
-                            second_qubit_to_move = q1
-                        first_qubit_to_move_pos = qubit_positions_rowcol[first_qubit_to_move]
-                        second_qubit_to_move_pos = qubit_positions_rowcol[second_qubit_to_move]
-
-                        #target_slm_rowcol = device.slm_traps[math.floor(len(device.slm_traps)/2)].get_position_xy()
-                        offset_col_from_second_to_first = first_qubit_to_move_pos[1] - second_qubit_to_move_pos[1]
-
-                        move1_instr = []
-                        for row in reversed(range(0, device.aod_rows)):
-                            move1_instr.append(MoveAODRow(row, aod_rows))
-                        for col in reversed(range(0, device.aod_cols)):
-                            move1_instr.append(MoveAODCol(col, aod_cols))
-                        
-                        move1_reversed_instr = reversed(move1_instr)
-                        move1_reversed_dirs_instr = list(map(reverseDir, move1_reversed_instr))
-                        
-                        compiled_instructions.extend(move1_instr)
-                        compiled_instructions.append(DeactivateAODCol(first_qubit_to_move_pos[1]))
-
-                        move2_instr = []
-                        for col in reversed(range(0, device.aod_cols)):
-                            move2_instr.append(MoveAODCol(col, offset_col_from_second_to_first - 0.2))
-                        
-                        move2_reversed_instr = reversed(move2_instr)
-                        move2_reversed_dirs_instr = list(map(reverseDir, move2_reversed_instr))
-
-                        compiled_instructions.extend(move2_instr)
-                        compiled_instructions.append(RydbergLaser((first_qubit_to_move_pos[1] + aod_rows,
-                                                                   first_qubit_to_move_pos[0] + aod_cols), oper.gate))
-                        compiled_instructions.extend(move2_reversed_dirs_instr)
-
-                        compiled_instructions.append(ActivateAODCol(first_qubit_to_move_pos[1]))
-                        compiled_instructions.extend(move1_reversed_dirs_instr)
-                        
-                elif pos1[1] == pos2[1]: #same col
-                    row_diff = pos2[1] - pos1[1]
-                    if abs(row_diff) == 1: #neighboring rows
-                        compiled_instructions.append(MoveAODRow(pos1[0], 0.8*row_diff))
-                        compiled_instructions.append(RydbergLaser((pos2[1], pos2[0]),
-                                                                   operation=oper.gate))
-                        compiled_instructions.append(MoveAODRow(pos1[0], -0.8*row_diff))
-                    else:
-                        # same col but not neighbors
-                        first_qubit_to_move = 0
-                        second_qubit_to_move = 0
-                        if pos1[0] > pos2[0]:
-                            first_qubit_to_move = q1
-                            second_qubit_to_move = q2
-                        else:
-                            first_qubit_to_move = q2
-                            second_qubit_to_move = q1
-                        first_qubit_to_move_pos = qubit_positions_rowcol[first_qubit_to_move]
-                        second_qubit_to_move_pos = qubit_positions_rowcol[second_qubit_to_move]
-
-                        #target_slm_rowcol = device.slm_traps[math.floor(len(device.slm_traps)/2)].get_position_xy()
-                        offset_row_from_second_to_first = first_qubit_to_move_pos[0] - second_qubit_to_move_pos[0]
-
-                        move1_instr = []
-                        for row in reversed(range(0, device.aod_rows)):
-                            move1_instr.append(MoveAODRow(row, aod_rows))
-                        for col in reversed(range(0, device.aod_cols)):
-                            move1_instr.append(MoveAODCol(col, aod_cols))
-                        
-                        move1_reversed_instr = reversed(move1_instr)
-                        move1_reversed_dirs_instr = list(map(reverseDir, move1_reversed_instr))
-                        
-                        compiled_instructions.extend(move1_instr)
-                        compiled_instructions.append(DeactivateAODRow(first_qubit_to_move_pos[0]))
-
-                        move2_instr = []
-                        for row in reversed(range(0, device.aod_rows)):
-                            move2_instr.append(MoveAODRow(row, offset_row_from_second_to_first - 0.2))
-                        
-                        move2_reversed_instr = reversed(move2_instr)
-                        move2_reversed_dirs_instr = list(map(reverseDir, move2_reversed_instr))
-
-                        compiled_instructions.extend(move2_instr)
-                        compiled_instructions.append(RydbergLaser((first_qubit_to_move_pos[1] + aod_rows,
-                                                                   first_qubit_to_move_pos[0] + aod_cols), oper.gate))
-                        compiled_instructions.extend(move2_reversed_dirs_instr)
-
-                        compiled_instructions.append(ActivateAODRow(first_qubit_to_move_pos[0]))
-                        compiled_instructions.extend(move1_reversed_dirs_instr)
+    # the instructions of a gate only depend on the positions of its qubits,
+    # which never change during a run. they are built once per position pair
+    # as (instructions before the pulse, pulse position, instructions after
+    # it, branch taken) and the same (immutable) instructions are spliced
+    # into the stream for every gate on that pair.
+    templates = {}
+
+    def gate_template(q1, q2):
+        (pos1, pos2) = (qubit_positions_rowcol[q1], qubit_positions_rowcol[q2])
+        template = templates.get((pos1, pos2))
+        if template is not None:
+            return template
+        start = time.perf_counter()
+        before = []
+        after = []
+        out = before
+        laser_pos = None
+        if pos1[0] == pos2[0]: #same row
+            col_diff = pos2[1] - pos1[1]
+            if abs(col_diff) == 1: #neighboring columns
+                branch = 'same_row_adjacent'
+                out.append(MoveAODCol(pos1[1], 0.8*col_diff))
+                laser_pos = (pos2[1], pos2[0])
+                out = after
+                out.append(MoveAODCol(pos1[1], -0.8*col_diff))
+            else:
+                # same row but not neighbors
+                branch = 'same_row'
+                first_qubit_to_move = 0
+                second_qubit_to_move = 0
+                if pos1[1] > pos2[1]:
+                    first_qubit_to_move = q1
+                    second_qubit_to_move = q2
                 else:
-                    # aod positions are not neighboring nor on the same row/col
-                    target_slm_rowcol = device.slm_traps[math.floor(len(device.slm_traps)/2)].get_position_xy()
-                    higher_row = max(pos1[0], pos2[0])
-                    first_qubit_to_move = 0
-                    second_qubit_to_move = 0
-                    if pos1[0] == higher_row:
-                        first_qubit_to_move = q1
-                        second_qubit_to_move = q2
-                    else:
-                        first_qubit_to_move = q2
-                        second_qubit_to_move = q1
-                    first_qubit_to_move_pos = qubit_positions_rowcol[first_qubit_to_move]
-                    offset_row_to_target = target_slm_rowcol[0] - higher_row
-                    move1_instr = []
-                    for upper_row in reversed(range(0, device.aod_rows)):
-                        move1_instr.append(MoveAODRow(upper_row, offset_row_to_target))
-
-                    offset_col_to_target = target_slm_rowcol[1] - first_qubit_to_move_pos[1]
-                    for upper_col in  reversed(range(0, device.aod_cols)):
-                        move1_instr.append(MoveAODCol(upper_col, offset_col_to_target))
-
-                    move1_reversed_instr = reversed(move1_instr)
-                    move1_reversed_dirs_instr = list(map(reverseDir, move1_reversed_instr))
-
-                    compiled_instructions.extend(move1_instr)
-                    compiled_instructions.append(DeactivateAODRow(higher_row))
-                    compiled_instructions.extend(move1_reversed_dirs_instr)
-
-                    second_qubit_to_move_pos = qubit_positions_rowcol[second_qubit_to_move]
-                    smaller_row = min(pos1[0], pos2[0])
-                    offset_row_to_target = target_slm_rowcol[0] - higher_row
-                    move2_instr = []
-                    for upper_row in reversed(range(0, device.aod_rows)):
-                        move2_instr.append(MoveAODRow(upper_row, offset_row_to_target))
-                    
-                    offset_col_to_target = target_slm_rowcol[1] - second_qubit_to_move_pos[1]
-                    for upper_col in reversed(range(0, device.aod_cols)):
-                        move2_instr.append(MoveAODCol(upper_col, offset_col_to_target))
-                    
-                    move2_instr.append(MoveAODRow(smaller_row, 0.8))
-                    
-                    move2_reversed_instr = reversed(move2_instr)
-                    move2_reversed_dirs_instr = list(map(reverseDir, move2_reversed_instr))
-
-                    compiled_instructions.extend(move2_instr)
-                    compiled_instructions.append(RydbergLaser(target_slm_rowcol,
-                                                              operation=oper.gate))
-                    compiled_instructions.extend(move2_reversed_dirs_instr)
-                    compiled_instructions.extend(move1_instr)
-                    compiled_instructions.append(ActivateAODRow(higher_row))
-                    compiled_instructions.extend(move1_reversed_dirs_instr)
+                    first_qubit_to_move = q2
+                    second_qubit_to_move = q1
+                first_qubit_to_move_pos = qubit_positions_rowcol[first_qubit_to_move]
+                second_qubit_to_move_pos = qubit_positions_rowcol[second_qubit_to_move]
+
+                #target_slm_rowcol = device.slm_traps[math.floor(len(device.slm_traps)/2)].get_position_xy()
+                offset_col_from_second_to_first = first_qubit_to_move_pos[1] - second_qubit_to_move_pos[1]
+
+                move1_instr = []
+                for row in reversed(range(0, device.aod_rows)):
+                    move1_instr.append(MoveAODRow(row, aod_rows))
+                for col in reversed(range(0, device.aod_cols)):
+                    move1_instr.append(MoveAODCol(col, aod_cols))
+                
+                move1_reversed_instr = reversed(move1_instr)
+                move1_reversed_dirs_instr = list(map(reverseDir, move1_reversed_instr))
+                
+                out.extend(move1_instr)
+                out.append(DeactivateAODCol(first_qubit_to_move_pos[1]))
 
-    return (device, compiled_instructions)
+                move2_instr = []
+                for col in reversed(range(0, device.aod_cols)):
+                    move2_instr.append(MoveAODCol(col, offset_col_from_second_to_first - 0.2))
+                
+                move2_reversed_instr = reversed(move2_instr)
+                move2_reversed_dirs_instr = list(map(reverseDir, move2_reversed_instr))
+
+                out.extend(move2_instr)
+                laser_pos = (first_qubit_to_move_pos[1] + aod_rows, first_qubit_to_move_pos[0] + aod_cols)
+                out = after
+                out.extend(move2_reversed_dirs_instr)
+
+                out.append(ActivateAODCol(first_qubit_to_move_pos[1]))
+                out.extend(move1_reversed_dirs_instr)
+                
+        elif pos1[1] == pos2[1]: #same col
+            row_diff = pos2[1] - pos1[1]
+            if abs(row_diff) == 1: #neighboring rows
+                branch = 'same_col_adjacent'
+                out.append(MoveAODRow(pos1[0], 0.8*row_diff))
+                laser_pos = (pos2[1], pos2[0])
+                out = after
+                out.append(MoveAODRow(pos1[0], -0.8*row_diff))
+            else:
+                # same col but not neighbors
+                branch = 'same_col'
+                first_qubit_to_move = 0
+                second_qubit_to_move = 0
+                if pos1[0] > pos2[0]:
+                    first_qubit_to_move = q1
+                    second_qubit_to_move = q2
+                else:
+                    first_qubit_to_move = q2
+                    second_qubit_to_move = q1
+                first_qubit_to_move_pos = qubit_positions_rowcol[first_qubit_to_move]
+                second_qubit_to_move_pos = qubit_positions_rowcol[second_qubit_to_move]
+
+                #target_slm_rowcol = device.slm_traps[math.floor(len(device.slm_traps)/2)].get_position_xy()
+                offset_row_from_second_to_first = first_qubit_to_move_pos[0] - second_qubit_to_move_pos[0]
+
+                move1_instr = []
+                for row in reversed(range(0, device.aod_rows)):
+                    move1_instr.append(MoveAODRow(row, aod_rows))
+                for col in reversed(range(0, device.aod_cols)):
+                    move1_instr.append(MoveAODCol(col, aod_cols))
+                
+                move1_reversed_instr = reversed(move1_instr)
+                move1_reversed_dirs_instr = list(map(reverseDir, move1_reversed_instr))
+                
+                out.extend(move1_instr)
+                out.append(DeactivateAODRow(first_qubit_to_move_pos[0]))
+
+                move2_instr = []
+                for row in reversed(range(0, device.aod_rows)):
+                    move2_instr.append(MoveAODRow(row, offset_row_from_second_to_first - 0.2))
+                
+                move2_reversed_instr = reversed(move2_instr)
+                move2_reversed_dirs_instr = list(map(reverseDir, move2_reversed_instr))
 
+                out.extend(move2_instr)
+                laser_pos = (first_qubit_to_move_pos[1] + aod_rows, first_qubit_to_move_pos[0] + aod_cols)
+                out = after
+                out.extend(move2_reversed_dirs_instr)
+
+                out.append(ActivateAODRow(first_qubit_to_move_pos[0]))
+                out.extend(move1_reversed_dirs_instr)
+        else:
+            # aod positions are not neighboring nor on the same row/col
+            branch = 'general'
+            target_slm_rowcol = device.slm_traps[math.floor(len(device.slm_traps)/2)].get_position_xy()
+            higher_row = max(pos1[0], pos2[0])
+            first_qubit_to_move = 0
+            second_qubit_to_move = 0
+            if pos1[0] == higher_row:
+                first_qubit_to_move = q1
+                second_qubit_to_move = q2
+            else:
+                first_qubit_to_move = q2
+                second_qubit_to_move = q1
+            first_qubit_to_move_pos = qubit_positions_rowcol[first_qubit_to_move]
+            offset_row_to_target = target_slm_rowcol[0] - higher_row
+            move1_instr = []
+            for upper_row in reversed(range(0, device.aod_rows)):
+                move1_instr.append(MoveAODRow(upper_row, offset_row_to_target))
+
+            offset_col_to_target = target_slm_rowcol[1] - first_qubit_to_move_pos[1]
+            for upper_col in  reversed(range(0, device.aod_cols)):
+                move1_instr.append(MoveAODCol(upper_col, offset_col_to_target))
+
+            move1_reversed_instr = reversed(move1_instr)
+            move1_reversed_dirs_instr = list(map(reverseDir, move1_reversed_instr))
+
+            out.extend(move1_instr)
+            out.append(DeactivateAODRow(higher_row))
+            out.extend(move1_reversed_dirs_instr)
+
+            second_qubit_to_move_pos = qubit_positions_rowcol[second_qubit_to_move]
+            smaller_row = min(pos1[0], pos2[0])
+            offset_row_to_target = target_slm_rowcol[0] - higher_row
+            move2_instr = []
+            for upper_row in reversed(range(0, device.aod_rows)):
+                move2_instr.append(MoveAODRow(upper_row, offset_row_to_target))
+            
+            offset_col_to_target = target_slm_rowcol[1] - second_qubit_to_move_pos[1]
+            for upper_col in reversed(range(0, device.aod_cols)):
+                move2_instr.append(MoveAODCol(upper_col, offset_col_to_target))
+            
+            move2_instr.append(MoveAODRow(smaller_row, 0.8))
+            
+            move2_reversed_instr = reversed(move2_instr)
+            move2_reversed_dirs_instr = list(map(reverseDir, move2_reversed_instr))
+
+            out.extend(move2_instr)
+            laser_pos = target_slm_rowcol
+            out = after
+            out.extend(move2_reversed_dirs_instr)
+            out.extend(move1_instr)
+            out.append(ActivateAODRow(higher_row))
+            out.extend(move1_reversed_dirs_instr)
+        template = (before, laser_pos, after, branch)
+        templates[(pos1, pos2)] = template
+        if listener is not None:
+            listener.phase('compile', 'gate_template', start, time.perf_counter() - start)
+        return template
+
+    def instructions():
+        yield from compiled_instructions
+        for moment in circuit:
+            for oper in moment.operations:
+                if len(oper.qubits) == 2:
+                    q1 = oper.qubits[0].x
+                    q2 = oper.qubits[1].x
+                    before, laser_pos, after, branch = gate_template(q1, q2)
+                    if listener is not None:
+                        listener.gate_compiled('compile', branch)
+                    yield from before
+                    yield RydbergLaser(laser_pos, operation=oper.gate)
+                    yield from after
+
+    stream = instructions()
+    # collective_moves: every run of line moves becomes one instruction per axis
+    if collective_moves:
+        stream = collected_moves(stream)
+    return (device, stream)
+
+
+def compile_smt(circuit: 'cirq.Circuit', window=2, time_budget=1.0, **compile_kwargs):
+    # compile_overlapping_traps with the gates of every window moments
+    # scheduled into the fewest stages by z3, time_budget seconds per window.
+    # a window that runs out of time (or a missing z3) gets the greedy
+    # parallel schedule.
+    return compile_overlapping_traps(circuit, smt_window=window, smt_time_budget=time_budget, **compile_kwargs)
+
+def compile_overlapping_traps(circuit: 'cirq.Circuit', optimize=False, stateful=False, parallel=False, placement=None,
+                              collective_moves=False, smt_window=0, smt_time_budget=1.0, listener=None):
+    # listener: as in compile
+    start = time.perf_counter()
+    device, stream = compile_overlapping_traps_stream(circuit, stateful=stateful, parallel=parallel, placement=placement,
+                                                      smt_window=smt_window, smt_time_budget=smt_time_budget,
+                                                      listener=listener)
+    compiled_instructions = list(stream)
+    compiled_instructions = _finish(device, compiled_instructions, optimize, collective_moves, listener)
+    if listener is not None:
+        listener.phase('compile', 'compile_overlapping_traps', start, time.perf_counter() - start)
+    return (device, compiled_instructions)
 
-def compile_overlapping_traps(circuit: cirq.Circuit):
+def compile_overlapping_traps_stream(circuit: 'cirq.Circuit', stateful=False, parallel=False, placement=None,
+                                     collective_moves=False, smt_window=0, smt_time_budget=1.0, listener=None):
+    # (device, iterator over the instructions of compile_overlapping_traps),
+    # generated moment by moment (window by window with smt_window) while
+    # the iterator is consumed. optimize needs the whole stream and is not
+    # offered.
+    setup_start = time.perf_counter()
     nof_qubits = len(circuit.all_qubits())
 
     aod_rows = math.ceil(math.sqrt(nof_qubits))
@@ -247,13 +439,30 @@ def compile_overlapping_traps(circuit: cirq.Circuit):
         row = math.floor(i / device.aod_rows)
         col = i % device.aod_cols
         qubit_positions_rowcol.append((row,col))
+    # placement: (row, col) of every qubit, e.g. from anneal_placement
+    if placement is not None:
+        assert(len(placement) == nof_qubits)
+        qubit_positions_rowcol = [tuple(pos) for pos in placement]
 
     init = Initialize(aod_qubits=[],
                aod_qubit_positions_rowcol=[],
-               slm_qubits=cirq.LineQubit.range(nof_qubits),
-               slm_trap_indices=range(nof_qubits))
+               slm_qubits=line_qubits(nof_qubits),
+               slm_trap_indices=[row*slm_rows + col for (row, col) in qubit_positions_rowcol])
     compiled_instructions.append(init)
 
+    if stateful:
+        assert(not parallel and smt_window == 0), "stateful routing does not schedule parallel stages"
+
+    # parallel: the gates of a moment are grouped into stages of gates that
+    # move together, each stage gets one pulse
+    scheduler = None
+    if smt_window > 0:
+        scheduler = SMTScheduler(device, compiled_instructions, smt_time_budget)
+    elif parallel:
+        scheduler = MomentScheduler(device, compiled_instructions)
+    if listener is not None:
+        listener.phase('compile', 'setup', setup_start, time.perf_counter() - setup_start)
+
     def reverseInstruction(instr):
         if isinstance(instr, MoveAODCol):
             return MoveAODCol(instr.col_index, -instr.offset)
@@ -275,65 +484,155 @@ def compile_overlapping_traps(circuit: cirq.Circuit):
         else:
             return -1
 
-    for moment in circuit:
-        for oper in moment.operations:
-            if len(oper.qubits) == 2:
-                q1 = oper.qubits[0].x
-                q2 = oper.qubits[1].x
-                (pos1, pos2) = (qubit_positions_rowcol[q1], qubit_positions_rowcol[q2])
- 
-                row_diff = pos2[0] - pos1[0]
-                col_diff = pos2[1] - pos1[1]
-
-                row_diff_sign = sign(row_diff)
-                col_diff_sign = sign(col_diff)
-
-                row_offset = row_diff_sign*0.2
-                col_offset = col_diff_sign*0.2
-                if pos1[0] == pos2[0]:
-                    row_offset = 0
-                if pos1[1] == pos2[1]:
-                    col_offset = 0
-
-                move_instr = []
-
-                for row in range(pos1[0], pos2[0], row_diff_sign):
-                    move_instr.append(ActivateAODRow(row))
-                
-                for col in range(pos1[1], pos2[1], col_diff_sign):
-                    move_instr.append(ActivateAODCol(col))
-
-                counter = 0
-                for row in reversed(range(pos1[0], pos2[0] + row_diff_sign, row_diff_sign)):
-                    this_row_diff = pos2[0] - row
-                    if row != pos1[0]:
-                        offset = this_row_diff + row_diff_sign*(0.99 - counter*0.01)
-                        if offset != 0:
-                            move_instr.append(MoveAODRow(row, offset))
-                    else:
-                        offset = row_diff - row_offset
-                        if offset != 0:
-                            move_instr.append(MoveAODRow(row, offset))
-                    counter += 1
-                
-                counter = 0
-                for col in reversed(range(pos1[1], pos2[1] + col_diff_sign, col_diff_sign)):
-                    this_col_diff = pos2[1] - col
-                    if col != pos1[1]:
-                        offset = this_col_diff + col_diff_sign*(0.99 - counter*0.01)
-                        if offset != 0:
-                            move_instr.append(MoveAODCol(col, offset))
+    def emit(move_instr, laser, reversed_instructions):
+        compiled_instructions.extend(move_instr)
+        compiled_instructions.append(laser)
+        compiled_instructions.extend(reversed_instructions)
+
+    # the forward and reverse moves of a gate only depend on the positions of
+    # its qubits, which never change during a run. they are built once per
+    # position pair (with the branch taken) and the same (immutable)
+    # instructions are spliced into the stream for every gate on that pair.
+    templates = {}
+
+    def gate_template(pos1, pos2):
+        template = templates.get((pos1, pos2))
+        if template is not None:
+            return template
+        start = time.perf_counter()
+        if pos1[0] == pos2[0]:
+            branch = 'same_row'
+        elif pos1[1] == pos2[1]:
+            branch = 'same_col'
+        else:
+            branch = 'general'
+
+        row_diff = pos2[0] - pos1[0]
+        col_diff = pos2[1] - pos1[1]
+
+        row_diff_sign = sign(row_diff)
+        col_diff_sign = sign(col_diff)
+
+        row_offset = row_diff_sign*0.2
+        col_offset = col_diff_sign*0.2
+        if pos1[0] == pos2[0]:
+            row_offset = 0
+        if pos1[1] == pos2[1]:
+            col_offset = 0
+
+        move_instr = []
+
+        for row in range(pos1[0], pos2[0], row_diff_sign):
+            move_instr.append(ActivateAODRow(row))
+
+        for col in range(pos1[1], pos2[1], col_diff_sign):
+            move_instr.append(ActivateAODCol(col))
+
+        counter = 0
+        for row in reversed(range(pos1[0], pos2[0] + row_diff_sign, row_diff_sign)):
+            this_row_diff = pos2[0] - row
+            if row != pos1[0]:
+                offset = this_row_diff + row_diff_sign*(0.99 - counter*0.01)
+                if offset != 0:
+                    move_instr.append(MoveAODRow(row, offset))
+            else:
+                offset = row_diff - row_offset
+                if offset != 0:
+                    move_instr.append(MoveAODRow(row, offset))
+            counter += 1
+
+        counter = 0
+        for col in reversed(range(pos1[1], pos2[1] + col_diff_sign, col_diff_sign)):
+            this_col_diff = pos2[1] - col
+            if col != pos1[1]:
+                offset = this_col_diff + col_diff_sign*(0.99 - counter*0.01)
+                if offset != 0:
+                    move_instr.append(MoveAODCol(col, offset))
+            else:
+                offset = col_diff - col_offset
+                if offset != 0:
+                    move_instr.append(MoveAODCol(col, offset))
+            counter += 1
+
+        reversed_instructions = list(map(reverseInstruction, reversed(move_instr)))
+        template = (move_instr, reversed_instructions, branch)
+        templates[(pos1, pos2)] = template
+        if listener is not None:
+            listener.phase('compile', 'gate_template', start, time.perf_counter() - start)
+        return template
+
+    def stateless_route(slm_index1, slm_index2, operation):
+        # the gate between the qubits in two slm traps, with every line home
+        pos1, pos2 = divmod(slm_index1, slm_rows), divmod(slm_index2, slm_rows)
+        move_instr, reversed_instructions, _ = gate_template(pos1, pos2)
+        return move_instr + [RydbergLaser((pos2[1], pos2[0]), operation=operation)] + reversed_instructions
+
+    # stateful: the qubits move between slm traps as the gates need them and
+    # every gate is routed from where its qubits are instead of from the home
+    # positions. the router moves one qubit per gate, so it does not combine
+    # with the schedulers.
+    router = None
+    if stateful:
+        router = StatefulRouter(device, compiled_instructions, stateless_route)
+
+    def drained():
+        # what was emitted since the last call. the router and the schedulers
+        # hold on to compiled_instructions, so it is emptied in place.
+        chunk = compiled_instructions[:]
+        del compiled_instructions[:]
+        return chunk
+
+    def instructions():
+        yield from drained()
+        window = []
+        for moment_index, moment in enumerate(circuit):
+            blocks = []
+            for oper in moment.operations:
+                if len(oper.qubits) == 2 and router is not None:
+                    start = time.perf_counter()
+                    router.route_gate(oper.qubits[0].x, oper.qubits[1].x, oper.gate)
+                    if listener is not None:
+                        listener.phase('compile', 'route', start, time.perf_counter() - start)
+                        listener.gate_compiled('compile_overlapping_traps', 'stateful')
+                elif len(oper.qubits) == 2:
+                    q1 = oper.qubits[0].x
+                    q2 = oper.qubits[1].x
+                    (pos1, pos2) = (qubit_positions_rowcol[q1], qubit_positions_rowcol[q2])
+                    move_instr, reversed_instructions, branch = gate_template(pos1, pos2)
+                    if listener is not None:
+                        listener.gate_compiled('compile_overlapping_traps', branch)
+                    laser = RydbergLaser((pos2[1], pos2[0]),
+                                         operation=oper.gate)
+                    if scheduler is not None:
+                        blocks.append(GateBlock(move_instr, laser, reversed_instructions, (q1, q2)))
                     else:
-                        offset = col_diff - col_offset
-                        if offset != 0:
-                            move_instr.append(MoveAODCol(col, offset))
-                    counter += 1
-                
-                reversed_instructions = list(map(reverseInstruction, reversed(move_instr)))
-                compiled_instructions.extend(move_instr)
-                compiled_instructions.append(RydbergLaser((pos2[1], pos2[0]),
-                                                operation=oper.gate))
-                compiled_instructions.extend(reversed_instructions)
-                    
-
-    return (device, compiled_instructions)
\ No newline at end of file
+                        emit(move_instr, laser, reversed_instructions)
+
+            if smt_window > 0:
+                window.append(blocks)
+                if len(window) == smt_window or moment_index == len(circuit) - 1:
+                    start = time.perf_counter()
+                    stages = scheduler.schedule_window(window)
+                    if listener is not None:
+                        listener.phase('compile', 'schedule', start, time.perf_counter() - start)
+                    for stage in stages:
+                        emit(*stage_instructions(stage))
+                    window = []
+            elif scheduler is not None:
+                start = time.perf_counter()
+                stages = scheduler.schedule(blocks)
+                if listener is not None:
+                    listener.phase('compile', 'schedule', start, time.perf_counter() - start)
+                for stage in stages:
+                    emit(*stage_instructions(stage))
+            yield from drained()
+
+        if router is not None:
+            router.finish()
+        yield from drained()
+
+    stream = instructions()
+    # collective_moves: every run of line moves becomes one instruction per axis
+    if collective_moves:
+        stream = collected_moves(stream)
+    return (device, stream)
\ No newline at end of file
@@ -1,39 +1,56 @@
 class Instruction:
+    __slots__ = ()
     def __str__(self):
         return "description of the instruction"
 
 class ActivateAODRow(Instruction):
+    __slots__ = ('row_index',)
     def __init__(self, row_index):
         self.row_index = row_index
     def __str__(self):
         return f"activate row {self.row_index}"
 
 class ActivateAODCol(Instruction):
+    __slots__ = ('col_index',)
     def __init__(self, col_index):
         self.col_index = col_index
     def __str__(self):
         return f"activate col {self.col_index}"
 
 class DeactivateAODRow(Instruction):
+    __slots__ = ('row_index',)
     def __init__(self, row_index):
         self.row_index = row_index
     def __str__(self):
         return f"deactivate row {self.row_index}"
 
 class DeactivateAODCol(Instruction):
+    __slots__ = ('col_index',)
     def __init__(self, col_index):
         self.col_index = col_index
     def __str__(self):
         return f"deactivate col {self.col_index}"
 
 class RydbergLaser(Instruction):
+    __slots__ = ('target_pos', 'operation')
     def __init__(self, target_pos_xy, operation):
         self.target_pos = target_pos_xy
         self.operation = operation
     def __str__(self):
         return f"operation {self.operation} at pos {self.target_pos}"
 
+class RydbergPulse(Instruction):
+    # one global pulse over several sites, e.g. every gate of a parallel stage
+    __slots__ = ('target_positions', 'operations')
+    def __init__(self, target_positions_xy, operations):
+        assert(len(list(target_positions_xy)) == len(list(operations)))
+        self.target_positions = target_positions_xy
+        self.operations = operations
+    def __str__(self):
+        return f"operations {self.operations} at pos {self.target_positions}"
+
 class MoveAODRow(Instruction):
+    __slots__ = ('row_index', 'offset')
     def __init__(self, row_index, offset):
         self.row_index = row_index
         self.offset = offset
@@ -41,13 +58,34 @@ class MoveAODRow(Instruction):
         return f"move row {self.row_index} by {self.offset}"
 
 class MoveAODCol(Instruction):
+    __slots__ = ('col_index', 'offset')
     def __init__(self, col_index, offset):
         self.col_index = col_index
         self.offset = offset
     def __str__(self):
         return f"move col {self.col_index} by {self.offset}"
 
+class MoveAODRows(Instruction):
+    # moves every listed row by its own offset in one step
+    __slots__ = ('row_indices', 'offsets')
+    def __init__(self, row_indices, offsets):
+        assert(len(list(row_indices)) == len(list(offsets)))
+        self.row_indices = row_indices
+        self.offsets = offsets
+    def __str__(self):
+        return f"move rows {list(self.row_indices)} by {list(self.offsets)}"
+
+class MoveAODCols(Instruction):
+    __slots__ = ('col_indices', 'offsets')
+    def __init__(self, col_indices, offsets):
+        assert(len(list(col_indices)) == len(list(offsets)))
+        self.col_indices = col_indices
+        self.offsets = offsets
+    def __str__(self):
+        return f"move cols {list(self.col_indices)} by {list(self.offsets)}"
+
 class Initialize(Instruction):
+    __slots__ = ('aod_qubits', 'aod_qubit_positions_rowcol', 'slm_qubits', 'slm_trap_indices')
     def __init__(self, aod_qubits, aod_qubit_positions_rowcol, slm_qubits, slm_trap_indices):
         assert(len(list(aod_qubits)) == len(list(aod_qubit_positions_rowcol)))
         assert(len(list(slm_qubits)) == len(list(slm_trap_indices)))
@@ -59,4 +97,4 @@ class Initialize(Instruction):
         return f"initialize qubits on traps"
 
 class DrawState(Instruction):
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
@@ -0,0 +1,198 @@
+import numpy as np
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows
+
+# offsets smaller than this are treated as no-op moves
+MOVE_EPSILON = 1e-12
+
+
+def move_line(inst):
+    # (axis, line index) of a move instruction, None for anything else
+    inst_type = type(inst)
+    if inst_type is MoveAODRow:
+        return ('row', inst.row_index)
+    if inst_type is MoveAODCol:
+        return ('col', inst.col_index)
+    return None
+
+
+def transfer_line(inst):
+    # (axis, line index, activates) of an activate/deactivate instruction
+    inst_type = type(inst)
+    if inst_type is ActivateAODRow:
+        return ('row', inst.row_index, True)
+    if inst_type is ActivateAODCol:
+        return ('col', inst.col_index, True)
+    if inst_type is DeactivateAODRow:
+        return ('row', inst.row_index, False)
+    if inst_type is DeactivateAODCol:
+        return ('col', inst.col_index, False)
+    return None
+
+
+def make_move(line, offset):
+    axis, index = line
+    if axis == 'row':
+        return MoveAODRow(index, offset)
+    return MoveAODCol(index, offset)
+
+
+def moves_commute(line1, line2):
+    # a move only checks the ordering against the neighbouring lines of the
+    # same axis, so moves of the other axis or of lines at least two apart
+    # can be swapped without changing any check
+    return line1[0] != line2[0] or abs(line1[1] - line2[1]) >= 2
+
+
+def fuse_moves(instructions, max_scan=64):
+    # single pass over the stream. every move is merged into the latest move of
+    # the same line if only commuting moves lie in between; merged moves that
+    # add up to nothing disappear, which lets whole "move, reverse move"
+    # sequences collapse one line at a time.
+    output = []
+    for inst in instructions:
+        line = move_line(inst)
+        if line is None:
+            output.append(inst)
+            continue
+        if abs(inst.offset) < MOVE_EPSILON:
+            continue
+        fused = False
+        for j in range(len(output) - 1, max(-1, len(output) - 1 - max_scan), -1):
+            other_line = move_line(output[j])
+            if other_line is None:
+                break
+            if other_line == line:
+                offset = output[j].offset + inst.offset
+                if abs(offset) < MOVE_EPSILON:
+                    del output[j]
+                else:
+                    output[j] = make_move(line, offset)
+                fused = True
+                break
+            if not moves_commute(line, other_line):
+                break
+        if not fused:
+            output.append(inst)
+    return output
+
+
+def cancel_transfer_runs(device, instructions):
+    # drops activate/deactivate instructions that leave the trap occupancy
+    # unchanged. whether they cancel depends on where the qubits are, so the
+    # stream is replayed on a copy of the (not yet executed) device and every
+    # candidate is checked against the actual state. a whole run of transfers
+    # between two moves (e.g. deactivating every line of one gate and
+    # activating the same lines for the next one) is tried first, then
+    # adjacent activate/deactivate pairs of one line inside the run.
+    scratch = device.copy()
+    state = scratch.state
+    output = []
+    i = 0
+    nof_instructions = len(instructions)
+    while i < nof_instructions:
+        if transfer_line(instructions[i]) is None:
+            execute_headless(scratch, instructions[i])
+            output.append(instructions[i])
+            i += 1
+            continue
+        run_end = i
+        while run_end < nof_instructions and transfer_line(instructions[run_end]) is not None:
+            run_end += 1
+        run = instructions[i:run_end]
+        i = run_end
+
+        aod_qubit_ids = state.aod_qubit_ids.copy()
+        slm_qubit_ids = state.slm_qubit_ids.copy()
+        for inst in run:
+            execute_headless(scratch, inst)
+        if occupancy_unchanged(state, aod_qubit_ids, slm_qubit_ids):
+            continue
+        state.aod_qubit_ids[...] = aod_qubit_ids
+        state.slm_qubit_ids[...] = slm_qubit_ids
+
+        k = 0
+        while k < len(run):
+            if k + 1 < len(run):
+                first = transfer_line(run[k])
+                second = transfer_line(run[k + 1])
+                if first[:2] == second[:2] and first[2] != second[2]:
+                    aod_qubit_ids = state.aod_qubit_ids.copy()
+                    slm_qubit_ids = state.slm_qubit_ids.copy()
+                    execute_headless(scratch, run[k])
+                    execute_headless(scratch, run[k + 1])
+                    if not occupancy_unchanged(state, aod_qubit_ids, slm_qubit_ids):
+                        output.append(run[k])
+                        output.append(run[k + 1])
+                    k += 2
+                    continue
+            execute_headless(scratch, run[k])
+            output.append(run[k])
+            k += 1
+    return output
+
+
+def occupancy_unchanged(state, aod_qubit_ids, slm_qubit_ids):
+    return (np.array_equal(aod_qubit_ids, state.aod_qubit_ids)
+            and np.array_equal(slm_qubit_ids, state.slm_qubit_ids))
+
+
+def execute_headless(device, inst):
+    handler = device.handler_for(type(inst), headless=True)
+    if handler is not None:
+        handler(device, inst)
+
+
+def optimize_instructions(device, instructions, max_passes=None):
+    # peephole optimization of a compiled stream: no-op moves are dropped,
+    # consecutive moves of a line are fused, inverse moves cancel and
+    # activates/deactivates that do not change any trap occupancy cancel.
+    # device must be the device the stream was compiled for, before executing
+    # anything on it. passes repeat until nothing changes, as every removed
+    # pair can expose a new one.
+    instructions = list(instructions)
+    nof_passes = 0
+    while max_passes is None or nof_passes < max_passes:
+        nof_passes += 1
+        nof_before = len(instructions)
+        instructions = fuse_moves(instructions)
+        instructions = cancel_transfer_runs(device, instructions)
+        if len(instructions) == nof_before:
+            break
+    return instructions
+
+
+def collect_moves(instructions):
+    # replaces every run of consecutive single line moves by at most one
+    # MoveAODRows and one MoveAODCols. a run that passes the ordering checks
+    # line by line starts and ends with strictly ordered lines, so moving all
+    # of its lines at once to the same end positions passes them as well.
+    return list(collected_moves(instructions))
+
+
+def collected_moves(instructions):
+    # collect_moves as a generator, for instruction streams of any length
+    rows = {}
+    cols = {}
+
+    def flush():
+        output = []
+        for lines, single, collective in ((rows, MoveAODRow, MoveAODRows), (cols, MoveAODCol, MoveAODCols)):
+            moved = sorted(line for line in lines if abs(lines[line]) >= MOVE_EPSILON)
+            if len(moved) == 1:
+                output.append(single(moved[0], lines[moved[0]]))
+            elif len(moved) > 1:
+                output.append(collective(moved, [lines[line] for line in moved]))
+            lines.clear()
+        return output
+
+    for inst in instructions:
+        line = move_line(inst)
+        if line is None:
+            yield from flush()
+            yield inst
+        elif line[0] == 'row':
+            rows[line[1]] = rows.get(line[1], 0) + inst.offset
+        else:
+            cols[line[1]] = cols.get(line[1], 0) + inst.offset
+    yield from flush()
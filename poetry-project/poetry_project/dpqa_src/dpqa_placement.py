@@ -0,0 +1,120 @@
+import math
+import random
+import time
+
+
+def grid_shape(nof_qubits):
+    # the aod grid both compilers build for nof_qubits qubits
+    side = math.ceil(math.sqrt(nof_qubits))
+    return (side, side)
+
+
+def default_placement(nof_qubits, rows, cols):
+    # qubit i at (i // rows, i % cols), the placement the compilers use by default
+    return [(math.floor(i / rows), i % cols) for i in range(nof_qubits)]
+
+
+def interaction_graph(circuit):
+    # {(qubit a, qubit b): number of two qubit gates between them}, a < b,
+    # qubits as their LineQubit indices
+    weights = {}
+    for moment in circuit:
+        for oper in moment.operations:
+            if len(oper.qubits) == 2:
+                a, b = sorted((oper.qubits[0].x, oper.qubits[1].x))
+                weights[(a, b)] = weights.get((a, b), 0) + 1
+    return weights
+
+
+def placement_cost(weights, placement):
+    # weighted manhattan distance of all interacting pairs
+    cost = 0
+    for (a, b), weight in weights.items():
+        (r1, c1), (r2, c2) = placement[a], placement[b]
+        cost += weight * (abs(r1 - r2) + abs(c1 - c2))
+    return cost
+
+
+def anneal_placement(circuit, rows=None, cols=None, time_budget=1.0, seed=0, initial_placement=None):
+    # simulated annealing over qubit -> grid site assignments, minimizing the
+    # weighted manhattan distance of the interaction graph. a move swaps the
+    # contents of two sites (a qubit or nothing). starts from the default
+    # placement (or initial_placement) and returns the best placement found
+    # within time_budget seconds, so the result is never worse than the start.
+    nof_qubits = len(circuit.all_qubits())
+    if rows is None or cols is None:
+        rows, cols = grid_shape(nof_qubits)
+    assert(nof_qubits <= rows * cols)
+    if initial_placement is None:
+        initial_placement = default_placement(nof_qubits, rows, cols)
+    placement = list(initial_placement)
+    assert(len(placement) == nof_qubits)
+
+    weights = interaction_graph(circuit)
+    neighbours = [[] for _ in range(nof_qubits)]
+    for (a, b), weight in weights.items():
+        neighbours[a].append((b, weight))
+        neighbours[b].append((a, weight))
+
+    # site -> qubit, None for an empty site
+    occupant = {(r, c): None for r in range(rows) for c in range(cols)}
+    for qubit, site in enumerate(placement):
+        assert(occupant[site] is None), "two qubits on the same site"
+        occupant[site] = qubit
+    sites = list(occupant)
+
+    cost = placement_cost(weights, placement)
+    best_cost = cost
+    best_placement = list(placement)
+    if not weights or len(sites) < 2:
+        return best_placement
+
+    def moved_cost(qubit, old_site, new_site, other):
+        # change of the qubit's edge costs when it moves from old_site to new_site
+        delta = 0
+        for neighbour, weight in neighbours[qubit]:
+            if neighbour == other:
+                continue
+            r, c = placement[neighbour]
+            delta += weight * (abs(new_site[0] - r) + abs(new_site[1] - c)
+                               - abs(old_site[0] - r) - abs(old_site[1] - c))
+        return delta
+
+    rng = random.Random(seed)
+    start_temperature = max(1.0, sum(weights.values()) / len(weights))
+    end_temperature = 1e-3
+    start = time.perf_counter()
+    temperature = start_temperature
+    iteration = 0
+    while True:
+        if iteration % 256 == 0:
+            elapsed_fraction = (time.perf_counter() - start) / time_budget if time_budget > 0 else 1.0
+            if elapsed_fraction >= 1.0:
+                break
+            temperature = start_temperature * (end_temperature / start_temperature) ** elapsed_fraction
+        iteration += 1
+
+        site1, site2 = rng.sample(sites, 2)
+        qubit1 = occupant[site1]
+        qubit2 = occupant[site2]
+        if qubit1 is None and qubit2 is None:
+            continue
+        delta = 0
+        if qubit1 is not None:
+            delta += moved_cost(qubit1, site1, site2, qubit2)
+        if qubit2 is not None:
+            delta += moved_cost(qubit2, site2, site1, qubit1)
+        if delta > 0 and rng.random() >= math.exp(-delta / temperature):
+            continue
+
+        occupant[site1] = qubit2
+        occupant[site2] = qubit1
+        if qubit1 is not None:
+            placement[qubit1] = site2
+        if qubit2 is not None:
+            placement[qubit2] = site1
+        cost += delta
+        if cost < best_cost:
+            best_cost = cost
+            best_placement = list(placement)
+    return best_placement
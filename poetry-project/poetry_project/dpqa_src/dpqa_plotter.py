@@ -73,6 +73,15 @@ def show_current_state(dpqa_dev, draw_movement_lines=True, indx=0):
                             alpha=0.6)
         ax.add_patch(circle)
     dpqa_dev.previous_rydberg_laser_pos = (-1, -1)
+
+    for laser_pos in dpqa_dev.previous_rydberg_pulse_positions:
+        circle = plt.Circle(xy=(laser_pos),
+                            radius=dpqa_dev.rydberg_radius + 0.1,
+                            color='green',
+                            fill=False,
+                            alpha=0.6)
+        ax.add_patch(circle)
+    dpqa_dev.previous_rydberg_pulse_positions = []
         
 
     #ax.scatter(x_slm_occupied, y_slm_occupied, s=sizes_slm_occupied, color = color_slm_occupied)
@@ -0,0 +1,168 @@
+import json
+import os
+import time
+
+
+class Listener:
+    # callbacks of the compilers (listener=...) and of headless execution
+    # (execute_instructions(..., listener=...)). every callback does nothing
+    # here, a listener overrides the ones it wants. start is a
+    # time.perf_counter() value.
+    def phase(self, category, name, start, seconds):
+        # a timed part of a compile ('compile', e.g. 'gate_template') or of an
+        # execution ('execute')
+        pass
+
+    def gate_compiled(self, compiler, branch):
+        # a two qubit gate compiled by compiler ('compile' or
+        # 'compile_overlapping_traps') through branch, e.g. 'same_row'
+        pass
+
+    def instruction_executed(self, opcode, start, seconds):
+        # opcode is the name of the instruction class
+        pass
+
+    def aod_moved(self, distance):
+        # aod lines moved by distance in total (the sum over the lines)
+        pass
+
+    def qubits_transferred(self, picked_up, dropped):
+        # qubits that went from slm to aod traps and back in one instruction
+        pass
+
+    def pulsed(self, nof_sites):
+        # a rydberg pulse on nof_sites laser positions
+        pass
+
+
+class Listeners(Listener):
+    # passes every callback on to several listeners
+    def __init__(self, *listeners):
+        self.listeners = listeners
+
+    def phase(self, category, name, start, seconds):
+        for listener in self.listeners:
+            listener.phase(category, name, start, seconds)
+
+    def gate_compiled(self, compiler, branch):
+        for listener in self.listeners:
+            listener.gate_compiled(compiler, branch)
+
+    def instruction_executed(self, opcode, start, seconds):
+        for listener in self.listeners:
+            listener.instruction_executed(opcode, start, seconds)
+
+    def aod_moved(self, distance):
+        for listener in self.listeners:
+            listener.aod_moved(distance)
+
+    def qubits_transferred(self, picked_up, dropped):
+        for listener in self.listeners:
+            listener.qubits_transferred(picked_up, dropped)
+
+    def pulsed(self, nof_sites):
+        for listener in self.listeners:
+            listener.pulsed(nof_sites)
+
+
+class Profiler(Listener):
+    # counts and times everything it is told about. the totals are written
+    # by save_json, the phases and instructions as spans on a timeline by
+    # save_chrome_trace (chrome://tracing or https://ui.perfetto.dev). spans
+    # are kept up to max_spans, later ones only go into the totals.
+    def __init__(self, record_spans=True, max_spans=1 << 20):
+        self.record_spans = record_spans
+        self.max_spans = max_spans
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped_spans = 0
+        self.phase_counts = {}
+        self.phase_seconds = {}
+        self.branch_counts = {}
+        self.opcode_counts = {}
+        self.opcode_seconds = {}
+        self.aod_travel = 0.0
+        self.qubits_picked_up = 0
+        self.qubits_dropped = 0
+        self.pulses = 0
+        self.pulse_sites = 0
+
+    def _span(self, category, name, start, seconds):
+        if len(self.spans) < self.max_spans:
+            self.spans.append((category, name, start, seconds))
+        else:
+            self.dropped_spans += 1
+
+    def phase(self, category, name, start, seconds):
+        self.phase_counts[name] = self.phase_counts.get(name, 0) + 1
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+        if self.record_spans:
+            self._span(category, name, start, seconds)
+
+    def gate_compiled(self, compiler, branch):
+        counts = self.branch_counts.setdefault(compiler, {})
+        counts[branch] = counts.get(branch, 0) + 1
+
+    def instruction_executed(self, opcode, start, seconds):
+        self.opcode_counts[opcode] = self.opcode_counts.get(opcode, 0) + 1
+        self.opcode_seconds[opcode] = self.opcode_seconds.get(opcode, 0.0) + seconds
+        if self.record_spans:
+            self._span('instruction', opcode, start, seconds)
+
+    def aod_moved(self, distance):
+        self.aod_travel += distance
+
+    def qubits_transferred(self, picked_up, dropped):
+        self.qubits_picked_up += picked_up
+        self.qubits_dropped += dropped
+
+    def pulsed(self, nof_sites):
+        self.pulses += 1
+        self.pulse_sites += nof_sites
+
+    # output
+
+    def to_dict(self):
+        return {
+            'phases': {name: {'count': self.phase_counts[name], 'seconds': self.phase_seconds[name]}
+                       for name in self.phase_counts},
+            'branches': self.branch_counts,
+            'opcodes': {opcode: {'count': self.opcode_counts[opcode], 'seconds': self.opcode_seconds[opcode]}
+                        for opcode in self.opcode_counts},
+            'aod_travel': self.aod_travel,
+            'qubits_picked_up': self.qubits_picked_up,
+            'qubits_dropped': self.qubits_dropped,
+            'pulses': self.pulses,
+            'pulse_sites': self.pulse_sites,
+            'dropped_spans': self.dropped_spans,
+        }
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+            f.write('\n')
+
+    def chrome_trace(self):
+        # trace event format: one complete ('X') event per span in
+        # microseconds since the profiler was made, compile phases on one
+        # thread and execution on another, the totals in otherData
+        threads = {'compile': 0, 'execute': 1, 'instruction': 1}
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0, 'args': {'name': 'compile'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 1, 'args': {'name': 'execute'}},
+        ]
+        for category, name, start, seconds in self.spans:
+            events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': seconds * 1e6,
+                'pid': os.getpid(),
+                'tid': threads.get(category, 0),
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': self.to_dict()}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
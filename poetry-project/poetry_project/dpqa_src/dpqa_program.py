@@ -0,0 +1,221 @@
+import numpy as np
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, Initialize, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser, RydbergPulse
+
+# opcodes of the columnar program format. OP_OBJECT stores an arbitrary
+# instruction object (e.g. a user registered instruction) in the payload table.
+# the collective moves OP_MOVE_AOD_ROWS/OP_MOVE_AOD_COLS keep their lines in
+# the program's line arrays and OP_RYDBERG_PULSE_SITES its sites in the site
+# arrays: index is the position of the first line (site), payload the number
+# of lines (sites). the operation of a site is a payload id, like the one of
+# a rydberg laser. OP_RYDBERG_PULSE, a multi-site pulse kept whole in the
+# payload table, is only found in programs of format version 2 and before.
+OP_ACTIVATE_AOD_ROW = 0
+OP_ACTIVATE_AOD_COL = 1
+OP_DEACTIVATE_AOD_ROW = 2
+OP_DEACTIVATE_AOD_COL = 3
+OP_MOVE_AOD_ROW = 4
+OP_MOVE_AOD_COL = 5
+OP_RYDBERG_LASER = 6
+OP_INITIALIZE = 7
+OP_DRAW_STATE = 8
+OP_OBJECT = 9
+OP_RYDBERG_PULSE = 10
+OP_MOVE_AOD_ROWS = 11
+OP_MOVE_AOD_COLS = 12
+OP_RYDBERG_PULSE_SITES = 13
+
+# fixed little endian layout, the binary program files use it as is
+INSTRUCTION_DTYPE = np.dtype([
+    ('opcode', 'u1'),
+    ('index', '<i4'),
+    ('offset', '<f8'),
+    ('laser_x', '<f8'),
+    ('laser_y', '<f8'),
+    ('payload', '<i4'),
+])
+
+LINE_INDEX_DTYPE = np.dtype('<i4')
+LINE_OFFSET_DTYPE = np.dtype('<f8')
+SITE_POSITION_DTYPE = np.dtype('<f8')
+SITE_OPERATION_DTYPE = np.dtype('<i4')
+
+NO_PAYLOAD = -1
+
+
+class Program:
+    # columnar instruction stream: one record of INSTRUCTION_DTYPE per
+    # instruction. rydberg laser and pulse site operations, Initialize
+    # instructions and unknown instruction objects are kept in the payloads
+    # list, records and sites refer to them by position. site_positions is
+    # (nof_sites, 2).
+    def __init__(self, records=None, payloads=None, line_indices=None, line_offsets=None, site_positions=None,
+                 site_operations=None):
+        if records is None:
+            records = np.zeros(0, dtype=INSTRUCTION_DTYPE)
+        if line_indices is None:
+            line_indices = np.zeros(0, dtype=LINE_INDEX_DTYPE)
+        if line_offsets is None:
+            line_offsets = np.zeros(0, dtype=LINE_OFFSET_DTYPE)
+        if site_positions is None:
+            site_positions = np.zeros((0, 2), dtype=SITE_POSITION_DTYPE)
+        if site_operations is None:
+            site_operations = np.zeros(0, dtype=SITE_OPERATION_DTYPE)
+        self.records = records
+        self.payloads = [] if payloads is None else payloads
+        self.line_indices = line_indices
+        self.line_offsets = line_offsets
+        self.site_positions = site_positions
+        self.site_operations = site_operations
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        chunk_size = 1 << 16
+        for start in range(0, len(self.records), chunk_size):
+            chunk = self.records[start:start + chunk_size]
+            for record in zip(chunk['opcode'].tolist(), chunk['index'].tolist(), chunk['offset'].tolist(),
+                              chunk['laser_x'].tolist(), chunk['laser_y'].tolist(), chunk['payload'].tolist()):
+                yield self._instruction_from_record(*record)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return Program(self.records[key], self.payloads, self.line_indices, self.line_offsets,
+                           self.site_positions, self.site_operations)
+        record = self.records[key]
+        return self._instruction_from_record(int(record['opcode']), int(record['index']), float(record['offset']),
+                                             float(record['laser_x']), float(record['laser_y']), int(record['payload']))
+
+    @classmethod
+    def from_instructions(cls, instructions):
+        builder = ProgramBuilder()
+        for inst in instructions:
+            builder.append(inst)
+        return builder.build()
+
+    def to_instructions(self):
+        return list(self)
+
+    def pulse_sites(self, index, nof_sites):
+        # (positions, operations) of the sites of an OP_RYDBERG_PULSE_SITES record
+        positions = [tuple(pos) for pos in self.site_positions[index:index + nof_sites].tolist()]
+        return (positions, [self.payloads[i] for i in self.site_operations[index:index + nof_sites].tolist()])
+
+    def _instruction_from_record(self, opcode, index, offset, laser_x, laser_y, payload):
+        if opcode == OP_MOVE_AOD_ROW:
+            return MoveAODRow(index, offset)
+        if opcode == OP_MOVE_AOD_COL:
+            return MoveAODCol(index, offset)
+        if opcode == OP_MOVE_AOD_ROWS:
+            return MoveAODRows(self.line_indices[index:index + payload].tolist(),
+                               self.line_offsets[index:index + payload].tolist())
+        if opcode == OP_MOVE_AOD_COLS:
+            return MoveAODCols(self.line_indices[index:index + payload].tolist(),
+                               self.line_offsets[index:index + payload].tolist())
+        if opcode == OP_ACTIVATE_AOD_ROW:
+            return ActivateAODRow(index)
+        if opcode == OP_ACTIVATE_AOD_COL:
+            return ActivateAODCol(index)
+        if opcode == OP_DEACTIVATE_AOD_ROW:
+            return DeactivateAODRow(index)
+        if opcode == OP_DEACTIVATE_AOD_COL:
+            return DeactivateAODCol(index)
+        if opcode == OP_RYDBERG_LASER:
+            return RydbergLaser((laser_x, laser_y), self.payloads[payload])
+        if opcode == OP_RYDBERG_PULSE_SITES:
+            return RydbergPulse(*self.pulse_sites(index, payload))
+        if opcode == OP_DRAW_STATE:
+            return DrawState()
+        assert(opcode in (OP_INITIALIZE, OP_RYDBERG_PULSE, OP_OBJECT))
+        return self.payloads[payload]
+
+
+class ProgramBuilder:
+    # appends instructions into a growing record buffer. payloads holds the
+    # entries from id first_payload_id on, the ones before were taken out by
+    # a ProgramWriter.
+    def __init__(self, capacity=1024):
+        self.records = np.zeros(capacity, dtype=INSTRUCTION_DTYPE)
+        self.nof_records = 0
+        self.payloads = []
+        self.first_payload_id = 0
+        self.payload_ids = {}
+        self.line_indices = []
+        self.line_offsets = []
+        self.site_positions = []
+        self.site_operations = []
+
+    def payload_id(self, payload, dedupe=True):
+        # equal operations (e.g. every CZ of a circuit) share one payload entry
+        if dedupe:
+            try:
+                payload_id = self.payload_ids.get(payload)
+            except TypeError:
+                payload_id = None
+                dedupe = False
+            if payload_id is not None:
+                return payload_id
+        payload_id = self.first_payload_id + len(self.payloads)
+        self.payloads.append(payload)
+        if dedupe:
+            self.payload_ids[payload] = payload_id
+        return payload_id
+
+    def append_record(self, opcode, index=0, offset=0.0, laser_x=0.0, laser_y=0.0, payload=NO_PAYLOAD):
+        if self.nof_records == len(self.records):
+            grown = np.zeros(2 * len(self.records), dtype=INSTRUCTION_DTYPE)
+            grown[:self.nof_records] = self.records
+            self.records = grown
+        self.records[self.nof_records] = (opcode, index, offset, laser_x, laser_y, payload)
+        self.nof_records += 1
+
+    def append_lines(self, opcode, indices, offsets):
+        indices = list(indices)
+        self.append_record(opcode, index=len(self.line_indices), payload=len(indices))
+        self.line_indices.extend(indices)
+        self.line_offsets.extend(offsets)
+
+    def append_sites(self, positions, operations):
+        positions = list(positions)
+        self.append_record(OP_RYDBERG_PULSE_SITES, index=len(self.site_operations), payload=len(positions))
+        self.site_positions.extend(positions)
+        self.site_operations.extend(self.payload_id(operation) for operation in operations)
+
+    def append(self, inst):
+        inst_type = type(inst)
+        if inst_type is MoveAODRow:
+            self.append_record(OP_MOVE_AOD_ROW, inst.row_index, inst.offset)
+        elif inst_type is MoveAODCol:
+            self.append_record(OP_MOVE_AOD_COL, inst.col_index, inst.offset)
+        elif inst_type is MoveAODRows:
+            self.append_lines(OP_MOVE_AOD_ROWS, inst.row_indices, inst.offsets)
+        elif inst_type is MoveAODCols:
+            self.append_lines(OP_MOVE_AOD_COLS, inst.col_indices, inst.offsets)
+        elif inst_type is ActivateAODRow:
+            self.append_record(OP_ACTIVATE_AOD_ROW, inst.row_index)
+        elif inst_type is ActivateAODCol:
+            self.append_record(OP_ACTIVATE_AOD_COL, inst.col_index)
+        elif inst_type is DeactivateAODRow:
+            self.append_record(OP_DEACTIVATE_AOD_ROW, inst.row_index)
+        elif inst_type is DeactivateAODCol:
+            self.append_record(OP_DEACTIVATE_AOD_COL, inst.col_index)
+        elif inst_type is RydbergLaser:
+            self.append_record(OP_RYDBERG_LASER, laser_x=inst.target_pos[0], laser_y=inst.target_pos[1],
+                               payload=self.payload_id(inst.operation))
+        elif inst_type is RydbergPulse:
+            self.append_sites(inst.target_positions, inst.operations)
+        elif inst_type is DrawState:
+            self.append_record(OP_DRAW_STATE)
+        elif inst_type is Initialize:
+            self.append_record(OP_INITIALIZE, payload=self.payload_id(inst, dedupe=False))
+        else:
+            self.append_record(OP_OBJECT, payload=self.payload_id(inst, dedupe=False))
+
+    def build(self):
+        assert(self.first_payload_id == 0), "the payloads were taken out by a ProgramWriter"
+        return Program(self.records[:self.nof_records].copy(), self.payloads,
+                       np.array(self.line_indices, dtype=LINE_INDEX_DTYPE),
+                       np.array(self.line_offsets, dtype=LINE_OFFSET_DTYPE),
+                       np.array(self.site_positions, dtype=SITE_POSITION_DTYPE).reshape(-1, 2),
+                       np.array(self.site_operations, dtype=SITE_OPERATION_DTYPE))
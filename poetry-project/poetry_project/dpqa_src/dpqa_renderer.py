@@ -0,0 +1,362 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import EllipseCollection, LineCollection, PathCollection
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
+
+from dpqa_src.dpqa_binary import dump_program, parse_program
+from dpqa_src.dpqa_program import OP_DRAW_STATE, Program
+from dpqa_src.dpqa_state import EMPTY
+
+SLM_TRAP_RADIUS = 0.20
+AOD_TRAP_RADIUS = 0.15
+UNOCCUPIED_ALPHA = 0.2
+
+# one process renders about 55 frames per second of a 64 qubit device to
+# pngs (x86_64), so a frame after every instruction of a 10k instruction
+# program takes 3 minutes. by default a program without DrawState
+# instructions gets at most MAX_FRAMES frames, evenly spaced: a minute of
+# video at 10 fps, rendered in about 11 seconds.
+MAX_FRAMES = 600
+# parallel rendering starts a process per range that first runs the program
+# up to its range, ranges shorter than this are not worth it
+MIN_FRAMES_PER_WORKER = 100
+
+
+class FrameRenderer:
+    # draws device states like dpqa_plotter.show_current_state, into one agg
+    # figure that is reused for every frame. the figure is built without
+    # pyplot, so no gui backend is loaded. the axes are drawn once and kept as
+    # a background, a frame restores it and draws the trap collections, the
+    # movement lines, the pulse circles and the labels on top, with their
+    # offsets and colors updated from the state arrays. the labels are glyph
+    # outlines in one path collection: text artists would be laid out again
+    # every time they move.
+    def __init__(self, device, labels=True, draw_movement_lines=True, figsize=(6.4, 4.8), dpi=100):
+        self.labels = labels
+        self.draw_movement_lines = draw_movement_lines
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot()
+        self.ax = ax
+        ax.set(xlim=(-1, device.max_dim_x), xticks=np.arange(0, device.max_dim_x),
+               ylim=(-1, device.max_dim_y), yticks=np.arange(0, device.max_dim_y))
+        ax.set_aspect('equal')
+
+        state = device.state
+        self.slm_colors = np.tile(to_rgba('blue'), (state.nof_slm_traps, 1))
+        self.aod_colors = np.tile(to_rgba('red'), (state.aod_rows * state.aod_cols, 1))
+        self.movement_lines = LineCollection([], linestyles='dashed', colors='orange', alpha=0.7,
+                                             animated=True)
+        self.pulse_circles = EllipseCollection(2 * (device.rydberg_radius + 0.1), 2 * (device.rydberg_radius + 0.1), 0,
+                                               units='xy', offsets=np.zeros((0, 2)), offset_transform=ax.transData,
+                                               facecolors='none', edgecolors=to_rgba('green', 0.6), animated=True)
+        self.slm_circles = EllipseCollection(2 * SLM_TRAP_RADIUS, 2 * SLM_TRAP_RADIUS, 0, units='xy',
+                                             offsets=state.slm_positions_xy(), offset_transform=ax.transData,
+                                             linewidths=0, animated=True)
+        self.aod_circles = EllipseCollection(2 * AOD_TRAP_RADIUS, 2 * AOD_TRAP_RADIUS, 0, units='xy',
+                                             offsets=state.aod_positions_xy().reshape(-1, 2),
+                                             offset_transform=ax.transData, linewidths=0, animated=True)
+        # label paths are in points around the trap position
+        self.label_collection = PathCollection([], offsets=np.zeros((0, 2)), offset_transform=ax.transData,
+                                               linewidths=0, animated=True)
+        self.label_collection.set_transform(Affine2D().scale(dpi / 72))
+        for artist in (self.movement_lines, self.pulse_circles, self.slm_circles, self.aod_circles,
+                       self.label_collection):
+            ax.add_collection(artist, autolim=False)
+        # one centered glyph path per qubit, made when the qubit first shows up
+        self.label_paths = []
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    @property
+    def size(self):
+        # (width, height) of a frame in pixels
+        width, height = self.canvas.get_width_height()
+        return (int(width), int(height))
+
+    def render(self, device):
+        # draws the device's current state and returns the frame as an
+        # (height, width, 4) rgba array. the array is the canvas buffer, it
+        # is overwritten by the next frame. like show_current_state, this
+        # clears the movement vectors and the pulse markers it draws.
+        state = device.state
+        ax = self.ax
+        self.canvas.restore_region(self.background)
+
+        aod_positions = state.aod_positions_xy().reshape(-1, 2)
+        aod_ids = state.aod_qubit_ids.ravel()
+        if self.draw_movement_lines:
+            vectors = state.movement_vectors().reshape(-1, 2)
+            moved = np.any(vectors != 0, axis=1)
+            ends = aod_positions[moved]
+            self.movement_lines.set_segments(np.stack((ends - vectors[moved], ends), axis=1))
+        device.clear_movement_vectors()
+
+        pulses = list(device.previous_rydberg_pulse_positions)
+        if device.previous_rydberg_laser_pos != (-1, -1):
+            pulses.append(device.previous_rydberg_laser_pos)
+        device.previous_rydberg_laser_pos = (-1, -1)
+        device.previous_rydberg_pulse_positions = []
+        if pulses:
+            self.pulse_circles.set_offsets(np.asarray(pulses, dtype=np.float64).reshape(-1, 2))
+            ax.draw_artist(self.pulse_circles)
+
+        slm_ids = state.slm_qubit_ids
+        self.slm_colors[:, 3] = np.where(slm_ids != EMPTY, 1.0, UNOCCUPIED_ALPHA)
+        self.slm_circles.set_facecolors(self.slm_colors)
+        ax.draw_artist(self.slm_circles)
+        self.aod_colors[:, 3] = np.where(aod_ids != EMPTY, 1.0, UNOCCUPIED_ALPHA)
+        self.aod_circles.set_offsets(aod_positions)
+        self.aod_circles.set_facecolors(self.aod_colors)
+        ax.draw_artist(self.aod_circles)
+        # in show_current_state the lines are above the traps and below the labels
+        if self.draw_movement_lines:
+            ax.draw_artist(self.movement_lines)
+
+        if self.labels:
+            self._draw_labels(state, state.slm_positions_xy(), slm_ids, aod_positions, aod_ids)
+        return np.asarray(self.canvas.buffer_rgba())
+
+    def _draw_labels(self, state, slm_positions, slm_ids, aod_positions, aod_ids):
+        slm_occupied = np.flatnonzero(slm_ids != EMPTY)
+        aod_occupied = np.flatnonzero(aod_ids != EMPTY)
+        qubit_ids = np.concatenate((slm_ids[slm_occupied], aod_ids[aod_occupied]))
+        if len(qubit_ids) == 0:
+            return
+        while len(self.label_paths) <= qubit_ids.max():
+            path = TextPath((0, 0), str(state.qubits[len(self.label_paths)].x), size=10)
+            (x0, y0), (x1, y1) = path.get_extents().get_points()
+            self.label_paths.append(path.transformed(Affine2D().translate(-(x0 + x1) / 2, -(y0 + y1) / 2)))
+        colors = np.zeros((len(qubit_ids), 4))
+        colors[:len(slm_occupied)] = to_rgba('white')
+        colors[len(slm_occupied):] = to_rgba('black')
+        self.label_collection.set_paths([self.label_paths[qubit_id] for qubit_id in qubit_ids.tolist()])
+        self.label_collection.set_offsets(np.concatenate((slm_positions[slm_occupied], aod_positions[aod_occupied])))
+        self.label_collection.set_facecolors(colors)
+        self.ax.draw_artist(self.label_collection)
+
+
+# frame writers: write(frame) takes an rgba array, close() finishes the file
+
+class PNGFrameWriter:
+    # one png per frame, frame_000000.png, frame_000001.png, ... in directory
+    def __init__(self, directory, first_index=0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.index = first_index
+
+    def write(self, frame):
+        from PIL import Image
+        Image.fromarray(frame).save(os.path.join(self.directory, f"frame_{self.index:06d}.png"), compress_level=1)
+        self.index += 1
+
+    def close(self):
+        pass
+
+
+class FFmpegFrameWriter:
+    # pipes raw rgba frames to ffmpeg, which picks the encoder from the
+    # extension of path (mp4, gif, webm, ...) unless encoder_arguments are
+    # given. frames are encoded as they come, nothing is held in memory.
+    def __init__(self, path, size, fps, encoder_arguments=None):
+        if encoder_arguments is None:
+            encoder_arguments = _encoder_arguments(path)
+        width, height = size
+        self.process = subprocess.Popen(
+            [_ffmpeg(path), '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+             '-s', f"{width}x{height}", '-r', str(fps), '-i', '-', *encoder_arguments, path],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close(self):
+        self.process.stdin.close()
+        assert(self.process.wait() == 0), "ffmpeg failed"
+
+
+class PillowGIFWriter:
+    # gif without ffmpeg. pillow writes a gif in one go, so the frames are
+    # kept (as 8 bit palette images) until close.
+    def __init__(self, path, fps):
+        self.path = path
+        self.duration = 1000 / fps
+        self.frames = []
+
+    def write(self, frame):
+        from PIL import Image
+        self.frames.append(Image.fromarray(frame).convert('RGB').quantize(colors=64))
+
+    def close(self):
+        if self.frames:
+            self.frames[0].save(self.path, save_all=True, append_images=self.frames[1:],
+                                duration=self.duration, loop=0)
+        self.frames = []
+
+
+# the segments of parallel rendering are lossless and joined by ffmpeg at the end
+SEGMENT_ENCODER_ARGUMENTS = ['-vcodec', 'ffv1']
+
+def _ffmpeg(path):
+    ffmpeg = shutil.which('ffmpeg')
+    assert(ffmpeg is not None), "ffmpeg is needed to write " + path
+    return ffmpeg
+
+def _encoder_arguments(path):
+    if os.path.splitext(path)[1].lower() in ('.mp4', '.mov', '.mkv'):
+        # h264 needs even dimensions and yuv420p for most players. the frames
+        # are flat colors, veryfast keeps the files small at half the encoding time.
+        return ['-vcodec', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+    return []
+
+def _uses_ffmpeg(path):
+    # a path without an extension is a directory of pngs. gifs are written
+    # with ffmpeg when it is installed and with pillow otherwise, every other
+    # format needs ffmpeg.
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '':
+        return False
+    if extension == '.gif':
+        return shutil.which('ffmpeg') is not None
+    _ffmpeg(path)
+    return True
+
+def frame_writer(path, size, fps):
+    if os.path.splitext(path)[1] == '':
+        return PNGFrameWriter(path)
+    if not _uses_ffmpeg(path):
+        return PillowGIFWriter(path, fps)
+    return FFmpegFrameWriter(path, size, fps)
+
+
+def frame_steps(program, frames=None):
+    # the instruction indices after which a frame is drawn:
+    #   'instructions': every instruction (like execute_instructions with
+    #     draw_states_between_instructions)
+    #   'draw_state': every DrawState instruction
+    #   an int n: every n-th instruction and the last one
+    #   None: the DrawState instructions if the program has any, otherwise
+    #     every n-th instruction with n chosen for at most MAX_FRAMES frames
+    # a frame shows the moves and the last pulse since the frame before.
+    if frames is None:
+        if np.any(program.records['opcode'] == OP_DRAW_STATE):
+            frames = 'draw_state'
+        else:
+            frames = max(1, -(-len(program) // MAX_FRAMES))
+    if isinstance(frames, (int, np.integer)):
+        assert(frames >= 1), f"frame stride {frames} is not positive"
+        steps = np.arange(frames - 1, len(program), frames)
+        if len(program) and (len(steps) == 0 or steps[-1] != len(program) - 1):
+            steps = np.append(steps, len(program) - 1)
+        return steps
+    assert(frames in ('instructions', 'draw_state')), f"unknown frames mode {frames}"
+    if frames == 'draw_state':
+        return np.flatnonzero(program.records['opcode'] == OP_DRAW_STATE)
+    return np.arange(len(program))
+
+def default_workers(path, nof_frames):
+    # a process per core when the frames can be rendered in parallel (to
+    # pngs, or to segments joined by ffmpeg), as long as every process gets
+    # MIN_FRAMES_PER_WORKER frames
+    if os.path.splitext(path)[1] != '' and shutil.which('ffmpeg') is None:
+        return 1
+    return max(1, min(os.cpu_count() or 1, nof_frames // MIN_FRAMES_PER_WORKER))
+
+def _render_steps(device, program, steps, previous_step, make_writer, renderer_options):
+    # runs the program up to the frame before steps (whose frame would have
+    # cleared the movement vectors and pulse markers), then renders a frame
+    # after every step into make_writer(frame size). returns the number of
+    # frames.
+    renderer = FrameRenderer(device, **renderer_options)
+    writer = make_writer(renderer.size)
+    if previous_step >= 0:
+        device.execute_instructions(program[:previous_step + 1], headless=True)
+        device.clear_movement_vectors()
+        device.previous_rydberg_laser_pos = (-1, -1)
+        device.previous_rydberg_pulse_positions = []
+    executed = previous_step + 1
+    for step in steps.tolist():
+        device.execute_instructions(program[executed:step + 1], headless=True)
+        executed = step + 1
+        writer.write(renderer.render(device))
+    writer.close()
+    return len(steps)
+
+def _render_range(data, first_index, steps, previous_step, segment_path, fps, renderer_options):
+    # runs in a worker: renders its frames to a lossless video segment, or to
+    # pngs numbered by their frame index when segment_path is a directory
+    device, program = parse_program(data)
+    if os.path.splitext(segment_path)[1] == '':
+        make_writer = lambda size: PNGFrameWriter(segment_path, first_index)
+    else:
+        make_writer = lambda size: FFmpegFrameWriter(segment_path, size, fps, SEGMENT_ENCODER_ARGUMENTS)
+    return _render_steps(device, program, steps, previous_step, make_writer, renderer_options)
+
+
+def render_program(device, instructions, path, fps=10, frames=None, workers=None, **renderer_options):
+    # renders the run of instructions on device (as compiled, it is not
+    # changed) to path: a video or gif, or a directory of pngs when path has
+    # no extension. frames: see frame_steps, frames='instructions' draws
+    # every instruction. with workers > 1 the frames are split into
+    # contiguous ranges rendered by that many processes, each runs the
+    # program headless up to its first frame. the ranges are lossless
+    # segments joined by ffmpeg at the end (pngs without ffmpeg). workers
+    # defaults to default_workers. returns the number of frames.
+    program = instructions if isinstance(instructions, Program) else Program.from_instructions(instructions)
+    steps = frame_steps(program, frames)
+    if workers is None:
+        workers = default_workers(path, len(steps))
+    if workers <= 1 or len(steps) < 2:
+        return _render_steps(device.copy(), program, steps, -1, lambda size: frame_writer(path, size, fps),
+                             renderer_options)
+
+    png_output = os.path.splitext(path)[1] == ''
+    segments = _uses_ffmpeg(path)
+    directory = path if png_output else tempfile.mkdtemp(prefix='dpqa_frames_')
+    try:
+        data = dump_program(device, program)
+        ranges = np.array_split(np.arange(len(steps)), min(workers, len(steps)))
+        segment_paths = [os.path.join(directory, f"segment_{k:04d}.mkv") if segments else directory
+                         for k in range(len(ranges))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_render_range, data, int(frame_range[0]), steps[frame_range],
+                                       int(steps[frame_range[0] - 1]) if frame_range[0] > 0 else -1,
+                                       segment_path, fps, renderer_options)
+                       for frame_range, segment_path in zip(ranges, segment_paths)]
+            nof_frames = sum(future.result() for future in futures)
+        if segments:
+            _join_segments(segment_paths, path, directory)
+        elif not png_output:
+            _encode_pngs(directory, path, fps, nof_frames)
+    finally:
+        if not png_output:
+            shutil.rmtree(directory, ignore_errors=True)
+    return nof_frames
+
+def _join_segments(segment_paths, path, directory):
+    listing = os.path.join(directory, 'segments.txt')
+    with open(listing, 'w') as f:
+        for segment_path in segment_paths:
+            f.write(f"file '{os.path.abspath(segment_path)}'\n")
+    subprocess.run([_ffmpeg(path), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listing,
+                    *_encoder_arguments(path), path], check=True)
+
+def _encode_pngs(directory, path, fps, nof_frames):
+    # without ffmpeg only gifs get here, written by pillow
+    from PIL import Image
+    writer = PillowGIFWriter(path, fps)
+    for index in range(nof_frames):
+        with Image.open(os.path.join(directory, f"frame_{index:06d}.png")) as image:
+            writer.write(np.asarray(image))
+    writer.close()
@@ -0,0 +1,322 @@
+import numpy as np
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, DeactivateAODCol, MoveAODCol, MoveAODRow, RydbergLaser
+from dpqa_src.dpqa_state import EMPTY
+
+# lines pushed out of the way of a moving line are left this far apart
+LINE_GAP = 0.1
+# lines are kept this far inside the device bounds
+BOUND_MARGIN = 0.05
+# where the moving qubit of a gate waits next to its partner, per axis
+INTERACTION_OFFSET = 0.2
+
+
+def qubit_positions(device):
+    # (nof registered qubits, 2) array of qubit positions, nan for lost qubits
+    state = device.state
+    positions = np.full((len(state.qubits), 2), np.nan)
+    rows, cols = np.nonzero(state.aod_qubit_ids != EMPTY)
+    positions[state.aod_qubit_ids[rows, cols]] = np.stack((state.aod_col_x[cols], state.aod_row_y[rows]), axis=-1)
+    slm_indices = np.flatnonzero(state.slm_qubit_ids != EMPTY)
+    positions[state.slm_qubit_ids[slm_indices]] = np.stack((state.slm_x[slm_indices], state.slm_y[slm_indices]), axis=-1)
+    return positions
+
+
+def pushed_positions(positions, line, target, limit):
+    # positions of the lines of one axis after line moves to target, with the
+    # lines in its way pushed ahead of it LINE_GAP apart (closer if they would
+    # not fit inside limit). None if they do not fit at all.
+    step = 1 if target > positions[line] else -1
+    stop = len(positions) if step == 1 else -1
+    if abs(target) > limit:
+        return None
+    gap = LINE_GAP
+    while gap > 1e-3:
+        new = positions.copy()
+        new[line] = target
+        m = line + step
+        while m != stop and (new[m] - new[m - step]) * step < gap:
+            new[m] = new[m - step] + step * gap
+            m += step
+        pushed = abs(m - line) - 1
+        if pushed == 0 or abs(new[m - step]) <= limit:
+            return new
+        gap = min(gap, (limit - abs(target)) / (pushed + 1)) * 0.999
+    return None
+
+
+def line_moves(move_class, positions, new):
+    # moves taking the lines from positions to new. lines moving up go from
+    # the top down and lines moving down from the bottom up, so no line ever
+    # passes a neighbour.
+    deltas = new - positions
+    up = [line for line in reversed(range(len(deltas))) if deltas[line] > 1e-12]
+    down = [line for line in range(len(deltas)) if deltas[line] < -1e-12]
+    return [move_class(line, deltas[line].item()) for line in up + down]
+
+
+class _Plan:
+    # instructions for one gate (or the final drop) worked out on copies of
+    # the line positions and slm occupancy of the router's device
+    def __init__(self, router):
+        state = router.scratch.state
+        self.router = router
+        self.rows = state.aod_row_y.copy()
+        self.cols = state.aod_col_x.copy()
+        self.slm_qubit_ids = state.slm_qubit_ids.copy()
+        self.held = router.held
+        self.layout = {}
+        self.instructions = []
+
+    def move(self, axis, line, target):
+        # False if the lines do not fit
+        positions, move_class, limit = ((self.rows, MoveAODRow, self.router.limit_y) if axis == 'row'
+                                        else (self.cols, MoveAODCol, self.router.limit_x))
+        new = pushed_positions(positions, line, target, limit)
+        if new is None:
+            return False
+        self.instructions.extend(line_moves(move_class, positions, new))
+        positions[:] = new
+        return True
+
+    def closest_line(self, axis, target):
+        # the line that gets to target with the fewest moves, then the shortest travel
+        positions, limit = (self.rows, self.router.limit_y) if axis == 'row' else (self.cols, self.router.limit_x)
+        best = None
+        for line in range(len(positions)):
+            new = pushed_positions(positions, line, target, limit)
+            if new is None:
+                continue
+            moved = np.abs(new - positions) > 1e-12
+            cost = (np.count_nonzero(moved), np.abs(new - positions).sum())
+            if best is None or cost < best[0]:
+                best = (cost, line)
+        return None if best is None else best[1]
+
+    def picks_up(self, x, y):
+        # the occupied slm trap an aod trap at (x, y) would pick up from, or None
+        router = self.router
+        near = np.flatnonzero((np.abs(router.slm_x - x) <= router.transfer_radius)
+                              & (np.abs(router.slm_y - y) <= router.transfer_radius))
+        for slm_index in near.tolist():
+            if (self.slm_qubit_ids[slm_index] != EMPTY
+                    and np.hypot(router.slm_x[slm_index] - x, router.slm_y[slm_index] - y) <= router.transfer_radius):
+                return slm_index
+        return None
+
+    def clear_rows(self, keep_row, x):
+        # moves every other row off the qubits of the column at x, so that
+        # activating the column only picks up the qubit of keep_row
+        for row in range(len(self.rows)):
+            if row == keep_row or self.picks_up(x, self.rows[row]) is None:
+                continue
+            low = self.rows[row - 1] if row > 0 else -self.router.limit_y
+            high = self.rows[row + 1] if row < len(self.rows) - 1 else self.router.limit_y
+            for target in (self.rows[row] + 0.5, self.rows[row] - 0.5,
+                           (self.rows[row] + high) / 2, (self.rows[row] + low) / 2):
+                if low < target < high and self.picks_up(x, target) is None:
+                    break
+            else:
+                return False
+            self.instructions.append(MoveAODRow(row, (target - self.rows[row]).item()))
+            self.rows[row] = target
+        return True
+
+    def pick_up(self, qubit):
+        slm_index = self.router.layout[qubit]
+        x = self.router.slm_x[slm_index]
+        y = self.router.slm_y[slm_index]
+        row = self.closest_line('row', y)
+        if row is None or not self.move('row', row, y):
+            return False
+        col = self.closest_line('col', x)
+        if col is None or not self.move('col', col, x) or not self.clear_rows(row, x):
+            return False
+        self.instructions.append(ActivateAODCol(col))
+        self.slm_qubit_ids[slm_index] = EMPTY
+        self.layout[qubit] = EMPTY
+        self.held = (qubit, row, col)
+        return True
+
+    def drop(self):
+        # the held qubit goes into the free slm trap closest to it
+        qubit, row, col = self.held
+        router = self.router
+        free = np.flatnonzero(self.slm_qubit_ids == EMPTY)
+        distances = np.hypot(router.slm_x[free] - self.cols[col], router.slm_y[free] - self.rows[row])
+        for slm_index in free[np.argsort(distances, kind='stable')].tolist():
+            rows, cols, length = self.rows.copy(), self.cols.copy(), len(self.instructions)
+            if self.move('row', row, router.slm_y[slm_index]) and self.move('col', col, router.slm_x[slm_index]):
+                break
+            self.rows, self.cols = rows, cols
+            del self.instructions[length:]
+        else:
+            return False
+        self.instructions.append(DeactivateAODCol(col))
+        self.slm_qubit_ids[slm_index] = qubit
+        self.layout[qubit] = slm_index
+        self.held = None
+        return True
+
+    def home(self):
+        # every line back to where it started, the aod must be empty
+        router = self.router
+        self.instructions.extend(line_moves(MoveAODRow, self.rows, router.home_rows))
+        self.instructions.extend(line_moves(MoveAODCol, self.cols, router.home_cols))
+        self.rows[:] = router.home_rows
+        self.cols[:] = router.home_cols
+
+    def meet(self, partner):
+        # the held qubit moves next to partner, on the side it comes from
+        qubit, row, col = self.held
+        router = self.router
+        slm_index = router.layout[partner]
+        x = router.slm_x[slm_index]
+        y = router.slm_y[slm_index]
+        target_x = x + INTERACTION_OFFSET * np.sign(self.cols[col] - x)
+        target_y = y + INTERACTION_OFFSET * np.sign(self.rows[row] - y)
+        if not (self.move('row', row, target_y) and self.move('col', col, target_x)):
+            return None
+        return (x.item(), y.item())
+
+
+class StatefulRouter:
+    # routes every gate from the current qubit -> slm trap layout instead of
+    # from fixed home positions. one aod row and one aod column pick up one
+    # qubit of the gate and carry it next to the other one, every other line
+    # in their way is pushed aside, and nothing goes back home: after the
+    # pulse the qubit stays in the aod until a gate that does not use it
+    # needs the lines, and is then dropped into the free slm trap closest to
+    # where it is. of the two qubits of a gate the one whose route is shorter
+    # moves.
+    #
+    # every route is run on a copy of the device before it is emitted and is
+    # only taken if the device executes it, every qubit is still in a trap
+    # and the pulse reaches exactly the two qubits of the gate. a gate without
+    # such a route takes the stateless one: the held qubit is dropped, the
+    # lines go back to where they started and stateless_route(slm_index1,
+    # slm_index2, operation) gives the instructions of the gate between the
+    # slm traps its qubits are in, pulse included.
+    def __init__(self, device, compiled_instructions, stateless_route):
+        self.scratch = device.copy()
+        self.compiled_instructions = compiled_instructions
+        self.stateless_route = stateless_route
+        for instr in compiled_instructions:
+            self._execute(instr)
+        state = self.scratch.state
+        self.nof_qubits = len(state.qubits)
+        self.layout = np.full(self.nof_qubits, EMPTY, dtype=np.int64)
+        slm_indices = np.flatnonzero(state.slm_qubit_ids != EMPTY)
+        self.layout[state.slm_qubit_ids[slm_indices]] = slm_indices
+        assert(np.all(self.layout != EMPTY)), "stateful routing starts with every qubit in an slm trap"
+        self.slm_x = state.slm_x.astype(np.float64)
+        self.slm_y = state.slm_y.astype(np.float64)
+        self.transfer_radius = device.trap_transfer_radius
+        self.limit_x = device.max_dim_x - BOUND_MARGIN
+        self.limit_y = device.max_dim_y - BOUND_MARGIN
+        self.home_rows = state.aod_row_y.astype(np.float64)
+        self.home_cols = state.aod_col_x.astype(np.float64)
+        self.held = None
+        self.route_counts = {'held': 0, 'picked_up': 0, 'stateless': 0}
+
+    def _execute(self, instr):
+        handler = self.scratch.handler_for(type(instr), headless=True)
+        if handler is not None:
+            handler(self.scratch, instr)
+
+    def _plans(self, q1, q2):
+        if self.held is not None and self.held[0] in (q1, q2):
+            plan = _Plan(self)
+            site = plan.meet(q2 if self.held[0] == q1 else q1)
+            if site is not None:
+                yield (plan, site)
+            return
+        for mover, partner in ((q1, q2), (q2, q1)):
+            plan = _Plan(self)
+            if plan.held is not None and not plan.drop():
+                continue
+            if not plan.pick_up(mover):
+                continue
+            site = plan.meet(partner)
+            if site is not None:
+                yield (plan, site)
+
+    def _try(self, plan, site, qubits):
+        # runs plan on the device copy, keeps it if it is valid
+        checkpoint = self.scratch.checkpoint()
+        try:
+            for instr in plan.instructions:
+                self._execute(instr)
+        except AssertionError:
+            self.scratch.rollback(checkpoint)
+            self.scratch.commit(checkpoint)
+            return False
+        state = self.scratch.state
+        placed = np.count_nonzero(state.aod_qubit_ids != EMPTY) + np.count_nonzero(state.slm_qubit_ids != EMPTY)
+        if placed != self.nof_qubits or (site is not None
+                                         and self.scratch.qubit_ids_in_rydberg_range(site) != sorted(qubits)):
+            self.scratch.rollback(checkpoint)
+            self.scratch.commit(checkpoint)
+            return False
+        self.scratch.commit(checkpoint)
+        return True
+
+    def _take(self, plan):
+        for qubit, slm_index in plan.layout.items():
+            self.layout[qubit] = slm_index
+        self.held = plan.held
+        self.compiled_instructions.extend(plan.instructions)
+
+    def route_gate(self, q1, q2, operation):
+        # emits the route of the gate on qubit ids q1 and q2 and its pulse
+        was_held = self.held is not None and self.held[0] in (q1, q2)
+        plans = sorted(self._plans(q1, q2), key=lambda plan_site: (
+            len(plan_site[0].instructions),
+            sum(abs(instr.offset) for instr in plan_site[0].instructions if hasattr(instr, 'offset'))))
+        for plan, site in plans:
+            if self._try(plan, site, (q1, q2)):
+                break
+        else:
+            self._route_stateless(q1, q2, operation)
+            return
+        self._take(plan)
+        self.route_counts['held' if was_held else 'picked_up'] += 1
+        laser = RydbergLaser(site, operation=operation)
+        self._execute(laser)
+        self.compiled_instructions.append(laser)
+        if operation == 'SWAP':
+            # the pulse swapped the two qubits between their traps
+            self._sync()
+
+    def _route_stateless(self, q1, q2, operation):
+        plan = _Plan(self)
+        if plan.held is not None:
+            assert(plan.drop() and self._try(plan, None, ())), "the held qubit cannot be dropped"
+            self._take(plan)
+            plan = _Plan(self)
+        plan.home()
+        plan.instructions.extend(self.stateless_route(self.layout[q1].item(), self.layout[q2].item(), operation))
+        for instr in plan.instructions:
+            self._execute(instr)
+        self.compiled_instructions.extend(plan.instructions)
+        self.route_counts['stateless'] += 1
+        # a swap leaves the two qubits in each other's trap
+        self._sync()
+
+    def _sync(self):
+        state = self.scratch.state
+        slm_indices = np.flatnonzero(state.slm_qubit_ids != EMPTY)
+        self.layout[state.slm_qubit_ids[slm_indices]] = slm_indices
+        if self.held is not None:
+            _, row, col = self.held
+            qubit = state.aod_qubit_ids[row, col].item()
+            self.layout[qubit] = EMPTY
+            self.held = (qubit, row, col)
+
+    def finish(self):
+        # drops the held qubit, every qubit ends in an slm trap
+        if self.held is None:
+            return
+        plan = _Plan(self)
+        assert(plan.drop() and self._try(plan, None, ())), "the held qubit cannot be dropped"
+        self._take(plan)
@@ -0,0 +1,174 @@
+import numpy as np
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, MoveAODCol, MoveAODRow, RydbergLaser, RydbergPulse
+
+# line positions closer than this count as the same position
+POSITION_TOLERANCE = 1e-9
+
+
+class GateBlock:
+    # the forward moves, the pulse and the reverse moves of one gate, and what
+    # the gate does with every aod line it uses: line -> (activated, offsets).
+    # qubits are the gate's qubits, needed to schedule across moments.
+    def __init__(self, move_instr, laser, reversed_instructions, qubits=()):
+        assert(isinstance(laser, RydbergLaser))
+        self.move_instr = move_instr
+        self.laser = laser
+        self.reversed_instructions = reversed_instructions
+        self.qubits = tuple(qubits)
+
+        activated = set()
+        offsets = {}
+        for instr in move_instr:
+            line = aod_line(instr)
+            assert(line is not None), f"unexpected instruction in a gate move sequence: {instr}"
+            if isinstance(instr, (ActivateAODRow, ActivateAODCol)):
+                assert(line not in offsets), "a gate block activates its lines before moving them"
+                activated.add(line)
+            else:
+                offsets.setdefault(line, []).append(instr.offset)
+        self.line_actions = {line: (line in activated, tuple(offsets.get(line, ())))
+                             for line in activated | set(offsets)}
+
+
+def aod_line(instr):
+    # ('row', index) or ('col', index) of a line instruction, None for anything else
+    if isinstance(instr, (ActivateAODRow, DeactivateAODRow, MoveAODRow)):
+        return ('row', instr.row_index)
+    if isinstance(instr, (ActivateAODCol, DeactivateAODCol, MoveAODCol)):
+        return ('col', instr.col_index)
+    return None
+
+
+def is_transfer(instr):
+    return isinstance(instr, (ActivateAODRow, ActivateAODCol, DeactivateAODRow, DeactivateAODCol))
+
+
+def shares_lines_consistently(block1, block2):
+    # a line used by both gates must be used the same way, the stage then
+    # activates and moves it once for both
+    if block1.laser.target_pos == block2.laser.target_pos:
+        return False
+    for line, action in block1.line_actions.items():
+        other = block2.line_actions.get(line)
+        if other is not None and other != action:
+            return False
+    return True
+
+
+def stage_instructions(stage):
+    # (forward moves, pulse, reverse moves) of a stage. every line is
+    # activated while all lines are at home and deactivated once all lines are
+    # back, a line shared by several gates is activated and moved once. the
+    # moves of a stage run as one collective motion on hardware, followed by
+    # one pulse over all of the stage's gate sites.
+    def unique_transfers(instructions):
+        seen = set()
+        output = []
+        for instr in instructions:
+            key = (type(instr), aod_line(instr))
+            if is_transfer(instr) and key not in seen:
+                seen.add(key)
+                output.append(instr)
+        return output
+
+    def once_per_line(blocks, instructions_of):
+        # the moves of a line shared by several gates come from the first of them
+        owner = {}
+        output = []
+        for block in blocks:
+            for instr in instructions_of(block):
+                if is_transfer(instr):
+                    continue
+                line = aod_line(instr)
+                if owner.setdefault(line, block) is block:
+                    output.append(instr)
+        return output
+
+    forward = [instr for block in stage for instr in block.move_instr]
+    move_instr = unique_transfers(forward) + once_per_line(stage, lambda block: block.move_instr)
+    backward = [instr for block in reversed(stage) for instr in block.reversed_instructions]
+    reversed_instructions = (once_per_line(reversed(stage), lambda block: block.reversed_instructions)
+                             + unique_transfers(backward))
+    if len(stage) == 1:
+        pulse = stage[0].laser
+    else:
+        pulse = RydbergPulse([block.laser.target_pos for block in stage],
+                             [block.laser.operation for block in stage])
+    return (move_instr, pulse, reversed_instructions)
+
+
+def same_state(device1, device2):
+    state1 = device1.state
+    state2 = device2.state
+    return (np.array_equal(state1.aod_qubit_ids, state2.aod_qubit_ids)
+            and np.array_equal(state1.slm_qubit_ids, state2.slm_qubit_ids)
+            and np.allclose(state1.aod_row_y, state2.aod_row_y, rtol=0, atol=POSITION_TOLERANCE)
+            and np.allclose(state1.aod_col_x, state2.aod_col_x, rtol=0, atol=POSITION_TOLERANCE))
+
+
+class MomentScheduler:
+    # groups the gates of a moment into stages that share one collective
+    # motion and one pulse. stages are built greedily: a stage starts from the
+    # first gate left and takes every later gate whose lines are compatible
+    # with it. whether the combined moves pass the ordering checks of
+    # move_aod_row_by/move_aod_col_by and every pulse site still sees exactly
+    # the qubits of its own gate is checked by running the stage on a copy of
+    # the device next to the gates run one by one.
+    def __init__(self, device, compiled_instructions):
+        self.scratch = device.copy()
+        for instr in compiled_instructions:
+            self._execute(self.scratch, instr)
+
+    def _execute(self, device, instr):
+        handler = device.handler_for(type(instr), headless=True)
+        if handler is not None:
+            handler(device, instr)
+
+    def _run_gate(self, device, move_instr, laser, reversed_instructions):
+        # returns the qubits at every pulse site
+        for instr in move_instr:
+            self._execute(device, instr)
+        if isinstance(laser, RydbergPulse):
+            hits = [device.qubit_ids_in_rydberg_range(pos) for pos in laser.target_positions]
+        else:
+            hits = [device.qubit_ids_in_rydberg_range(laser.target_pos)]
+        self._execute(device, laser)
+        for instr in reversed_instructions:
+            self._execute(device, instr)
+        return hits
+
+    def schedule(self, blocks):
+        # returns the stages in emission order
+        stages = []
+        remaining = list(blocks)
+        while remaining:
+            stage = [remaining.pop(0)]
+            reference = self.scratch.copy()
+            reference_hits = self._run_gate(reference, stage[0].move_instr, stage[0].laser,
+                                            stage[0].reversed_instructions)
+            # candidates run on self.scratch and the reference and are rolled back
+            scratch_checkpoint = self.scratch.checkpoint()
+            for block in list(remaining):
+                if not all(shares_lines_consistently(block, other) for other in stage):
+                    continue
+                reference_checkpoint = reference.checkpoint()
+                hits = reference_hits + self._run_gate(reference, block.move_instr, block.laser,
+                                                       block.reversed_instructions)
+                try:
+                    candidate_hits = self._run_gate(self.scratch, *stage_instructions(stage + [block]))
+                    accepted = candidate_hits == hits and same_state(self.scratch, reference)
+                except AssertionError:
+                    accepted = False
+                self.scratch.rollback(scratch_checkpoint)
+                if accepted:
+                    stage.append(block)
+                    remaining.remove(block)
+                    reference_hits = hits
+                else:
+                    reference.rollback(reference_checkpoint)
+                reference.commit(reference_checkpoint)
+            self.scratch.commit(scratch_checkpoint)
+            self.scratch = reference
+            stages.append(stage)
+        return stages
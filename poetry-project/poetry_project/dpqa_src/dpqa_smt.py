@@ -0,0 +1,229 @@
+import time
+
+import numpy as np
+
+from dpqa_src.dpqa_scheduler import MomentScheduler, same_state, shares_lines_consistently, stage_instructions
+
+_z3 = None
+
+def load_z3():
+    # z3 is optional, without it every window is scheduled greedily. it is
+    # imported by the first window that needs it, not with the compiler.
+    global _z3
+    if _z3 is None:
+        try:
+            import z3
+            _z3 = z3
+        except ImportError:
+            _z3 = False
+    return _z3 or None
+
+
+def longest_chain(nof_gates, dependencies):
+    # length of the longest chain of dependent gates, a lower bound on the
+    # number of stages. dependencies are (earlier, later) pairs.
+    depth = [1] * nof_gates
+    for earlier, later in sorted(dependencies, key=lambda pair: pair[1]):
+        depth[later] = max(depth[later], depth[earlier] + 1)
+    return max(depth, default=0)
+
+
+def greedy_clique(nof_gates, edges):
+    # size of a clique of gates that pairwise cannot share a stage, found
+    # greedily from the best connected gate. also a lower bound on the stages.
+    neighbours = [set() for _ in range(nof_gates)]
+    for g, h in edges:
+        neighbours[g].add(h)
+        neighbours[h].add(g)
+    clique = set()
+    candidates = set(range(nof_gates))
+    while candidates:
+        gate = max(candidates, key=lambda g: (len(neighbours[g] & candidates), -g))
+        clique.add(gate)
+        candidates &= neighbours[gate]
+    return len(clique)
+
+
+def lines_stay_ordered(nof_lines, axis, blocks):
+    # the final line positions of a stage of these blocks are strictly ordered
+    positions = np.arange(nof_lines, dtype=np.float64)
+    for block in blocks:
+        for (line_axis, line), (_, offsets) in block.line_actions.items():
+            if line_axis == axis:
+                positions[line] = line + sum(offsets)
+    return bool(np.all(np.diff(positions) > 0))
+
+
+class SMTScheduler(MomentScheduler):
+    # schedules the gates of a window of moments into the fewest stages (one
+    # collective motion and one pulse each) with z3. gate g runs in stage s_g:
+    #   - gates on a common qubit keep their circuit order, s_g < s_h
+    #   - gates that cannot share a stage get s_g != s_h: they use a common
+    #     aod line differently (transfers), their lines would end up out of
+    #     order, or their pulse sites would see other qubits (rydberg
+    #     adjacency), checked on the device for every pair
+    #   - a solution is checked by running its stages on the device. a stage
+    #     that fails there is learned as a clause (not all of its gates in one
+    #     stage) and the solver is asked again. the learned stages are kept by
+    #     the qubits of their gates and asserted again in every later window
+    #     holding the same gates.
+    # one solver serves every window, each in its own push/pop scope, and the
+    # number of stages is searched upwards from the longest dependency chain
+    # or the largest clique of gates that exclude each other, every bound in a
+    # nested scope. the greedy MomentScheduler schedule is the upper bound and
+    # the fallback when time_budget seconds run out for the window.
+    #
+    # an unsat bound proves the next one optimal only if the window used no
+    # learned clause: those come from running particular stages on the
+    # device, not from the constraints, and could exclude a schedule that
+    # works. such windows are counted as unproven.
+    def __init__(self, device, compiled_instructions, time_budget=1.0):
+        super().__init__(device, compiled_instructions)
+        self.time_budget = time_budget
+        self.solver = None
+        # gate qubit pairs of the stages that failed on the device
+        self.learned = []
+        # windows solved optimally, solved with learned clauses and fallen
+        # back to the greedy schedule
+        self.window_counts = {'optimal': 0, 'unproven': 0, 'greedy': 0}
+
+    def schedule_window(self, moments):
+        # moments: a list of lists of GateBlocks with their qubits set.
+        # returns the stages in emission order.
+        blocks = [block for moment in moments for block in moment]
+        z3 = load_z3()
+        if z3 is None:
+            return self._greedy(moments, 'greedy')
+        if len(blocks) < 2:
+            return self._greedy(moments, 'optimal')
+        deadline = time.perf_counter() + self.time_budget
+
+        # schedule() leaves the device it started from as it was
+        start = self.scratch
+        greedy = self._greedy(moments, None)
+        self.scratch = start
+
+        moment_of = [m for m, moment in enumerate(moments) for _ in moment]
+        dependencies = []
+        conflicts = []
+        for g in range(len(blocks)):
+            for h in range(g + 1, len(blocks)):
+                if moment_of[g] != moment_of[h] and set(blocks[g].qubits) & set(blocks[h].qubits):
+                    dependencies.append((g, h))
+                elif not self._can_share_stage(blocks[g], blocks[h]):
+                    conflicts.append((g, h))
+                if time.perf_counter() > deadline:
+                    return self._accept(greedy, 'greedy')
+
+        if self.solver is None:
+            self.solver = z3.Solver()
+        self.solver.push()
+        try:
+            return self._solve_window(z3, blocks, dependencies, conflicts, greedy, deadline)
+        finally:
+            self.solver.pop()
+
+    def _solve_window(self, z3, blocks, dependencies, conflicts, greedy, deadline):
+        solver = self.solver
+        stage_of = [z3.Int(f"s_{g}") for g in range(len(blocks))]
+        solver.add([s >= 0 for s in stage_of])
+        solver.add([stage_of[g] < stage_of[h] for g, h in dependencies])
+        solver.add([stage_of[g] != stage_of[h] for g, h in conflicts])
+
+        # the stages learned in earlier windows whose gates are all here
+        indices_of = {}
+        for g, block in enumerate(blocks):
+            indices_of.setdefault(tuple(block.qubits), []).append(g)
+        learned = False
+        for pairs in self.learned:
+            if all(len(indices_of.get(pair, ())) == 1 for pair in pairs):
+                indices = [indices_of[pair][0] for pair in pairs]
+                solver.add(z3.Or([stage_of[g] != stage_of[h] for g, h in zip(indices, indices[1:])]))
+                learned = True
+
+        nof_stages = max(longest_chain(len(blocks), dependencies),
+                         greedy_clique(len(blocks), dependencies + conflicts))
+        while nof_stages < len(greedy):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return self._accept(greedy, 'greedy')
+            solver.push()
+            solver.add([s < nof_stages for s in stage_of])
+            solver.set('timeout', max(1, int(remaining * 1000)))
+            result = solver.check()
+            if result == z3.unknown:
+                solver.pop()
+                return self._accept(greedy, 'greedy')
+            if result == z3.unsat:
+                solver.pop()
+                nof_stages += 1
+                continue
+            model = solver.model()
+            assignment = [model.eval(s, model_completion=True).as_long() for s in stage_of]
+            solver.pop()
+            stages = [[blocks[g] for g in range(len(blocks)) if assignment[g] == k] for k in range(nof_stages)]
+            stages = [stage for stage in stages if stage]
+            failed = self._run_stages(stages)
+            if failed is None:
+                # the bounds below were unsat, so this one is the fewest
+                self.window_counts['unproven' if learned else 'optimal'] += 1
+                return stages
+            if len(failed) < 2:
+                # a gate that fails on its own fails the greedy schedule too
+                return self._accept(greedy, 'greedy')
+            # learned: the gates of the failed stage do not share a stage
+            indices = [blocks.index(block) for block in failed]
+            solver.add(z3.Or([stage_of[g] != stage_of[h] for g, h in zip(indices, indices[1:])]))
+            self.learned.append([tuple(block.qubits) for block in failed])
+            learned = True
+
+        # no bound below the greedy schedule is satisfiable
+        return self._accept(greedy, 'unproven' if learned else 'optimal')
+
+    def _greedy(self, moments, count):
+        if count is not None:
+            self.window_counts[count] += 1
+        return [stage for moment in moments for stage in self.schedule(moment)]
+
+    def _accept(self, stages, count):
+        self.window_counts[count] += 1
+        assert(self._run_stages(stages) is None)
+        return stages
+
+    def _can_share_stage(self, block1, block2):
+        if not shares_lines_consistently(block1, block2):
+            return False
+        state = self.scratch.state
+        if not (lines_stay_ordered(state.aod_rows, 'row', (block1, block2))
+                and lines_stay_ordered(state.aod_cols, 'col', (block1, block2))):
+            return False
+        checkpoint = self.scratch.checkpoint()
+        valid = self._stage_is_valid([block1, block2])
+        self.scratch.rollback(checkpoint)
+        self.scratch.commit(checkpoint)
+        return valid
+
+    def _stage_is_valid(self, stage):
+        # runs the stage on self.scratch, true if it does what running its
+        # gates one by one does
+        reference = self.scratch.copy()
+        hits = []
+        for block in stage:
+            hits += self._run_gate(reference, block.move_instr, block.laser, block.reversed_instructions)
+        try:
+            stage_hits = self._run_gate(self.scratch, *stage_instructions(stage))
+        except AssertionError:
+            return False
+        return stage_hits == hits and same_state(self.scratch, reference)
+
+    def _run_stages(self, stages):
+        # runs the stages on self.scratch. returns the first stage that fails,
+        # with self.scratch as before, or None with self.scratch after them.
+        checkpoint = self.scratch.checkpoint()
+        for stage in stages:
+            if not self._stage_is_valid(stage):
+                self.scratch.rollback(checkpoint)
+                self.scratch.commit(checkpoint)
+                return stage
+        self.scratch.commit(checkpoint)
+        return None
@@ -0,0 +1,47 @@
+import math
+
+
+class UniformGridIndex:
+    # uniform grid hash over a static set of points. every point is stored in the
+    # cell (floor(x / cell_size), floor(y / cell_size)), so a radius query only
+    # needs to visit the handful of cells overlapping the query square.
+    def __init__(self, points_xy, cell_size):
+        if cell_size <= 0:
+            cell_size = 1.0
+        self.cell_size = cell_size
+        self.cells = {}
+        for i, pos in enumerate(points_xy):
+            key = (math.floor(pos[0] / cell_size), math.floor(pos[1] / cell_size))
+            # points are inserted in index order, so every cell list stays sorted
+            self.cells.setdefault(key, []).append(i)
+
+    def candidates(self, pos_xy, radius):
+        # indices (in ascending order) of all points that may be within radius of
+        # pos_xy. the caller still does the exact distance check, the small slack
+        # only makes sure rounding never drops a point on the boundary.
+        reach = radius * (1 + 1e-9) + 1e-12
+        cs = self.cell_size
+        x0 = math.floor((pos_xy[0] - reach) / cs)
+        x1 = math.floor((pos_xy[0] + reach) / cs)
+        y0 = math.floor((pos_xy[1] - reach) / cs)
+        y1 = math.floor((pos_xy[1] + reach) / cs)
+
+        found = None
+        merged = False
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    continue
+                if found is None:
+                    found = cell
+                else:
+                    if not merged:
+                        found = list(found)
+                        merged = True
+                    found.extend(cell)
+        if found is None:
+            return []
+        if merged:
+            found.sort()
+        return found
@@ -0,0 +1,259 @@
+import copy
+
+import numpy as np
+
+EMPTY = -1
+
+# undo log entry kinds
+_AOD = 0
+_SLM = 1
+_ROWS = 2
+_COLS = 3
+_STAMPS = 4
+_QUBIT = 5
+
+
+class DPQAState:
+    # array backed state of a dpqa device. all traps of an aod row share the
+    # row's y coordinate and all traps of an aod column share the column's x
+    # coordinate, so aod positions are stored as one array per axis. occupancy is
+    # stored as qubit ids (EMPTY for an empty trap), the qubit objects themselves
+    # live in self.qubits.
+    def __init__(self, aod_rows, aod_cols, slm_positions_xy):
+        self.aod_rows = aod_rows
+        self.aod_cols = aod_cols
+
+        self.aod_row_y = np.arange(aod_rows, dtype=np.float64)
+        self.aod_col_x = np.arange(aod_cols, dtype=np.float64)
+        self.aod_qubit_ids = np.full((aod_rows, aod_cols), EMPTY, dtype=np.int64)
+
+        slm_positions = np.asarray(list(slm_positions_xy))
+        if slm_positions.dtype.kind not in 'iuf':
+            slm_positions = slm_positions.astype(np.float64)
+        slm_positions = slm_positions.reshape(-1, 2)
+        self.slm_x = slm_positions[:, 0].copy()
+        self.slm_y = slm_positions[:, 1].copy()
+        self.slm_qubit_ids = np.full(len(slm_positions), EMPTY, dtype=np.int64)
+
+        self.qubits = []
+        self.qubit_ids = {}
+
+        # movement vectors: the last offset of every line and a stamp telling
+        # which of a trap's row and column moved last (0 = not moved since clear)
+        self.move_counter = 0
+        self.aod_row_last_offset = np.zeros(aod_rows, dtype=np.float64)
+        self.aod_col_last_offset = np.zeros(aod_cols, dtype=np.float64)
+        self.aod_row_move_stamp = np.zeros(aod_rows, dtype=np.int64)
+        self.aod_col_move_stamp = np.zeros(aod_cols, dtype=np.int64)
+
+        # undo log, only kept while a checkpoint is open: one entry per change,
+        # holding what is needed to invert it
+        self.undo_log = None
+        self.open_checkpoints = []
+
+        # TraceRecorder told about every change while one is attached
+        self.trace = None
+
+    def copy(self):
+        # the copy starts without checkpoints
+        state = copy.copy(self)
+        for name, value in vars(self).items():
+            if isinstance(value, np.ndarray):
+                setattr(state, name, value.copy())
+        state.qubits = list(self.qubits)
+        state.qubit_ids = dict(self.qubit_ids)
+        state.undo_log = None
+        state.open_checkpoints = []
+        state.trace = None
+        return state
+
+    # checkpoints
+
+    def checkpoint(self):
+        # returns a marker to roll back to. checkpoints nest (the marker is the
+        # nesting depth), and rolling back keeps the checkpoint open so the
+        # same branch point can be tried again.
+        if self.undo_log is None:
+            self.undo_log = []
+        self.open_checkpoints.append(len(self.undo_log))
+        return len(self.open_checkpoints) - 1
+
+    def rollback(self, marker):
+        # undoes every change made since the checkpoint, newest first, and
+        # closes the checkpoints opened after it
+        assert(0 <= marker < len(self.open_checkpoints)), "no such open checkpoint"
+        log = self.undo_log
+        log_length = self.open_checkpoints[marker]
+        while len(log) > log_length:
+            entry = log.pop()
+            kind = entry[0]
+            if kind == _AOD:
+                self.aod_qubit_ids[entry[1], entry[2]] = entry[3]
+            elif kind == _SLM:
+                self.slm_qubit_ids[entry[1]] = entry[2]
+            elif kind == _ROWS:
+                _, rows, y, last_offset, stamp, self.move_counter = entry
+                self.aod_row_y[rows] = y
+                self.aod_row_last_offset[rows] = last_offset
+                self.aod_row_move_stamp[rows] = stamp
+            elif kind == _COLS:
+                _, cols, x, last_offset, stamp, self.move_counter = entry
+                self.aod_col_x[cols] = x
+                self.aod_col_last_offset[cols] = last_offset
+                self.aod_col_move_stamp[cols] = stamp
+            elif kind == _STAMPS:
+                self.aod_row_move_stamp[:] = entry[1]
+                self.aod_col_move_stamp[:] = entry[2]
+            elif kind == _QUBIT:
+                del self.qubit_ids[self.qubits.pop()]
+        del self.open_checkpoints[marker + 1:]
+
+    def commit(self, marker):
+        # keeps the changes made since the checkpoint and closes it, and the
+        # checkpoints opened after it. the log is dropped with the outermost one.
+        assert(0 <= marker < len(self.open_checkpoints)), "no such open checkpoint"
+        del self.open_checkpoints[marker:]
+        if not self.open_checkpoints:
+            self.undo_log = None
+
+    @property
+    def nof_slm_traps(self):
+        return len(self.slm_qubit_ids)
+
+    def register_qubit(self, qubit):
+        qubit_id = self.qubit_ids.get(qubit)
+        if qubit_id is None:
+            qubit_id = len(self.qubits)
+            self.qubits.append(qubit)
+            self.qubit_ids[qubit] = qubit_id
+            if self.undo_log is not None:
+                self.undo_log.append((_QUBIT,))
+        return qubit_id
+
+    # occupancy
+
+    def place_on_aod(self, row, col, qubit_id):
+        assert(self.aod_qubit_ids[row, col] == EMPTY)
+        if self.undo_log is not None:
+            self.undo_log.append((_AOD, row, col, self.aod_qubit_ids[row, col].item()))
+        self.aod_qubit_ids[row, col] = qubit_id
+        if self.trace is not None:
+            self.trace.placed_on_aod(qubit_id, row * self.aod_cols + col)
+
+    def take_from_aod(self, row, col):
+        qubit_id = int(self.aod_qubit_ids[row, col])
+        assert(qubit_id != EMPTY)
+        if self.undo_log is not None:
+            self.undo_log.append((_AOD, row, col, self.aod_qubit_ids[row, col].item()))
+        self.aod_qubit_ids[row, col] = EMPTY
+        return qubit_id
+
+    def place_on_slm(self, slm_index, qubit_id):
+        assert(self.slm_qubit_ids[slm_index] == EMPTY)
+        if self.undo_log is not None:
+            self.undo_log.append((_SLM, slm_index, self.slm_qubit_ids[slm_index].item()))
+        self.slm_qubit_ids[slm_index] = qubit_id
+        if self.trace is not None:
+            self.trace.placed_on_slm(qubit_id, slm_index)
+
+    def take_from_slm(self, slm_index):
+        qubit_id = int(self.slm_qubit_ids[slm_index])
+        assert(qubit_id != EMPTY)
+        if self.undo_log is not None:
+            self.undo_log.append((_SLM, slm_index, self.slm_qubit_ids[slm_index].item()))
+        self.slm_qubit_ids[slm_index] = EMPTY
+        return qubit_id
+
+    def aod_occupied(self):
+        return self.aod_qubit_ids != EMPTY
+
+    def slm_occupied(self):
+        return self.slm_qubit_ids != EMPTY
+
+    # positions
+
+    def move_row(self, row, offset):
+        if self.undo_log is not None:
+            self.undo_log.append((_ROWS, row, self.aod_row_y[row].item(), self.aod_row_last_offset[row].item(),
+                                  self.aod_row_move_stamp[row].item(), self.move_counter))
+        self.aod_row_y[row] += offset
+        self.move_counter += 1
+        self.aod_row_last_offset[row] = offset
+        self.aod_row_move_stamp[row] = self.move_counter
+        if self.trace is not None:
+            self.trace.row_moved(row, offset, self.aod_row_y[row].item())
+
+    def move_col(self, col, offset):
+        if self.undo_log is not None:
+            self.undo_log.append((_COLS, col, self.aod_col_x[col].item(), self.aod_col_last_offset[col].item(),
+                                  self.aod_col_move_stamp[col].item(), self.move_counter))
+        self.aod_col_x[col] += offset
+        self.move_counter += 1
+        self.aod_col_last_offset[col] = offset
+        self.aod_col_move_stamp[col] = self.move_counter
+        if self.trace is not None:
+            self.trace.col_moved(col, offset, self.aod_col_x[col].item())
+
+    def move_rows(self, rows, offsets):
+        # rows: index array without duplicates, moved together under one stamp
+        if self.undo_log is not None:
+            self.undo_log.append((_ROWS, rows, self.aod_row_y[rows], self.aod_row_last_offset[rows],
+                                  self.aod_row_move_stamp[rows], self.move_counter))
+        self.aod_row_y[rows] += offsets
+        self.move_counter += 1
+        self.aod_row_last_offset[rows] = offsets
+        self.aod_row_move_stamp[rows] = self.move_counter
+        if self.trace is not None:
+            self.trace.rows_moved(rows, offsets, self.aod_row_y[rows])
+
+    def move_cols(self, cols, offsets):
+        if self.undo_log is not None:
+            self.undo_log.append((_COLS, cols, self.aod_col_x[cols], self.aod_col_last_offset[cols],
+                                  self.aod_col_move_stamp[cols], self.move_counter))
+        self.aod_col_x[cols] += offsets
+        self.move_counter += 1
+        self.aod_col_last_offset[cols] = offsets
+        self.aod_col_move_stamp[cols] = self.move_counter
+        if self.trace is not None:
+            self.trace.cols_moved(cols, offsets, self.aod_col_x[cols])
+
+    def aod_position_xy(self, row, col):
+        return (float(self.aod_col_x[col]), float(self.aod_row_y[row]))
+
+    def slm_position_xy(self, slm_index):
+        return (self.slm_x[slm_index].item(), self.slm_y[slm_index].item())
+
+    def aod_positions_xy(self):
+        # shape (aod_rows, aod_cols, 2)
+        xs, ys = np.meshgrid(self.aod_col_x, self.aod_row_y)
+        return np.stack((xs, ys), axis=-1)
+
+    def slm_positions_xy(self):
+        # shape (nof_slm_traps, 2)
+        return np.stack((self.slm_x, self.slm_y), axis=-1)
+
+    # movement vectors
+
+    def movement_vector(self, row, col):
+        row_stamp = self.aod_row_move_stamp[row]
+        col_stamp = self.aod_col_move_stamp[col]
+        if row_stamp == 0 and col_stamp == 0:
+            return (0, 0)
+        if row_stamp > col_stamp:
+            return (0, float(self.aod_row_last_offset[row]))
+        return (float(self.aod_col_last_offset[col]), 0)
+
+    def movement_vectors(self):
+        # shape (aod_rows, aod_cols, 2)
+        row_moved_last = self.aod_row_move_stamp[:, None] > self.aod_col_move_stamp[None, :]
+        col_moved_last = ~row_moved_last & (self.aod_col_move_stamp[None, :] > 0)
+        vectors = np.zeros((self.aod_rows, self.aod_cols, 2), dtype=np.float64)
+        vectors[..., 0] = np.where(col_moved_last, self.aod_col_last_offset[None, :], 0.0)
+        vectors[..., 1] = np.where(row_moved_last, self.aod_row_last_offset[:, None], 0.0)
+        return vectors
+
+    def clear_movement_vectors(self):
+        if self.undo_log is not None:
+            self.undo_log.append((_STAMPS, self.aod_row_move_stamp.copy(), self.aod_col_move_stamp.copy()))
+        self.aod_row_move_stamp[:] = 0
+        self.aod_col_move_stamp[:] = 0
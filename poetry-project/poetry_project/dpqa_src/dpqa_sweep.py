@@ -0,0 +1,422 @@
+import numpy as np
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, Initialize, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_program import Program
+from dpqa_src.dpqa_state import EMPTY
+
+_NO_TRAP = np.iinfo(np.int64).max
+
+
+class _SLMGrid:
+    # the slm traps bucketed into square cells at least twice the query reach
+    # wide, as a dense (cells, traps per cell) table padded with -1 and with
+    # the traps of a cell in index order. the traps within reach of a point
+    # are then in its cell and the next one on each axis, so the candidates
+    # of many points are found with four gathers. the outermost ring of cells
+    # stays empty and points off the grid are clipped onto it.
+    def __init__(self, slm_x, slm_y, radius):
+        self.reach = radius * (1 + 1e-9) + 1e-12
+        extent = max(float(np.ptp(slm_x)), float(np.ptp(slm_y)), 1.0) if len(slm_x) else 1.0
+        self.cell_size = max(2 * self.reach, extent / 256)
+        cell_x = np.floor(slm_x / self.cell_size).astype(np.int64)
+        cell_y = np.floor(slm_y / self.cell_size).astype(np.int64)
+        self.x0 = (int(cell_x.min()) if len(cell_x) else 0) - 1
+        self.y0 = (int(cell_y.min()) if len(cell_y) else 0) - 1
+        self.nx = (int(cell_x.max()) if len(cell_x) else 0) - self.x0 + 2
+        self.ny = (int(cell_y.max()) if len(cell_y) else 0) - self.y0 + 2
+        cells = (cell_x - self.x0) * self.ny + (cell_y - self.y0)
+        order = np.argsort(cells, kind='stable')
+        sorted_cells = cells[order]
+        slots = np.arange(len(order)) - np.searchsorted(sorted_cells, sorted_cells, side='left')
+        per_cell = int(slots.max()) + 1 if len(slots) else 1
+        self.table = np.full((self.nx * self.ny, per_cell), -1, dtype=np.int64)
+        self.table[sorted_cells, slots] = order
+
+    def candidates(self, x, y):
+        # (..., 4 * traps per cell) slm indices, -1 padded, for points of shape (...)
+        ix = np.floor((x - self.reach) / self.cell_size).astype(np.int64) - self.x0
+        iy = np.floor((y - self.reach) / self.cell_size).astype(np.int64) - self.y0
+        cells = []
+        for dx in (0, 1):
+            for dy in (0, 1):
+                cells.append(self.table[np.clip(ix + dx, 0, self.nx - 1) * self.ny
+                                        + np.clip(iy + dy, 0, self.ny - 1)])
+        return np.concatenate(cells, axis=-1)
+
+
+class SweepResult:
+    # what execute_sweep found for each of its variants. a variant is valid
+    # when the stream ran to its end without breaking a rule DPQA asserts,
+    # an invalid one stopped at instruction failed_at for failure (a
+    # Violation kind) and its arrays hold the state before that instruction.
+    #
+    # pulses are the laser sites in stream order (a RydbergPulse has one per
+    # site), with pulse_steps and pulse_positions shared by the variants and
+    # per variant pulse_counts (the qubits in range, -1 once the variant has
+    # failed) and pulse_qubits (the two lowest qubit ids in range, EMPTY
+    # padded).
+    def __init__(self, executor):
+        self.valid = executor.active.copy()
+        self.failed_at = executor.failed_at
+        self.failures = executor.failures
+        self.lost_qubits = executor.lost_qubits
+        self.pulse_steps = np.array(executor.pulse_steps, dtype=np.int64)
+        self.pulse_positions = np.array(executor.pulse_positions, dtype=np.float64).reshape(-1, 2)
+        nof_variants = len(executor.active)
+        self.pulse_counts = (np.stack(executor.pulse_counts, axis=1) if executor.pulse_counts
+                             else np.zeros((nof_variants, 0), dtype=np.int64))
+        self.pulse_qubits = (np.stack(executor.pulse_qubits, axis=1) if executor.pulse_qubits
+                             else np.zeros((nof_variants, 0, 2), dtype=np.int64))
+        self.aod_row_y = executor.aod_row_y
+        self.aod_col_x = executor.aod_col_x
+        self.aod_qubit_ids = executor.aod_qubit_ids
+        self.slm_qubit_ids = executor.slm_qubit_ids
+        self.qubits = executor.qubits
+
+    def __len__(self):
+        return len(self.valid)
+
+    @property
+    def gates_applied(self):
+        # pulse sites that reached exactly two qubits, per variant
+        return np.count_nonzero(self.pulse_counts == 2, axis=1)
+
+    def interactions(self, variant):
+        # (instruction index, qubit id, qubit id) of every two qubit pulse site
+        # of one variant
+        sites = np.flatnonzero(self.pulse_counts[variant] == 2)
+        pairs = self.pulse_qubits[variant, sites]
+        return list(zip(self.pulse_steps[sites].tolist(), pairs[:, 0].tolist(), pairs[:, 1].tolist()))
+
+
+class SweepExecutor:
+    # runs one instruction stream on nof_variants copies of a device at once.
+    # the DPQAState arrays get a leading variant axis and every instruction
+    # is applied to all variants with a few numpy operations, following the
+    # rules of DPQA's own handlers (same traps picked, same distances, same
+    # asserts). the variants can differ in their radii (a number for all or
+    # one per variant, None for the device's) and in where the stream's first
+    # Initialize puts the qubits (see execute). a variant that breaks a rule
+    # is frozen, like a DPQA run stops at the failed assert.
+    #
+    # only SWAP pulses, which the compilers never emit, run variant by variant.
+    def __init__(self, device, nof_variants, trap_transfer_radius=None, rydberg_radius=None):
+        self.device = device
+        self.nof_variants = nof_variants
+        if trap_transfer_radius is None:
+            trap_transfer_radius = device.trap_transfer_radius
+        if rydberg_radius is None:
+            rydberg_radius = device.rydberg_radius
+        self.trap_transfer_radius = np.broadcast_to(np.asarray(trap_transfer_radius, dtype=np.float64),
+                                                    (nof_variants,)).copy()
+        self.rydberg_radius = np.broadcast_to(np.asarray(rydberg_radius, dtype=np.float64), (nof_variants,)).copy()
+
+        state = device.state
+        self.aod_row_y = np.tile(state.aod_row_y, (nof_variants, 1))
+        self.aod_col_x = np.tile(state.aod_col_x, (nof_variants, 1))
+        self.aod_qubit_ids = np.tile(state.aod_qubit_ids, (nof_variants, 1, 1))
+        self.slm_qubit_ids = np.tile(state.slm_qubit_ids, (nof_variants, 1))
+        self.slm_x = state.slm_x.astype(np.float64)
+        self.slm_y = state.slm_y.astype(np.float64)
+        self.qubits = list(state.qubits)
+        self.qubit_ids = dict(state.qubit_ids)
+        self.transfer_grid = _SLMGrid(self.slm_x, self.slm_y, float(self.trap_transfer_radius.max()))
+        self.variants = np.arange(nof_variants)
+
+        self.active = np.ones(nof_variants, dtype=bool)
+        self.failed_at = np.full(nof_variants, -1, dtype=np.int64)
+        self.failures = [None] * nof_variants
+        self.lost_qubits = np.zeros(nof_variants, dtype=np.int64)
+        self.pulse_steps = []
+        self.pulse_positions = []
+        self.pulse_counts = []
+        self.pulse_qubits = []
+        self.index = -1
+        self.placements = None
+
+    def fail(self, failing, kind):
+        # failing: bool per variant, only active variants are affected
+        failing = failing & self.active
+        for variant in np.flatnonzero(failing).tolist():
+            self.failed_at[variant] = self.index
+            self.failures[variant] = kind
+        self.active &= ~failing
+
+    def execute(self, instructions, placements=None):
+        # placements: (nof_variants, qubits) trap indices for the qubits of
+        # the stream's first Initialize, its aod qubits first (row * aod_cols
+        # + col) and then its slm qubits (slm trap indices). see
+        # initial_traps for the stream's own placement.
+        if placements is not None:
+            self.placements = np.asarray(placements, dtype=np.int64).reshape(self.nof_variants, -1)
+        if isinstance(instructions, Program):
+            instructions = iter(instructions)
+        for index, inst in enumerate(instructions, self.index + 1):
+            self.index = index
+            self.apply(inst)
+        return SweepResult(self)
+
+    def apply(self, inst):
+        inst_type = type(inst)
+        if inst_type is MoveAODRow:
+            self.move_line(self.aod_row_y, inst.row_index, inst.offset, self.device.max_dim_y)
+        elif inst_type is MoveAODCol:
+            self.move_line(self.aod_col_x, inst.col_index, inst.offset, self.device.max_dim_x)
+        elif inst_type is MoveAODRows:
+            self.move_lines(self.aod_row_y, inst.row_indices, inst.offsets, self.device.max_dim_y)
+        elif inst_type is MoveAODCols:
+            self.move_lines(self.aod_col_x, inst.col_indices, inst.offsets, self.device.max_dim_x)
+        elif inst_type is ActivateAODRow:
+            self.activate(self.aod_qubit_ids[:, inst.row_index, :], self.aod_col_x,
+                          self.aod_row_y[:, inst.row_index, None])
+        elif inst_type is ActivateAODCol:
+            self.activate(self.aod_qubit_ids[:, :, inst.col_index], self.aod_col_x[:, inst.col_index, None],
+                          self.aod_row_y)
+        elif inst_type is DeactivateAODRow:
+            self.deactivate(self.aod_qubit_ids[:, inst.row_index, :], self.aod_col_x,
+                            self.aod_row_y[:, inst.row_index, None])
+        elif inst_type is DeactivateAODCol:
+            self.deactivate(self.aod_qubit_ids[:, :, inst.col_index], self.aod_col_x[:, inst.col_index, None],
+                            self.aod_row_y)
+        elif inst_type is RydbergLaser:
+            self.pulse(inst.target_pos, inst.operation)
+        elif inst_type is RydbergPulse:
+            for laser_pos_xy, operation in zip(inst.target_positions, inst.operations):
+                self.pulse(laser_pos_xy, operation)
+        elif inst_type is Initialize:
+            self.initialize(inst)
+        elif inst_type is not DrawState:
+            assert(False), f"{inst_type.__name__} is not supported by the sweep executor"
+
+    # moves
+
+    def move_line(self, positions, line, offset, max_dim):
+        # DPQA.move_aod_row_by / move_aod_col_by
+        new = positions[:, line] + offset
+        ok = (new <= max_dim) & (new >= -max_dim)
+        self.fail(~ok, 'bounds')
+        ordered = np.ones(self.nof_variants, dtype=bool)
+        if offset < 0 and line != 0:
+            ordered = new > positions[:, line - 1]
+        if offset > 0 and line != positions.shape[1] - 1:
+            ordered = new < positions[:, line + 1]
+        self.fail(~ordered, 'ordering')
+        positions[self.active, line] = new[self.active]
+
+    def move_lines(self, positions, lines, offsets, max_dim):
+        # DPQA.move_aod_rows_by / move_aod_cols_by
+        lines = np.asarray(lines, dtype=np.int64)
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=np.float64), lines.shape)
+        if len(np.unique(lines)) != len(lines):
+            self.fail(np.ones(self.nof_variants, dtype=bool), 'ordering')
+            return
+        new = positions.copy()
+        new[:, lines] += offsets
+        moved = new[:, lines]
+        self.fail(~(np.all(moved <= max_dim, axis=1) & np.all(moved >= -max_dim, axis=1)), 'bounds')
+        self.fail(~np.all(np.diff(new, axis=1) > 0, axis=1), 'ordering')
+        positions[self.active] = new[self.active]
+
+    # transfers
+
+    def _first_slm_traps(self, pending, x, y, occupied, inclusive):
+        # per (variant, trap) point of pending: the lowest slm index within
+        # the variant's transfer radius (inclusive or not) whose occupancy is
+        # occupied, _NO_TRAP if none
+        candidates = self.transfer_grid.candidates(x, y)
+        safe = np.maximum(candidates, 0)
+        dx = x[..., None] - self.slm_x[safe]
+        dy = y[..., None] - self.slm_y[safe]
+        distances = np.sqrt(dx * dx + dy * dy)
+        radius = self.trap_transfer_radius[:, None, None]
+        in_range = (distances <= radius) if inclusive else (distances < radius)
+        slm_occupied = self.slm_qubit_ids[self.variants[:, None, None], safe] != EMPTY
+        usable = (candidates >= 0) & in_range & (slm_occupied == occupied) & pending[..., None]
+        return np.where(usable, candidates, _NO_TRAP).min(axis=-1)
+
+    def _transfer_rounds(self, pending, x, y, occupied, inclusive, move):
+        # DPQA goes through the aod traps of the line in order, each one taking
+        # the first suitable slm trap. all of them pick at once here. where
+        # several picked the same slm trap the first one gets it, and the
+        # traps from the first one that lost on pick again in the next round,
+        # as a loser's next pick may be one a later trap wanted
+        x, y = np.broadcast_arrays(x, y)
+        while pending.any():
+            choice = self._first_slm_traps(pending, x, y, occupied, inclusive)
+            variants, traps = np.nonzero(pending)
+            picked = choice[variants, traps]
+            # (variant, trap) pairs come in trap order within a variant, so
+            # the first of every (variant, slm trap) is the trap DPQA serves
+            found = picked != _NO_TRAP
+            keys = variants[found] * len(self.slm_x) + picked[found]
+            _, first = np.unique(keys, return_index=True)
+            claims = np.zeros(len(variants), dtype=bool)
+            claims[np.flatnonzero(found)[first]] = True
+            losers = found & ~claims
+            first_loser = np.full(self.nof_variants, _NO_TRAP, dtype=np.int64)
+            np.minimum.at(first_loser, variants[losers], traps[losers])
+            winners = claims & (traps < first_loser[variants])
+            move(variants[winners], traps[winners], picked[winners])
+            # options only ever shrink, a trap without one is done for good
+            done = winners | ~found
+            pending[variants[done], traps[done]] = False
+
+    def activate(self, line_ids, x, y):
+        # DPQA.activate_aod_row / activate_aod_col: every empty aod trap of the
+        # line picks up the first occupied slm trap in range (inclusive).
+        # line_ids is a view of the line's traps, (variants, traps).
+        pending = (line_ids == EMPTY) & self.active[:, None]
+
+        def pick_up(variants, traps, slm_indices):
+            line_ids[variants, traps] = self.slm_qubit_ids[variants, slm_indices]
+            self.slm_qubit_ids[variants, slm_indices] = EMPTY
+
+        self._transfer_rounds(pending, x, y, True, True, pick_up)
+
+    def deactivate(self, line_ids, x, y):
+        # DPQA.deactivate_aod_row / deactivate_aod_col: every loaded aod trap of
+        # the line drops its qubit into the first empty slm trap in range
+        # (exclusive), the qubit is lost if there is none
+        pending = (line_ids != EMPTY) & self.active[:, None]
+        dropping = pending.copy()
+
+        def drop(variants, traps, slm_indices):
+            self.slm_qubit_ids[variants, slm_indices] = line_ids[variants, traps]
+            line_ids[variants, traps] = EMPTY
+
+        self._transfer_rounds(pending, x, y, False, False, drop)
+        lost = dropping & (line_ids != EMPTY)
+        self.lost_qubits += np.count_nonzero(lost, axis=1)
+        line_ids[lost] = EMPTY
+
+    # pulses
+
+    def pulse(self, laser_pos_xy, operation):
+        # DPQA.rydberg_interaction_on_position: the traps strictly within the
+        # variant's rydberg radius, aod traps in row-major order before slm
+        # traps in index order
+        lx, ly = laser_pos_xy
+        radius = self.rydberg_radius
+        reach = float(radius.max()) * (1 + 1e-9) + 1e-12
+        dy = self.aod_row_y - ly
+        dx = self.aod_col_x - lx
+        rows = np.flatnonzero(np.any(np.abs(dy) <= reach, axis=0))
+        cols = np.flatnonzero(np.any(np.abs(dx) <= reach, axis=0))
+        dy = dy[:, rows]
+        dx = dx[:, cols]
+        aod_hit = np.sqrt((dx * dx)[:, None, :] + (dy * dy)[:, :, None]) < radius[:, None, None]
+        aod_ids = self.aod_qubit_ids[:, rows][:, :, cols]
+        slm_dx = self.slm_x - lx
+        slm_dy = self.slm_y - ly
+        slm_distances = np.sqrt(slm_dx * slm_dx + slm_dy * slm_dy)
+        slm_near = np.flatnonzero(slm_distances <= reach)
+        slm_hit = slm_distances[slm_near][None, :] < radius[:, None]
+        slm_ids = self.slm_qubit_ids[:, slm_near]
+
+        hit = np.concatenate([aod_hit.reshape(self.nof_variants, -1), slm_hit], axis=1)
+        ids = np.concatenate([aod_ids.reshape(self.nof_variants, -1), slm_ids], axis=1)
+        loaded = hit & (ids != EMPTY)
+        counts = np.count_nonzero(loaded, axis=1)
+        lowest = np.where(loaded, ids, _NO_TRAP)
+        if lowest.shape[1] > 2:
+            lowest = np.partition(lowest, 1, axis=1)[:, :2]
+        lowest = np.sort(np.pad(lowest, ((0, 0), (0, 2 - lowest.shape[1])), constant_values=_NO_TRAP), axis=1)
+        lowest[lowest == _NO_TRAP] = EMPTY
+
+        self.pulse_steps.append(self.index)
+        self.pulse_positions.append((lx, ly))
+        self.pulse_counts.append(np.where(self.active, counts, -1))
+        self.pulse_qubits.append(np.where(self.active[:, None], lowest, EMPTY))
+
+        if operation == 'SWAP':
+            self.fail(counts > 2, 'rydberg_crowding')
+            for variant in np.flatnonzero(self.active & (counts == 2)).tolist():
+                self._swap(variant, hit[variant], rows, cols, slm_near)
+
+    def _swap(self, variant, hit, rows, cols, slm_near):
+        # the first two traps in range swap their qubits, both must hold one
+        traps = []
+        nof_aod = len(rows) * len(cols)
+        for t in np.flatnonzero(hit)[:2].tolist():
+            if t < nof_aod:
+                traps.append((self.aod_qubit_ids, (variant, rows[t // len(cols)], cols[t % len(cols)])))
+            else:
+                traps.append((self.slm_qubit_ids, (variant, slm_near[t - nof_aod])))
+        (ids1, at1), (ids2, at2) = traps
+        if ids1[at1] == EMPTY or ids2[at2] == EMPTY:
+            self.fail(self.variants == variant, 'swap')
+            return
+        ids1[at1], ids2[at2] = ids2[at2], ids1[at1]
+
+    # placement
+
+    def initialize(self, inst):
+        # DPQA.add_qubits_to_aod_traps / add_qubits_to_slm_traps, for the first
+        # Initialize with the variants' placements when there are any
+        aod_ids = [self._register(qubit) for qubit in inst.aod_qubits]
+        slm_ids = [self._register(qubit) for qubit in inst.slm_qubits]
+        aod_cols = self.aod_qubit_ids.shape[2]
+        if self.placements is not None:
+            assert(self.placements.shape[1] == len(aod_ids) + len(slm_ids)), \
+                "a placement needs a trap for every qubit of the Initialize"
+            aod_traps = self.placements[:, :len(aod_ids)]
+            slm_traps = self.placements[:, len(aod_ids):]
+            self.placements = None
+        else:
+            aod_traps = np.tile(np.array([row * aod_cols + col for row, col in inst.aod_qubit_positions_rowcol],
+                                         dtype=np.int64).reshape(1, -1), (self.nof_variants, 1))
+            slm_traps = np.tile(np.asarray(list(inst.slm_trap_indices), dtype=np.int64).reshape(1, -1),
+                                (self.nof_variants, 1))
+        aod_flat = self.aod_qubit_ids.reshape(self.nof_variants, -1)
+        for ids, traps, occupancy in ((aod_ids, aod_traps, aod_flat), (slm_ids, slm_traps, self.slm_qubit_ids)):
+            if not ids:
+                continue
+            assert(np.all((traps >= 0) & (traps < occupancy.shape[1]))), "placement outside the traps"
+            taken = np.any(occupancy[self.variants[:, None], traps] != EMPTY, axis=1)
+            ordered = np.sort(traps, axis=1)
+            twice = np.any(ordered[:, 1:] == ordered[:, :-1], axis=1)
+            self.fail(taken | twice, 'double_occupancy')
+        for ids, traps, occupancy in ((aod_ids, aod_traps, aod_flat), (slm_ids, slm_traps, self.slm_qubit_ids)):
+            if ids:
+                variants = np.flatnonzero(self.active)
+                occupancy[variants[:, None], traps[variants]] = np.asarray(ids, dtype=np.int64)
+
+    def _register(self, qubit):
+        qubit_id = self.qubit_ids.get(qubit)
+        if qubit_id is None:
+            qubit_id = len(self.qubits)
+            self.qubits.append(qubit)
+            self.qubit_ids[qubit] = qubit_id
+        return qubit_id
+
+
+def initial_traps(device, instructions):
+    # the placement of the stream's first Initialize in the form
+    # execute_sweep takes, to permute or perturb into variants
+    for inst in (iter(instructions) if isinstance(instructions, Program) else instructions):
+        if isinstance(inst, Initialize):
+            return np.array([row * device.aod_cols + col for row, col in inst.aod_qubit_positions_rowcol]
+                            + list(inst.slm_trap_indices), dtype=np.int64)
+    assert(False), "the stream has no Initialize"
+
+def execute_sweep(device, instructions, placements=None, trap_transfer_radius=None, rydberg_radius=None):
+    # executes the stream for every placement and radius at once (the
+    # variants are their broadcast, e.g. N placements with one radius or one
+    # placement with N radii) without touching device, which must be the
+    # device the stream was compiled for, before executing anything on it.
+    # returns a SweepResult.
+    sizes = [1]
+    if placements is not None:
+        placements = np.asarray(placements, dtype=np.int64)
+        placements = placements.reshape(-1, placements.shape[-1])
+        sizes.append(len(placements))
+    for radius in (trap_transfer_radius, rydberg_radius):
+        if radius is not None:
+            sizes.append(np.asarray(radius).size)
+    nof_variants = max(sizes)
+    assert(all(size in (1, nof_variants) for size in sizes)), "the variants do not broadcast"
+    if placements is not None and len(placements) != nof_variants:
+        placements = np.repeat(placements, nof_variants, axis=0)
+    executor = SweepExecutor(device, nof_variants, np.ravel(trap_transfer_radius) if trap_transfer_radius is not None
+                             else None, np.ravel(rydberg_radius) if rydberg_radius is not None else None)
+    return executor.execute(instructions, placements)
@@ -0,0 +1,249 @@
+import math
+from array import array
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_program import Program
+
+
+class TimingModel:
+    # hardware timing parameters. times are in microseconds, distances in
+    # device units (one trap spacing).
+    def __init__(self,
+                 move_speed=0.1,
+                 move_acceleration=0.002,
+                 transfer_time=15.0,
+                 rydberg_pulse_time=0.25,
+                 coherence_time=1.5e6,
+                 idle_decoherence_budget=0.01):
+        self.move_speed = move_speed
+        self.move_acceleration = move_acceleration
+        self.transfer_time = transfer_time
+        self.rydberg_pulse_time = rydberg_pulse_time
+        self.coherence_time = coherence_time
+        # the largest fraction of coherence_time a qubit may spend idle
+        self.idle_decoherence_budget = idle_decoherence_budget
+
+    def move_time(self, distance):
+        # accelerate, cruise at move_speed, decelerate. short moves never
+        # reach move_speed and take 2 * sqrt(distance / acceleration).
+        distance = abs(distance)
+        speed = self.move_speed
+        acceleration = self.move_acceleration
+        if distance * acceleration >= speed * speed:
+            return distance / speed + speed / acceleration
+        return 2 * math.sqrt(distance / acceleration)
+
+    @property
+    def idle_time_budget(self):
+        return self.coherence_time * self.idle_decoherence_budget
+
+
+class TimingReport:
+    def __init__(self, total_duration, critical_path, critical_path_breakdown, qubit_idle_times,
+                 qubits_over_budget, nof_instructions):
+        self.total_duration = total_duration
+        # instruction indices, in execution order
+        self.critical_path = critical_path
+        # {instruction type name: time on the critical path}
+        self.critical_path_breakdown = critical_path_breakdown
+        # {qubit: idle time}, empty if per-qubit analysis was off
+        self.qubit_idle_times = qubit_idle_times
+        self.qubits_over_budget = qubits_over_budget
+        self.nof_instructions = nof_instructions
+
+    @property
+    def max_idle_time(self):
+        return max(self.qubit_idle_times.values(), default=0.0)
+
+    def __str__(self):
+        breakdown = ", ".join(f"{name} {time:.1f} us" for name, time in sorted(self.critical_path_breakdown.items()))
+        return (f"{self.nof_instructions} instructions, {self.total_duration:.1f} us, "
+                f"critical path of {len(self.critical_path)} instructions ({breakdown}), "
+                f"{len(self.qubits_over_budget)} qubits over the idle budget")
+
+
+def analyze_timing(device, instructions, model=None, per_qubit=True):
+    # list scheduling of the stream on the hardware resources: every aod row,
+    # every aod column and the rydberg laser. an instruction starts once the
+    # resources it depends on are free:
+    #   - a line move waits for its line and the neighbouring lines (ordering)
+    #     and for transfers on the other axis (they hold traps on this line)
+    #   - a transfer waits for its line and every line of the other axis
+    #   - a pulse waits for everything and nothing starts before it ends
+    # the busiest "all lines" dependencies are kept as running maxima, so the
+    # pass is linear in the length of the stream.
+    #
+    # device must be the device the stream was compiled for, before executing
+    # anything on it. with per_qubit, the stream is also executed on a copy of
+    # it to find the qubits of every pulse: a qubit is busy during its pulses
+    # and idle for the rest of the program.
+    if model is None:
+        model = TimingModel()
+    scratch = device.copy() if per_qubit else None
+
+    row_ready = [0.0] * device.aod_rows
+    row_by = [-1] * device.aod_rows
+    col_ready = [0.0] * device.aod_cols
+    col_by = [-1] * device.aod_cols
+    rows_max = cols_max = 0.0
+    rows_max_by = cols_max_by = -1
+    row_transfers_max = col_transfers_max = 0.0
+    row_transfers_max_by = col_transfers_max_by = -1
+    barrier = 0.0
+    barrier_by = -1
+
+    # per instruction: the instruction its start waits for, its duration and
+    # its type (as a position in kind_names)
+    predecessors = array('q')
+    durations = array('d')
+    kinds = array('H')
+    kind_ids = {}
+    kind_names = []
+    end_time = 0.0
+    last = -1
+    busy = {}
+
+    def line_start(ready, by, lines, start, start_by):
+        for line in lines:
+            if ready[line] > start:
+                start = ready[line]
+                start_by = by[line]
+        return (start, start_by)
+
+    if isinstance(instructions, Program):
+        instructions = iter(instructions)
+    index = -1
+    for index, inst in enumerate(instructions):
+        inst_type = type(inst)
+        start = barrier
+        start_by = barrier_by
+        if inst_type is MoveAODRow or inst_type is MoveAODRows:
+            if inst_type is MoveAODRow:
+                rows = (inst.row_index,)
+                duration = model.move_time(inst.offset)
+            else:
+                rows = list(inst.row_indices)
+                duration = max((model.move_time(offset) for offset in inst.offsets), default=0.0)
+            if col_transfers_max > start:
+                start, start_by = col_transfers_max, col_transfers_max_by
+            neighbours = set()
+            for row in rows:
+                neighbours.update((row - 1, row, row + 1))
+            neighbours.discard(-1)
+            neighbours.discard(device.aod_rows)
+            start, start_by = line_start(row_ready, row_by, neighbours, start, start_by)
+            end = start + duration
+            for row in rows:
+                row_ready[row] = end
+                row_by[row] = index
+            if end > rows_max:
+                rows_max, rows_max_by = end, index
+        elif inst_type is MoveAODCol or inst_type is MoveAODCols:
+            if inst_type is MoveAODCol:
+                cols = (inst.col_index,)
+                duration = model.move_time(inst.offset)
+            else:
+                cols = list(inst.col_indices)
+                duration = max((model.move_time(offset) for offset in inst.offsets), default=0.0)
+            if row_transfers_max > start:
+                start, start_by = row_transfers_max, row_transfers_max_by
+            neighbours = set()
+            for col in cols:
+                neighbours.update((col - 1, col, col + 1))
+            neighbours.discard(-1)
+            neighbours.discard(device.aod_cols)
+            start, start_by = line_start(col_ready, col_by, neighbours, start, start_by)
+            end = start + duration
+            for col in cols:
+                col_ready[col] = end
+                col_by[col] = index
+            if end > cols_max:
+                cols_max, cols_max_by = end, index
+        elif inst_type is ActivateAODRow or inst_type is DeactivateAODRow:
+            row = inst.row_index
+            duration = model.transfer_time
+            if cols_max > start:
+                start, start_by = cols_max, cols_max_by
+            if row_ready[row] > start:
+                start, start_by = row_ready[row], row_by[row]
+            end = start + duration
+            row_ready[row] = end
+            row_by[row] = index
+            if end > rows_max:
+                rows_max, rows_max_by = end, index
+            if end > row_transfers_max:
+                row_transfers_max, row_transfers_max_by = end, index
+        elif inst_type is ActivateAODCol or inst_type is DeactivateAODCol:
+            col = inst.col_index
+            duration = model.transfer_time
+            if rows_max > start:
+                start, start_by = rows_max, rows_max_by
+            if col_ready[col] > start:
+                start, start_by = col_ready[col], col_by[col]
+            end = start + duration
+            col_ready[col] = end
+            col_by[col] = index
+            if end > cols_max:
+                cols_max, cols_max_by = end, index
+            if end > col_transfers_max:
+                col_transfers_max, col_transfers_max_by = end, index
+        elif inst_type is DrawState:
+            duration = 0.0
+            end = start
+        else:
+            # pulses, Initialize and unknown instructions act on the whole array
+            if inst_type is RydbergLaser or inst_type is RydbergPulse:
+                duration = model.rydberg_pulse_time
+            else:
+                duration = 0.0
+            if rows_max > start:
+                start, start_by = rows_max, rows_max_by
+            if cols_max > start:
+                start, start_by = cols_max, cols_max_by
+            end = start + duration
+            barrier = end
+            barrier_by = index
+            if scratch is not None and duration > 0:
+                if inst_type is RydbergLaser:
+                    sites = (inst.target_pos,)
+                else:
+                    sites = inst.target_positions
+                for site in sites:
+                    for qubit_id in scratch.qubit_ids_in_rydberg_range(site):
+                        busy[qubit_id] = busy.get(qubit_id, 0.0) + duration
+
+        if scratch is not None:
+            handler = scratch.handler_for(inst_type, headless=True)
+            if handler is not None:
+                handler(scratch, inst)
+        kind = kind_ids.get(inst_type)
+        if kind is None:
+            kind = kind_ids[inst_type] = len(kind_names)
+            kind_names.append(inst_type.__name__)
+        predecessors.append(start_by)
+        durations.append(duration)
+        kinds.append(kind)
+        if end > end_time or last == -1:
+            end_time = end
+            last = index
+
+    critical_path = []
+    breakdown = {}
+    node = last
+    while node != -1:
+        critical_path.append(node)
+        node = predecessors[node]
+    critical_path.reverse()
+    for node in critical_path:
+        name = kind_names[kinds[node]]
+        breakdown[name] = breakdown.get(name, 0.0) + durations[node]
+
+    qubit_idle_times = {}
+    qubits_over_budget = []
+    if scratch is not None:
+        for qubit_id, qubit in enumerate(scratch.state.qubits):
+            idle = end_time - busy.get(qubit_id, 0.0)
+            qubit_idle_times[qubit] = idle
+            if idle > model.idle_time_budget:
+                qubits_over_budget.append(qubit)
+    return TimingReport(end_time, critical_path, breakdown, qubit_idle_times, qubits_over_budget, index + 1)
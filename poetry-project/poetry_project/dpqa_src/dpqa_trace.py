@@ -0,0 +1,330 @@
+import json
+import os
+
+import numpy as np
+
+from dpqa_src.dpqa_state import EMPTY
+
+# event tables of a trace. step is the index of the instruction (counted over
+# every execution the recorder was attached to) that caused the event.
+#   moves: a line moved by offset to position. axis 0 is an aod row, 1 a column
+#   placements: a qubit was put into a trap. kind 0 is an aod trap (index =
+#     row * aod_cols + col), 1 an slm trap. a qubit leaves its trap only to go
+#     into another one, except when a drop finds no slm trap: kind 2, lost.
+#   pulses: a rydberg pulse site, with the ids of the qubits it reached in
+#     pulse_qubits[qubits_start:qubits_start + nof_qubits]
+MOVE_DTYPE = np.dtype([('step', '<i8'), ('axis', 'u1'), ('line', '<i4'), ('offset', '<f8'), ('position', '<f8')])
+PLACEMENT_DTYPE = np.dtype([('step', '<i8'), ('qubit', '<i4'), ('kind', 'u1'), ('index', '<i4')])
+PULSE_DTYPE = np.dtype([('step', '<i8'), ('x', '<f8'), ('y', '<f8'), ('qubits_start', '<i8'), ('nof_qubits', '<i4')])
+PULSE_QUBIT_DTYPE = np.dtype([('qubit', '<i4')])
+
+AXIS_ROW = 0
+AXIS_COL = 1
+KIND_AOD = 0
+KIND_SLM = 1
+KIND_LOST = 2
+
+# (dtype, dtype the staged values are converted with). staging in one plain
+# type keeps the conversion a single fromiter.
+TABLES = {
+    'moves': (MOVE_DTYPE, np.float64),
+    'placements': (PLACEMENT_DTYPE, np.int64),
+    'pulses': (PULSE_DTYPE, np.float64),
+    'pulse_qubits': (PULSE_QUBIT_DTYPE, np.int64),
+}
+
+
+class TraceBuffer:
+    # records of dtype. the fields of every event are appended to a flat
+    # staging list (the cheapest thing to do per event) and moved in blocks
+    # into preallocated numpy chunks, each twice the size of the one before
+    # up to max_chunk_size. with a spill file, full chunks are written to it
+    # and dropped, so memory stays bounded however long the run.
+    def __init__(self, dtype, stage_dtype, chunk_size=1 << 12, max_chunk_size=1 << 20, spill_path=None):
+        self.dtype = dtype
+        self.stage_dtype = stage_dtype
+        self.width = len(dtype.names)
+        self.max_chunk_size = max_chunk_size
+        self.staged = []
+        self.chunks = []
+        self.chunk = np.empty(chunk_size, dtype=dtype)
+        self.nof_records = 0
+        self.spill = open(spill_path, 'wb') if spill_path is not None else None
+        self.nof_spilled = 0
+
+    def __len__(self):
+        return (self.nof_spilled + sum(len(chunk) for chunk in self.chunks) + self.nof_records
+                + len(self.staged) // self.width)
+
+    def flush_staged(self):
+        if not self.staged:
+            return
+        values = np.fromiter(self.staged, dtype=self.stage_dtype, count=len(self.staged)).reshape(-1, self.width)
+        self.staged.clear()
+        while len(values):
+            room = len(self.chunk) - self.nof_records
+            if room == 0:
+                self._next_chunk()
+                continue
+            block = values[:room]
+            rows = self.chunk[self.nof_records:self.nof_records + len(block)]
+            for i, name in enumerate(self.dtype.names):
+                rows[name] = block[:, i]
+            self.nof_records += len(block)
+            values = values[room:]
+
+    def _next_chunk(self):
+        if self.spill is not None:
+            self.chunk.tofile(self.spill)
+            self.nof_spilled += len(self.chunk)
+        else:
+            self.chunks.append(self.chunk)
+        self.chunk = np.empty(min(2 * len(self.chunk), self.max_chunk_size), dtype=self.dtype)
+        self.nof_records = 0
+
+    def array(self):
+        # the records in memory as one array (all of them without a spill file)
+        self.flush_staged()
+        return np.concatenate(self.chunks + [self.chunk[:self.nof_records]])
+
+    def close(self):
+        # writes what is left to the spill file
+        self.flush_staged()
+        if self.spill is not None:
+            self.chunk[:self.nof_records].tofile(self.spill)
+            self.nof_spilled += self.nof_records
+            self.nof_records = 0
+            self.spill.close()
+            self.spill = None
+
+
+class TraceRecorder:
+    # opt-in record of an execution, passed as execute_instructions(...,
+    # trace=recorder). while attached to a device, DPQAState reports every
+    # line move and qubit placement and DPQA every lost qubit and pulse site
+    # to it. the state at the start is kept as a snapshot, so the positions
+    # and the occupancy after any step can be rebuilt from the events (see
+    # Trace).
+    #
+    # with a directory, the tables are written there as they fill up and
+    # close() finishes a trace that load_trace memory-maps, otherwise save()
+    # writes an npz.
+    #
+    # the staged events are moved into the buffers every STAGE_STEPS steps
+    STAGE_STEPS = 1 << 10
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.buffers = {name: TraceBuffer(dtype, stage_dtype, spill_path=None if directory is None else
+                                          os.path.join(directory, name + '.bin'))
+                        for name, (dtype, stage_dtype) in TABLES.items()}
+        self.moves = self.buffers['moves'].staged
+        self.placements = self.buffers['placements'].staged
+        self.pulses = self.buffers['pulses'].staged
+        self.pulse_qubits = self.buffers['pulse_qubits'].staged
+        self.nof_pulse_qubits = 0
+        self.step = -1
+        self.nof_steps = 0
+        self.initial = None
+        self.qubit_labels = []
+        self.device_state = None
+
+    # called by DPQAState and DPQA while attached
+
+    def row_moved(self, row, offset, position):
+        self.moves.extend((self.step, AXIS_ROW, row, offset, position))
+
+    def col_moved(self, col, offset, position):
+        self.moves.extend((self.step, AXIS_COL, col, offset, position))
+
+    def rows_moved(self, rows, offsets, positions):
+        self._lines_moved(AXIS_ROW, rows, offsets, positions)
+
+    def cols_moved(self, cols, offsets, positions):
+        self._lines_moved(AXIS_COL, cols, offsets, positions)
+
+    def _lines_moved(self, axis, lines, offsets, positions):
+        step = self.step
+        for line, offset, position in zip(lines.tolist(), offsets.tolist(), positions.tolist()):
+            self.moves.extend((step, axis, line, offset, position))
+
+    def placed_on_aod(self, qubit_id, index):
+        self.placements.extend((self.step, qubit_id, KIND_AOD, index))
+
+    def placed_on_slm(self, qubit_id, index):
+        self.placements.extend((self.step, qubit_id, KIND_SLM, index))
+
+    def lost(self, qubit_id):
+        self.placements.extend((self.step, qubit_id, KIND_LOST, -1))
+
+    def pulsed(self, position_xy, qubit_ids):
+        self.pulses.extend((self.step, position_xy[0], position_xy[1], self.nof_pulse_qubits, len(qubit_ids)))
+        self.pulse_qubits.extend(qubit_ids)
+        self.nof_pulse_qubits += len(qubit_ids)
+
+    # attaching
+
+    def attach(self, device):
+        state = device.state
+        if self.initial is None:
+            self.initial = {
+                'aod_row_y': state.aod_row_y.copy(),
+                'aod_col_x': state.aod_col_x.copy(),
+                'aod_qubit_ids': state.aod_qubit_ids.copy(),
+                'slm_qubit_ids': state.slm_qubit_ids.copy(),
+                'slm_x': state.slm_x.astype(np.float64),
+                'slm_y': state.slm_y.astype(np.float64),
+            }
+        state.trace = self
+        self.device_state = state
+
+    def detach(self):
+        if self.device_state is not None:
+            self.qubit_labels = [str(qubit) for qubit in self.device_state.qubits]
+            self.device_state.trace = None
+            self.device_state = None
+        for buffer in self.buffers.values():
+            buffer.flush_staged()
+
+    def steps(self, device, items):
+        # yields the items (instructions or program records) with the
+        # recorder attached to device and self.step set to each one's index
+        self.attach(device)
+        try:
+            for item in items:
+                self.step = self.nof_steps
+                self.nof_steps += 1
+                yield item
+                # dropped before the next one is fetched, so zip can reuse its tuple
+                del item
+                if self.nof_steps % self.STAGE_STEPS == 0:
+                    for buffer in self.buffers.values():
+                        buffer.flush_staged()
+        finally:
+            self.detach()
+
+    # output
+
+    def trace(self):
+        # the recorded trace, in memory. not available with a directory
+        assert(self.directory is None), "the trace is on disk, use close() and load_trace"
+        assert(self.initial is not None), "nothing was recorded"
+        return Trace(self.initial, {name: buffer.array() for name, buffer in self.buffers.items()},
+                     self.nof_steps, self.qubit_labels)
+
+    def save(self, path):
+        self.trace().save(path)
+
+    def close(self):
+        # finishes the trace in the directory
+        assert(self.directory is not None), "close() is for a trace written to a directory, use save()"
+        assert(self.initial is not None), "nothing was recorded"
+        counts = {}
+        for name, buffer in self.buffers.items():
+            buffer.close()
+            counts[name] = buffer.nof_spilled
+        np.savez(os.path.join(self.directory, 'initial.npz'), **self.initial)
+        with open(os.path.join(self.directory, 'trace.json'), 'w') as f:
+            json.dump({'nof_steps': self.nof_steps, 'counts': counts, 'qubit_labels': self.qubit_labels}, f)
+
+
+class Trace:
+    # a recorded execution: the state it started from, the event tables (see
+    # MOVE_DTYPE and friends, sorted by step) and the number of steps.
+    def __init__(self, initial, tables, nof_steps, qubit_labels):
+        self.initial = initial
+        self.moves = tables['moves']
+        self.placements = tables['placements']
+        self.pulses = tables['pulses']
+        self.pulse_qubits = tables['pulse_qubits']
+        self.nof_steps = nof_steps
+        self.qubit_labels = qubit_labels
+
+    def save(self, path):
+        arrays = {'initial_' + name: value for name, value in self.initial.items()}
+        arrays.update(moves=self.moves, placements=self.placements, pulses=self.pulses,
+                      pulse_qubits=self.pulse_qubits, nof_steps=np.int64(self.nof_steps),
+                      qubit_labels=np.array(self.qubit_labels, dtype=str))
+        np.savez(path, **arrays)
+
+    def events_at(self, step):
+        # (moves, placements, pulses) of one step
+        return tuple(table[np.searchsorted(table['step'], step, side='left'):
+                           np.searchsorted(table['step'], step, side='right')]
+                     for table in (self.moves, self.placements, self.pulses))
+
+    def qubits_of_pulse(self, pulse):
+        return self.pulse_qubits['qubit'][pulse['qubits_start']:pulse['qubits_start'] + pulse['nof_qubits']]
+
+    def line_positions(self, step):
+        # (aod_row_y, aod_col_x) after the given step
+        moves = self.moves[:np.searchsorted(self.moves['step'], step, side='right')]
+        row_y = self.initial['aod_row_y'].copy()
+        col_x = self.initial['aod_col_x'].copy()
+        for axis, positions in ((AXIS_ROW, row_y), (AXIS_COL, col_x)):
+            lines, last = _last_events(moves['line'][moves['axis'] == axis])
+            positions[lines] = moves['position'][moves['axis'] == axis][last]
+        return (row_y, col_x)
+
+    def occupancy(self, step):
+        # (aod_qubit_ids, slm_qubit_ids) after the given step. every qubit is
+        # where it was at the start or where its last placement put it.
+        placements = self.placements[:np.searchsorted(self.placements['step'], step, side='right')]
+        initial_aod = self.initial['aod_qubit_ids'].reshape(-1)
+        initial_slm = self.initial['slm_qubit_ids']
+        kinds = np.full(len(self.qubit_labels), KIND_LOST, dtype=np.int64)
+        indices = np.full(len(self.qubit_labels), -1, dtype=np.int64)
+        for kind, ids in ((KIND_AOD, initial_aod), (KIND_SLM, initial_slm)):
+            traps = np.flatnonzero(ids != EMPTY)
+            kinds[ids[traps]] = kind
+            indices[ids[traps]] = traps
+        qubits, last = _last_events(placements['qubit'])
+        kinds[qubits] = placements['kind'][last]
+        indices[qubits] = placements['index'][last]
+        aod = np.full(initial_aod.shape, EMPTY, dtype=np.int64)
+        slm = np.full(initial_slm.shape, EMPTY, dtype=np.int64)
+        for kind, ids in ((KIND_AOD, aod), (KIND_SLM, slm)):
+            placed = np.flatnonzero(kinds == kind)
+            ids[indices[placed]] = placed
+        return (aod.reshape(self.initial['aod_qubit_ids'].shape), slm)
+
+    def qubit_positions(self, step):
+        # (x, y) of every qubit after the given step, nan for qubits not placed yet
+        row_y, col_x = self.line_positions(step)
+        aod, slm = self.occupancy(step)
+        positions = np.full((len(self.qubit_labels), 2), np.nan)
+        rows, cols = np.nonzero(aod != EMPTY)
+        positions[aod[rows, cols], 0] = col_x[cols]
+        positions[aod[rows, cols], 1] = row_y[rows]
+        traps = np.flatnonzero(slm != EMPTY)
+        positions[slm[traps], 0] = self.initial['slm_x'][traps]
+        positions[slm[traps], 1] = self.initial['slm_y'][traps]
+        return positions
+
+
+def _last_events(keys):
+    # the distinct keys and the position of the last event of each
+    reversed_keys = keys[::-1]
+    unique, first_in_reversed = np.unique(reversed_keys, return_index=True)
+    return (unique, len(keys) - 1 - first_in_reversed)
+
+def load_trace(path):
+    # a trace saved as npz, or the directory of a TraceRecorder, whose
+    # tables are memory-mapped
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'trace.json')) as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, 'initial.npz')) as data:
+            initial = {name: data[name] for name in data.files}
+        tables = {}
+        for name, (dtype, _) in TABLES.items():
+            count = meta['counts'][name]
+            tables[name] = (np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r', shape=(count,))
+                            if count else np.zeros(0, dtype=dtype))
+        return Trace(initial, tables, meta['nof_steps'], meta['qubit_labels'])
+    with np.load(path) as data:
+        initial = {name[len('initial_'):]: data[name] for name in data.files if name.startswith('initial_')}
+        tables = {name: data[name] for name in TABLES}
+        return Trace(initial, tables, int(data['nof_steps']), data['qubit_labels'].tolist())
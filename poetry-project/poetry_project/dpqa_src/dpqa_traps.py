@@ -1,5 +1,3 @@
-import cirq
-
 class Trap:
     def __init__(self, x, y):
         self.y_pos = y
@@ -13,7 +11,7 @@ class Trap:
         self.qubits.append(qubit)
         assert(len(self.qubits) == 1)
     
-    def remove_qubits(self) -> cirq.Qid:
+    def remove_qubits(self) -> 'cirq.Qid':
         assert(len(self.qubits) > 0)
         q = self.qubits[0]
         self.qubits = []
@@ -33,4 +31,74 @@ class AODTrap(Trap):
 
 class SLMTrap(Trap):
     def __init__(self, x, y):
-        super().__init__(x, y)
\ No newline at end of file
+        super().__init__(x, y)
+
+class AODTrapView:
+    # aod trap backed by the array state of a dpqa device. it reads like an
+    # AODTrap but is not one: a trap cannot move on its own (its row and its
+    # column move), so there is no move_trap_by, and qubits is a tuple read
+    # from the state. qubits go in and out with add_qubits/remove_qubits.
+    def __init__(self, state, row, col):
+        self.state = state
+        self.row = row
+        self.col = col
+
+    def get_position_xy(self):
+        return (self.x_pos, self.y_pos)
+
+    @property
+    def x_pos(self):
+        return float(self.state.aod_col_x[self.col])
+
+    @property
+    def y_pos(self):
+        return float(self.state.aod_row_y[self.row])
+
+    @property
+    def qubits(self):
+        qubit_id = self.state.aod_qubit_ids[self.row, self.col]
+        if qubit_id < 0:
+            return ()
+        return (self.state.qubits[qubit_id],)
+
+    @property
+    def movement_vector(self):
+        return self.state.movement_vector(self.row, self.col)
+
+    def add_qubits(self, qubit):
+        self.state.place_on_aod(self.row, self.col, self.state.register_qubit(qubit))
+
+    def remove_qubits(self) -> 'cirq.Qid':
+        return self.state.qubits[self.state.take_from_aod(self.row, self.col)]
+
+
+class SLMTrapView:
+    # slm trap backed by the array state of a dpqa device, read like an
+    # SLMTrap. qubits is a tuple read from the state, as in AODTrapView.
+    def __init__(self, state, slm_index):
+        self.state = state
+        self.slm_index = slm_index
+
+    def get_position_xy(self):
+        return (self.x_pos, self.y_pos)
+
+    @property
+    def x_pos(self):
+        return self.state.slm_x[self.slm_index].item()
+
+    @property
+    def y_pos(self):
+        return self.state.slm_y[self.slm_index].item()
+
+    @property
+    def qubits(self):
+        qubit_id = self.state.slm_qubit_ids[self.slm_index]
+        if qubit_id < 0:
+            return ()
+        return (self.state.qubits[qubit_id],)
+
+    def add_qubits(self, qubit):
+        self.state.place_on_slm(self.slm_index, self.state.register_qubit(qubit))
+
+    def remove_qubits(self) -> 'cirq.Qid':
+        return self.state.qubits[self.state.take_from_slm(self.slm_index)]
@@ -0,0 +1,202 @@
+import numpy as np
+
+from dpqa_src.dpqa_instructions import ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, Initialize, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_program import Program
+from dpqa_src.dpqa_state import EMPTY
+
+
+class Violation:
+    # kind is one of 'ordering', 'bounds', 'double_occupancy', 'lost_qubit',
+    # 'rydberg_crowding'
+    def __init__(self, index, kind, message):
+        self.index = index
+        self.kind = kind
+        self.message = message
+
+    def __str__(self):
+        return f"instruction {self.index}: {self.kind}: {self.message}"
+
+    def __repr__(self):
+        return f"Violation({self.index}, {self.kind!r}, {self.message!r})"
+
+
+class StreamValidator:
+    # checks a stream against the rules DPQA enforces while executing it, on
+    # its own copy of the device's position and occupancy arrays. nothing is
+    # asserted and the device is never touched, so one pass reports every
+    # violation. an invalid move is still applied (the lines are where the
+    # stream puts them), so a broken ordering can cause follow-up violations.
+    def __init__(self, device):
+        self.device = device
+        self.state = device.state.copy()
+        self.violations = []
+        self.index = -1
+
+    def report(self, kind, message):
+        self.violations.append(Violation(self.index, kind, message))
+
+    def validate(self, instructions, max_violations=None):
+        for inst in self.checked(instructions):
+            if max_violations is not None and len(self.violations) >= max_violations:
+                break
+        return self.violations
+
+    def checked(self, instructions):
+        # yields the instructions after checking each of them, so a stream can
+        # be validated on its way to another consumer (e.g. a ProgramWriter).
+        # the violations collect in self.violations.
+        if isinstance(instructions, Program):
+            instructions = iter(instructions)
+        for index, inst in enumerate(instructions, self.index + 1):
+            self.index = index
+            self.check(inst)
+            yield inst
+
+    def check(self, inst):
+        inst_type = type(inst)
+        if inst_type is MoveAODRow:
+            self.move_lines('row', [inst.row_index], [inst.offset])
+        elif inst_type is MoveAODCol:
+            self.move_lines('col', [inst.col_index], [inst.offset])
+        elif inst_type is MoveAODRows:
+            self.move_lines('row', list(inst.row_indices), list(inst.offsets))
+        elif inst_type is MoveAODCols:
+            self.move_lines('col', list(inst.col_indices), list(inst.offsets))
+        elif inst_type is ActivateAODRow:
+            self.activate(self.row_traps(inst.row_index))
+        elif inst_type is ActivateAODCol:
+            self.activate(self.col_traps(inst.col_index))
+        elif inst_type is DeactivateAODRow:
+            self.deactivate(self.row_traps(inst.row_index))
+        elif inst_type is DeactivateAODCol:
+            self.deactivate(self.col_traps(inst.col_index))
+        elif inst_type is RydbergLaser:
+            self.pulse(inst.target_pos)
+        elif inst_type is RydbergPulse:
+            for pos in inst.target_positions:
+                self.pulse(pos)
+        elif inst_type is Initialize:
+            self.initialize(inst)
+        # anything else (DrawState, user registered instructions) is not checked
+
+    # moves
+
+    def move_lines(self, axis, lines, offsets):
+        if axis == 'row':
+            positions = self.state.aod_row_y
+            max_dim = self.device.max_dim_y
+        else:
+            positions = self.state.aod_col_x
+            max_dim = self.device.max_dim_x
+        if len(lines) != len(set(lines)):
+            self.report('ordering', f"{axis}s {lines} moved twice in one instruction")
+        new_positions = positions.copy()
+        for line, offset in zip(lines, offsets):
+            if line < 0 or line >= len(positions):
+                self.report('bounds', f"no aod {axis} {line}")
+                return
+            new_positions[line] += offset
+        for line in lines:
+            if abs(new_positions[line]) > max_dim:
+                self.report('bounds', f"aod {axis} {line} moved to {new_positions[line]:.6g}, outside +-{max_dim}")
+        crossing = np.flatnonzero(np.diff(new_positions) <= 0)
+        # lines that were crossed before the move are reported where they were crossed
+        was_crossing = set(np.flatnonzero(np.diff(positions) <= 0).tolist())
+        for line in crossing.tolist():
+            if line not in was_crossing:
+                self.report('ordering', f"aod {axis}s {line} and {line + 1} at {new_positions[line]:.6g} "
+                                        f"and {new_positions[line + 1]:.6g} are not strictly ordered")
+        positions[:] = new_positions
+
+    # transfers
+
+    def row_traps(self, row):
+        if row < 0 or row >= self.state.aod_rows:
+            self.report('bounds', f"no aod row {row}")
+            return []
+        return [(row, col) for col in range(self.state.aod_cols)]
+
+    def col_traps(self, col):
+        if col < 0 or col >= self.state.aod_cols:
+            self.report('bounds', f"no aod col {col}")
+            return []
+        return [(row, col) for row in range(self.state.aod_rows)]
+
+    def slm_traps_near(self, pos_xy, inclusive):
+        device = self.device
+        radius = device.trap_transfer_radius
+        found = []
+        for slm_index in device.slm_trap_index.candidates(pos_xy, radius):
+            distance = device.distance_between_points(pos_xy, device.slm_positions_xy[slm_index])
+            if distance < radius or (inclusive and distance == radius):
+                found.append(slm_index)
+        return found
+
+    def activate(self, traps):
+        # an empty aod trap picks up the first occupied slm trap in range, a
+        # loaded one keeps its qubit and is skipped, like DPQA does
+        state = self.state
+        for row, col in traps:
+            if state.aod_qubit_ids[row, col] != EMPTY:
+                continue
+            pos = (state.aod_col_x[col].item(), state.aod_row_y[row].item())
+            occupied = [i for i in self.slm_traps_near(pos, inclusive=True) if state.slm_qubit_ids[i] != EMPTY]
+            if not occupied:
+                continue
+            state.aod_qubit_ids[row, col] = state.slm_qubit_ids[occupied[0]]
+            state.slm_qubit_ids[occupied[0]] = EMPTY
+
+    def deactivate(self, traps):
+        # a loaded aod trap drops its qubit into the first empty slm trap in range
+        state = self.state
+        for row, col in traps:
+            qubit_id = state.aod_qubit_ids[row, col]
+            if qubit_id == EMPTY:
+                continue
+            pos = (state.aod_col_x[col].item(), state.aod_row_y[row].item())
+            in_range = self.slm_traps_near(pos, inclusive=False)
+            empty = [i for i in in_range if state.slm_qubit_ids[i] == EMPTY]
+            state.aod_qubit_ids[row, col] = EMPTY
+            if empty:
+                state.slm_qubit_ids[empty[0]] = qubit_id
+            elif in_range:
+                self.report('double_occupancy', f"aod trap ({row}, {col}) drops its qubit onto occupied slm trap "
+                                                f"{in_range[0]}, the qubit is lost")
+            else:
+                self.report('lost_qubit', f"aod trap ({row}, {col}) at ({pos[0]:.6g}, {pos[1]:.6g}) drops its "
+                                          f"qubit with no slm trap in range")
+
+    # pulses
+
+    def pulse(self, laser_pos_xy):
+        state = self.state
+        device = self.device
+        lx, ly = laser_pos_xy
+        radius = device.rydberg_radius
+        loaded_rows, loaded_cols = np.nonzero(state.aod_qubit_ids != EMPTY)
+        dx = state.aod_col_x[loaded_cols] - lx
+        dy = state.aod_row_y[loaded_rows] - ly
+        nof_qubits = int(np.count_nonzero(np.sqrt(dx * dx + dy * dy) < radius))
+        for slm_index in device.slm_rydberg_index.candidates(laser_pos_xy, radius):
+            if (state.slm_qubit_ids[slm_index] != EMPTY
+                    and device.distance_between_points(laser_pos_xy, device.slm_positions_xy[slm_index]) < radius):
+                nof_qubits += 1
+        if nof_qubits > 2:
+            self.report('rydberg_crowding', f"pulse at ({lx:.6g}, {ly:.6g}) reaches {nof_qubits} qubits")
+
+    def initialize(self, inst):
+        state = self.state
+        for qubit, (row, col) in zip(inst.aod_qubits, inst.aod_qubit_positions_rowcol):
+            if state.aod_qubit_ids[row, col] != EMPTY:
+                self.report('double_occupancy', f"aod trap ({row}, {col}) initialized twice")
+            state.aod_qubit_ids[row, col] = state.register_qubit(qubit)
+        for qubit, slm_index in zip(inst.slm_qubits, inst.slm_trap_indices):
+            if state.slm_qubit_ids[slm_index] != EMPTY:
+                self.report('double_occupancy', f"slm trap {slm_index} initialized twice")
+            state.slm_qubit_ids[slm_index] = state.register_qubit(qubit)
+
+
+def validate_instructions(device, instructions, max_violations=None):
+    # every rule violation of the stream, in stream order. device must be the
+    # device the stream was compiled for, before executing anything on it.
+    return StreamValidator(device).validate(instructions, max_violations)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the sources import each other as dpqa_src.*, from inside poetry_project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'poetry_project'))
@@ -0,0 +1,47 @@
+import cirq
+import pytest
+
+from dpqa_src.dpqa_batch import compile_batch
+from dpqa_src.dpqa_benchmark import random_layers_circuit
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_program import Program
+
+
+def grid_circuit():
+    # the compilers take line qubits only
+    a, b = cirq.GridQubit(0, 0), cirq.GridQubit(0, 1)
+    return cirq.Circuit(cirq.H(a), cirq.CZ(a, b))
+
+
+@pytest.mark.parametrize('compile_function', [compile, compile_overlapping_traps])
+@pytest.mark.parametrize('chunksize', [1, 2])
+def test_a_failing_circuit_fails_only_its_own_result(compile_function, chunksize):
+    circuits = [random_layers_circuit(9, depth=2, seed=seed) for seed in range(4)]
+    circuits.insert(2, grid_circuit())
+    results = sorted(compile_batch(iter(circuits), compile_function, max_workers=2, chunksize=chunksize),
+                     key=lambda result: result.index)
+    assert [result.index for result in results] == list(range(5))
+    assert [result.ok for result in results] == [True, True, False, True, True]
+
+    failed = results[2]
+    assert (failed.device, failed.program, failed.error_type) == (None, None, 'AttributeError')
+    assert "'GridQubit' object has no attribute 'x'" in failed.error
+    for result in results[:2] + results[3:]:
+        device, instructions = compile_function(circuits[result.index])
+        assert result.error is None and result.error_type is None
+        assert result.device.slm_positions_xy == device.slm_positions_xy
+        assert [str(inst) for inst in result.program] == [str(inst) for inst in Program.from_instructions(instructions)]
+
+
+def compile_small_circuits(circuit):
+    # module level, so that the workers can unpickle it
+    if len(circuit.all_qubits()) > 4:
+        raise ValueError()
+    return compile_overlapping_traps(circuit)
+
+
+def test_any_exception_is_recorded():
+    circuits = [random_layers_circuit(4), random_layers_circuit(9)]
+    results = sorted(compile_batch(circuits, compile_small_circuits, max_workers=1), key=lambda result: result.index)
+    assert results[0].ok
+    assert (results[1].ok, results[1].error, results[1].error_type) == (False, 'ValueError()', 'ValueError')
@@ -0,0 +1,70 @@
+from dpqa_src.dpqa_benchmark import (DEFAULT_BASELINE, KNOWN_FAILURES, case_key, compare_results,
+                                    environment_differences, load_results, pinned_versions, run_case, status_changes,
+                                    unexpected_failures, unpinned_versions)
+from dpqa_src.dpqa_compiler import compile_overlapping_traps
+from dpqa_src.dpqa_instructions import MoveAODRow
+
+
+def fails_to_compile(circuit):
+    raise ValueError("no device for this circuit")
+
+
+def compiles_out_of_bounds(circuit):
+    device, instructions = compile_overlapping_traps(circuit)
+    return (device, instructions + [MoveAODRow(0, 1000)])
+
+
+def test_failures_record_their_stage():
+    result = run_case('ghz_ladder', 4, fails_to_compile, memory=False)
+    assert (result['error_stage'], result['error_type'], result['error']) == (
+        'compile', 'ValueError', "no device for this circuit")
+    assert result['error_location'].startswith('test_dpqa_benchmark.py:')
+
+    result = run_case('ghz_ladder', 4, compiles_out_of_bounds, memory=False)
+    assert (result['error_stage'], result['error_type']) == ('execute', 'AssertionError')
+    assert result['error_location'].startswith('dpqa.py:') and 'max_dim_y' in result['error_line']
+
+
+def test_status_changes_both_ways():
+    working = run_case('ghz_ladder', 4, compile_overlapping_traps, memory=False)
+    broken = dict(run_case('ghz_ladder', 4, compiles_out_of_bounds, memory=False), compiler=working['compiler'])
+    assert working['error'] is None
+
+    changes = status_changes({'results': [working]}, {'results': [broken]})
+    assert [change.fixed for change in changes] == [False]
+    regressions = compare_results({'results': [working]}, {'results': [broken]})
+    assert [str(regression) for regression in regressions] == [str(changes[0]).replace(': broken,', ':')]
+
+    changes = status_changes({'results': [broken]}, {'results': [working]})
+    assert [change.fixed for change in changes] == [True]
+    assert 'execute failed at dpqa.py' in str(changes[0])
+    assert compare_results({'results': [broken]}, {'results': [working]}) == []
+
+
+def test_the_baseline_fails_only_known_cases():
+    baseline = load_results(DEFAULT_BASELINE)
+    assert unexpected_failures(baseline) == []
+    for result in baseline['results']:
+        if result['error'] is not None:
+            assert result['known_failure'] == KNOWN_FAILURES[case_key(result)]
+
+
+def test_versions_against_the_pins_and_the_baseline():
+    pins = pinned_versions()
+    assert set(pins) == {'numpy', 'cirq'}
+    pinned = {'environment': dict(pins, python='3.10.12', machine='x86_64'), 'results': []}
+    assert unpinned_versions(pinned) == []
+    assert unpinned_versions({'environment': dict(pinned['environment'], cirq=pins['cirq'] + '.0')}) == []
+    other = {'environment': dict(pinned['environment'], numpy='2.0.0'), 'results': []}
+    assert unpinned_versions(other) == [f"numpy 2.0.0 (pinned {pins['numpy']})"]
+    assert environment_differences(pinned, other) == [f"numpy {pins['numpy']} -> 2.0.0"]
+
+    # timings are not compared across versions, counts are
+    case = dict(run_case('ghz_ladder', 4, compile_overlapping_traps, memory=False))
+    slower = dict(case, compile_seconds=case['compile_seconds'] + 10)
+    longer = dict(case, instructions=case['instructions'] + 1)
+    assert [regression.metric for regression in compare_results(
+        dict(pinned, results=[case]), dict(pinned, results=[slower]))] == ['compile_seconds']
+    assert compare_results(dict(pinned, results=[case]), dict(other, results=[slower])) == []
+    assert [regression.metric for regression in compare_results(
+        dict(pinned, results=[case]), dict(other, results=[longer]))] == ['instructions']
@@ -0,0 +1,128 @@
+import json
+
+import numpy as np
+import pytest
+
+from dpqa_src import dpqa_binary
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_binary import (ProgramWriter, dump_program, load_program, parse_program, register_payload_codec,
+                                  save_program)
+from dpqa_src.dpqa_compiler import compile_overlapping_traps, compile_overlapping_traps_stream
+from dpqa_src.dpqa_instructions import RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_program import Program
+
+
+def compiled(**compile_kwargs):
+    device, instructions = compile_overlapping_traps(qaoa_circuit(8), **compile_kwargs)
+    return (device, Program.from_instructions(instructions))
+
+
+def assert_same_program(device, program, loaded_device, loaded_program):
+    for name in ('aod_rows', 'aod_cols', 'max_dim_x', 'max_dim_y', 'rydberg_radius', 'trap_transfer_radius',
+                 'slm_positions_xy'):
+        assert getattr(loaded_device, name) == getattr(device, name)
+    assert [str(inst) for inst in loaded_program] == [str(inst) for inst in program]
+
+
+@pytest.mark.parametrize('collective_moves', [False, True])
+def test_dump_and_parse(collective_moves):
+    device, program = compiled(collective_moves=collective_moves)
+    assert_same_program(device, program, *parse_program(dump_program(device, program)))
+
+
+def test_save_and_load(tmp_path):
+    device, program = compiled(collective_moves=True)
+    save_program(tmp_path / 'saved.dpqa', device, program)
+    assert_same_program(device, program, *load_program(tmp_path / 'saved.dpqa'))
+    # streamed in small chunks, the file is the same
+    with ProgramWriter(tmp_path / 'written.dpqa', device, chunk_size=7) as writer:
+        writer.extend(program)
+    assert (tmp_path / 'written.dpqa').read_bytes() == (tmp_path / 'saved.dpqa').read_bytes()
+
+
+class Marker:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return f"marker {self.name}"
+
+
+def test_payloads_need_a_codec(monkeypatch):
+    device, program = compiled()
+    instructions = list(program) + [RydbergLaser((0, 0), Marker('a'))]
+    with pytest.raises(AssertionError, match='register_payload_codec'):
+        dump_program(device, Program.from_instructions(instructions))
+
+    monkeypatch.setattr(dpqa_binary, 'PAYLOAD_CODECS', {})
+    monkeypatch.setattr(dpqa_binary, '_CODEC_KINDS', {})
+    register_payload_codec('marker', Marker, lambda marker: marker.name, Marker)
+    _, loaded = parse_program(dump_program(device, Program.from_instructions(instructions)))
+    assert str(loaded[len(instructions) - 1].operation) == 'marker a'
+
+
+def test_unknown_payload_kinds_are_refused(tmp_path):
+    device, program = compiled()
+    data = dump_program(device, program)
+    header = dpqa_binary._parse_header(data)
+    start = header['payload_offset']
+    payloads = json.loads(data[start:start + header['payload_nbytes']])
+    payloads[-1] = {'kind': 'pickle', 'value': ''}
+    payload_bytes = json.dumps(payloads).encode('utf-8').ljust(header['payload_nbytes'])
+    tampered = data[:start] + payload_bytes + data[start + header['payload_nbytes']:]
+    with pytest.raises(AssertionError, match='unknown payload kind'):
+        parse_program(tampered)
+
+
+def test_failed_writes_leave_no_file(tmp_path):
+    device, program = compiled()
+    path = tmp_path / 'program.dpqa'
+    with pytest.raises(RuntimeError):
+        with ProgramWriter(path, device, chunk_size=7) as writer:
+            for k, inst in enumerate(program):
+                if k == 50:
+                    raise RuntimeError('compile failed')
+                writer.append(inst)
+    assert list(tmp_path.iterdir()) == []
+
+    # a payload that cannot be written fails in close()
+    instructions = list(program) + [RydbergLaser((0, 0), Marker('a'))]
+    with pytest.raises(AssertionError):
+        save_program(path, device, iter(instructions))
+    with pytest.raises(AssertionError):
+        save_program(path, device, Program.from_instructions(instructions))
+    assert list(tmp_path.iterdir()) == []
+
+    # an old program is kept until the new one is complete
+    save_program(path, device, program)
+    with pytest.raises(AssertionError):
+        save_program(path, device, iter(instructions))
+    assert [str(inst) for inst in load_program(path)[1]] == [str(inst) for inst in program]
+
+
+def test_writer_keeps_only_distinct_operations(tmp_path):
+    # the sites of every pulse of a parallel stream go to the site sections,
+    # only the distinct operations stay in memory while it is written
+    device, stream = compile_overlapping_traps_stream(random_layers_circuit(36, depth=6), parallel=True)
+    instructions = list(stream)
+    assert sum(isinstance(inst, RydbergPulse) for inst in instructions) > 10
+    with ProgramWriter(tmp_path / 'written.dpqa', device, chunk_size=64) as writer:
+        for inst in instructions:
+            writer.append(inst)
+            assert writer.builder.nof_records < 64 and len(writer.builder.payloads) <= 2
+        assert len(writer.builder.payload_ids) == 1
+    save_program(tmp_path / 'saved.dpqa', device, Program.from_instructions(instructions))
+    assert (tmp_path / 'written.dpqa').read_bytes() == (tmp_path / 'saved.dpqa').read_bytes()
+
+    _, loaded = load_program(tmp_path / 'written.dpqa')
+    assert len(loaded.payloads) == 2
+    for inst, loaded_inst in zip(instructions, loaded):
+        assert type(loaded_inst) is type(inst)
+        if isinstance(inst, RydbergPulse):
+            assert loaded_inst.operations == inst.operations
+            assert np.array_equal(loaded_inst.target_positions, inst.target_positions)
+    final = device.copy()
+    final.execute_instructions_headless(instructions)
+    device.execute_program(loaded)
+    assert np.array_equal(device.state.slm_qubit_ids, final.state.slm_qubit_ids)
+    assert np.array_equal(device.state.aod_qubit_ids, final.state.aod_qubit_ids)
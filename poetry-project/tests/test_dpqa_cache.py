@@ -0,0 +1,63 @@
+import numpy as np
+
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_cache import CompilationCache, circuit_key
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_program import Program
+
+
+def strings(program):
+    return [str(inst) for inst in program]
+
+
+def test_hits_return_the_compiled_program():
+    cache = CompilationCache()
+    circuit = random_layers_circuit(9, depth=3)
+    _, expected = compile_overlapping_traps(circuit)
+    _, missed = cache.compile(circuit)
+    device, hit = cache.compile(circuit)
+    assert strings(missed) == strings(hit) == strings(Program.from_instructions(expected))
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    # a hit is a copy, changing it does not change the cache
+    hit.records['offset'][:] = 0
+    device.execute_instructions_headless(hit)
+    assert strings(cache.compile(circuit)[1]) == strings(missed)
+
+
+def test_keys_follow_the_options():
+    circuit = random_layers_circuit(9, depth=3)
+    key = circuit_key(circuit, compile_overlapping_traps, {})
+    assert key == circuit_key(random_layers_circuit(9, depth=3), compile_overlapping_traps, {'listener': object()})
+    assert key != circuit_key(circuit, compile, {})
+    assert key != circuit_key(circuit, compile_overlapping_traps, {'optimize': True})
+    assert key != circuit_key(random_layers_circuit(9, depth=3, seed=1), compile_overlapping_traps, {})
+    # arrays are keyed by their contents, not by their elided repr
+    placement = np.arange(2000)
+    moved = placement.copy()
+    moved[1000] = -1
+    assert (circuit_key(circuit, compile_overlapping_traps, {'placement': placement})
+            != circuit_key(circuit, compile_overlapping_traps, {'placement': moved}))
+
+
+def test_evicted_programs_are_found_on_disk(tmp_path):
+    cache = CompilationCache(max_entries=1, directory=tmp_path)
+    circuits = [random_layers_circuit(9, depth=2, seed=seed) for seed in range(2)]
+    first = strings(cache.compile(circuits[0])[1])
+    cache.compile(circuits[1])
+    assert len(cache) == 1 and cache.stats.evictions == 1
+    assert strings(cache.compile(circuits[0])[1]) == first
+    assert cache.stats.disk_hits == 1
+    # and by another cache on the same directory
+    assert strings(CompilationCache(directory=tmp_path).compile(circuits[0])[1]) == first
+
+
+def test_blocks_are_shared():
+    cache = CompilationCache()
+    layer = qaoa_circuit(8)
+    circuit = layer + layer
+    block_moments = len(layer)
+    _, whole = compile(circuit)
+    _, joined = cache.compile(circuit, compile, block_moments=block_moments)
+    assert strings(joined) == strings(Program.from_instructions(whole))
+    # the whole circuit and both of its blocks, which are the same
+    assert (cache.stats.misses, cache.stats.hits) == (2, 1)
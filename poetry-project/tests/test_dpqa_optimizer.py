@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_instructions import MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser
+from dpqa_src.dpqa_optimizer import collect_moves, fuse_moves, optimize_instructions
+
+
+def pulses_and_final_state(device, instructions):
+    # the qubits every pulse reaches and where every qubit ends
+    device = device.copy()
+    pulses = []
+    for inst in instructions:
+        if isinstance(inst, RydbergLaser):
+            pulses.append(device.qubit_ids_in_rydberg_range(inst.target_pos))
+        device.execute_instructions_headless([inst])
+    state = device.state
+    return (pulses, state.aod_qubit_ids.tolist(), state.slm_qubit_ids.tolist())
+
+
+@pytest.mark.parametrize('compile_function', [compile, compile_overlapping_traps])
+@pytest.mark.parametrize('circuit', [random_layers_circuit(9, depth=4), qaoa_circuit(8)])
+def test_optimized_streams_do_the_same(compile_function, circuit):
+    device, instructions = compile_function(circuit)
+    optimized = optimize_instructions(device, instructions)
+    assert len(optimized) <= len(instructions)
+    assert pulses_and_final_state(device, optimized) == pulses_and_final_state(device, instructions)
+
+
+def test_fuse_moves():
+    # moves of one line fuse across commuting moves, inverse moves cancel
+    fused = fuse_moves([MoveAODRow(0, 0.5), MoveAODCol(1, 0.2), MoveAODRow(0, 0.25), MoveAODCol(1, -0.2),
+                        MoveAODRow(1, 0.0)])
+    assert [str(inst) for inst in fused] == [str(MoveAODRow(0, 0.75))]
+    # a pulse in between stops the fusing
+    kept = fuse_moves([MoveAODRow(0, 0.5), RydbergLaser((0, 0), 'CZ'), MoveAODRow(0, -0.5)])
+    assert len(kept) == 3
+
+
+def test_collect_moves():
+    collected = collect_moves([MoveAODRow(2, 0.5), MoveAODRow(0, 0.25), MoveAODCol(1, 0.1), MoveAODRow(2, 0.5),
+                               RydbergLaser((0, 0), 'CZ'), MoveAODCol(0, 0.3)])
+    assert [type(inst) for inst in collected] == [MoveAODRows, MoveAODCol, RydbergLaser, MoveAODCol]
+    assert list(collected[0].row_indices) == [0, 2]
+    assert np.allclose(collected[0].offsets, [0.25, 1.0])
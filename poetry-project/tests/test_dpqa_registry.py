@@ -0,0 +1,30 @@
+from dpqa_src.dpqa import DPQA
+from dpqa_src.dpqa_instructions import DrawState, Instruction, RydbergLaser
+
+
+class Mark(Instruction):
+    __slots__ = ()
+
+
+def test_subclasses_register_on_their_own():
+    marked = []
+
+    class MarkingDPQA(DPQA):
+        pass
+
+    class OtherDPQA(DPQA):
+        pass
+
+    # before registering anything a subclass resolves like DPQA
+    assert OtherDPQA.handler_for(RydbergLaser) is DPQA.handler_for(RydbergLaser)
+    MarkingDPQA.register_instruction(Mark, lambda device, inst: marked.append(inst))
+    MarkingDPQA.register_instruction(RydbergLaser, lambda device, inst: marked.append(inst))
+    assert MarkingDPQA.handler_for(Mark) is not None
+    assert DPQA.handler_for(Mark) is None and OtherDPQA.handler_for(Mark) is None
+    assert DPQA.handler_for(RydbergLaser) is not MarkingDPQA.handler_for(RydbergLaser)
+    assert 'instruction_handlers' not in OtherDPQA.__dict__
+
+    # draws_state on the subclass does not change DPQA either
+    MarkingDPQA.register_instruction(DrawState, lambda device, inst: None)
+    assert MarkingDPQA.handler_for(DrawState, headless=True) is not None
+    assert DPQA.handler_for(DrawState, headless=True) is None
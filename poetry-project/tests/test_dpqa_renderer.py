@@ -0,0 +1,29 @@
+import numpy as np
+
+from dpqa_src.dpqa_benchmark import qaoa_circuit
+from dpqa_src.dpqa_compiler import compile_overlapping_traps
+from dpqa_src.dpqa_instructions import DrawState
+from dpqa_src.dpqa_program import Program
+from dpqa_src.dpqa_renderer import MAX_FRAMES, frame_steps, render_program
+
+
+def test_frame_steps():
+    device, instructions = compile_overlapping_traps(qaoa_circuit(8))
+    program = Program.from_instructions(instructions)
+    assert frame_steps(program, 'instructions').tolist() == list(range(len(program)))
+    assert frame_steps(program, 10).tolist() == list(range(9, len(program), 10)) + [len(program) - 1]
+    # no DrawState: a stride, ending with the last instruction
+    long_program = Program.from_instructions(instructions * (3 * MAX_FRAMES // len(instructions) + 1))
+    steps = frame_steps(long_program)
+    assert len(steps) <= MAX_FRAMES + 1 and steps[-1] == len(long_program) - 1
+    assert len(np.unique(np.diff(steps[:-1]))) == 1
+    # with DrawState, its frames
+    drawn = Program.from_instructions(instructions[:5] + [DrawState()] + instructions[5:] + [DrawState()])
+    assert frame_steps(drawn).tolist() == [5, len(drawn) - 1]
+
+
+def test_render_program_to_pngs(tmp_path):
+    device, instructions = compile_overlapping_traps(qaoa_circuit(4))
+    nof_frames = render_program(device, instructions, str(tmp_path / 'frames'), frames=5)
+    assert nof_frames == len(frame_steps(Program.from_instructions(instructions), 5))
+    assert len(list((tmp_path / 'frames').iterdir())) == nof_frames
@@ -0,0 +1,68 @@
+import itertools
+
+import cirq
+import numpy as np
+import pytest
+
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_compiler import compile_overlapping_traps
+from dpqa_src.dpqa_instructions import RydbergLaser
+from dpqa_src.dpqa_routing import StatefulRouter
+from dpqa_src.dpqa_state import EMPTY
+
+
+def assert_pulses_hit_their_gates(circuit, device, instructions):
+    # every pulse reaches exactly the two qubits of its gate, in circuit
+    # order, and every qubit ends in an slm trap
+    gates = [sorted(qubit.x for qubit in oper.qubits) for oper in circuit.all_operations() if len(oper.qubits) == 2]
+    device = device.copy()
+    pulses = []
+    for inst in instructions:
+        if isinstance(inst, RydbergLaser):
+            pulses.append(device.qubit_ids_in_rydberg_range(inst.target_pos))
+        device.execute_instructions_headless([inst])
+    assert pulses == gates
+    state = device.state
+    assert np.all(state.aod_qubit_ids == EMPTY)
+    assert sorted(state.slm_qubit_ids[state.slm_qubit_ids != EMPTY].tolist()) == list(range(len(state.qubits)))
+
+
+def swap_circuit(nof_qubits, nof_gates, seed=0):
+    rng = np.random.default_rng(seed)
+    qubits = cirq.LineQubit.range(nof_qubits)
+    circuit = cirq.Circuit(cirq.H.on_each(*qubits))
+    for _ in range(nof_gates):
+        a, b = rng.choice(nof_qubits, 2, replace=False)
+        circuit.append(cirq.SWAP(qubits[a], qubits[b]) if rng.random() < 0.3 else cirq.CZ(qubits[a], qubits[b]))
+    return circuit
+
+
+@pytest.mark.parametrize('circuit', [random_layers_circuit(9, depth=4), random_layers_circuit(25, depth=3, seed=1),
+                                     qaoa_circuit(12), swap_circuit(16, 30)])
+def test_stateful_pulses_hit_their_gates(circuit):
+    device, instructions = compile_overlapping_traps(circuit, stateful=True)
+    assert_pulses_hit_their_gates(circuit, device, instructions)
+
+
+@pytest.mark.parametrize('every', [1, 3])
+@pytest.mark.parametrize('circuit', [random_layers_circuit(16, depth=4), swap_circuit(9, 30, seed=2)])
+def test_gates_without_a_route_fall_back_to_the_stateless_one(monkeypatch, every, circuit):
+    # every gate, or every third one (some with a qubit held from the gate
+    # before), finds no stateful route
+    plans = StatefulRouter._plans
+    calls = itertools.count()
+    monkeypatch.setattr(StatefulRouter, '_plans',
+                        lambda router, q1, q2: iter(()) if next(calls) % every == 0 else plans(router, q1, q2))
+    route_stateless = StatefulRouter._route_stateless
+    fallbacks = []
+
+    def recorded(router, q1, q2, operation):
+        fallbacks.append(router.held)
+        route_stateless(router, q1, q2, operation)
+
+    monkeypatch.setattr(StatefulRouter, '_route_stateless', recorded)
+    device, instructions = compile_overlapping_traps(circuit, stateful=True)
+    assert len(fallbacks) == -(-sum(len(oper.qubits) == 2 for oper in circuit.all_operations()) // every)
+    if every > 1:
+        assert any(held is not None for held in fallbacks)
+    assert_pulses_hit_their_gates(circuit, device, instructions)
@@ -0,0 +1,62 @@
+import pytest
+
+from dpqa_src.dpqa_benchmark import ghz_ladder_circuit, qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_compiler import compile_overlapping_traps
+from dpqa_src.dpqa_instructions import RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_scheduler import shares_lines_consistently
+
+
+def pulse_sites_and_final_state(device, instructions):
+    # the qubits at every pulse site, the number of pulses and where every
+    # qubit ends
+    device = device.copy()
+    sites = []
+    nof_pulses = 0
+    for inst in instructions:
+        if isinstance(inst, RydbergLaser):
+            sites.append(device.qubit_ids_in_rydberg_range(inst.target_pos))
+            nof_pulses += 1
+        elif isinstance(inst, RydbergPulse):
+            sites += [device.qubit_ids_in_rydberg_range(pos) for pos in inst.target_positions]
+            nof_pulses += 1
+        device.execute_instructions_headless([inst])
+    state = device.state
+    return (sites, nof_pulses, state.aod_qubit_ids.tolist(), state.slm_qubit_ids.tolist())
+
+
+@pytest.mark.parametrize('circuit', [random_layers_circuit(16, depth=4), random_layers_circuit(36, depth=3, seed=1),
+                                     qaoa_circuit(12), ghz_ladder_circuit(9)])
+def test_scheduled_streams_do_the_same(circuit):
+    device, instructions = compile_overlapping_traps(circuit)
+    scheduled_device, scheduled = compile_overlapping_traps(circuit, parallel=True)
+    sites, nof_pulses, aod_qubit_ids, slm_qubit_ids = pulse_sites_and_final_state(device, instructions)
+    scheduled_sites, nof_scheduled_pulses, scheduled_aod_qubit_ids, scheduled_slm_qubit_ids = (
+        pulse_sites_and_final_state(scheduled_device, scheduled))
+    # the gates of a moment may be pulsed in another order, each site still
+    # reaches exactly the qubits of its gate
+    assert all(len(site) == 2 for site in scheduled_sites)
+    assert sorted(scheduled_sites) == sorted(sites)
+    assert (scheduled_aod_qubit_ids, scheduled_slm_qubit_ids) == (aod_qubit_ids, slm_qubit_ids)
+    assert nof_scheduled_pulses <= nof_pulses
+
+
+def test_moments_share_pulses():
+    circuit = random_layers_circuit(36, depth=3, seed=1)
+    device, instructions = compile_overlapping_traps(circuit, parallel=True)
+    nof_gates = sum(len(oper.qubits) == 2 for oper in circuit.all_operations())
+    pulses = [inst for inst in instructions if isinstance(inst, RydbergPulse)]
+    assert pulses and max(len(pulse.target_positions) for pulse in pulses) > 1
+    assert len(pulses) + sum(isinstance(inst, RydbergLaser) for inst in instructions) < nof_gates
+
+
+def test_blocks_that_use_a_line_differently_do_not_share_a_stage():
+    class Block:
+        def __init__(self, target_pos, line_actions):
+            self.laser = RydbergLaser(target_pos, 'CZ')
+            self.line_actions = line_actions
+
+    moved = Block((1, 1), {('row', 0): (True, (0.5,)), ('col', 1): (False, (0.2,))})
+    assert shares_lines_consistently(moved, Block((2, 2), {('row', 0): (True, (0.5,)), ('col', 2): (True, ())}))
+    assert not shares_lines_consistently(moved, Block((2, 2), {('row', 0): (True, (0.3,))}))
+    assert not shares_lines_consistently(moved, Block((2, 2), {('col', 1): (True, (0.2,))}))
+    assert not shares_lines_consistently(moved, Block((1, 1), {}))
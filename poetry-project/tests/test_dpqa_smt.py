@@ -0,0 +1,118 @@
+import pytest
+
+from dpqa_src import dpqa_smt
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_compiler import compile_overlapping_traps
+from dpqa_src.dpqa_instructions import RydbergLaser, RydbergPulse
+from dpqa_src.dpqa_smt import SMTScheduler
+
+pytest.importorskip('z3')
+
+
+def pulse_sites_and_final_state(device, instructions):
+    # the qubits at every pulse site, the number of pulses and where every
+    # qubit ends
+    device = device.copy()
+    sites = []
+    nof_pulses = 0
+    for inst in instructions:
+        if isinstance(inst, RydbergLaser):
+            sites.append(device.qubit_ids_in_rydberg_range(inst.target_pos))
+            nof_pulses += 1
+        elif isinstance(inst, RydbergPulse):
+            sites += [device.qubit_ids_in_rydberg_range(pos) for pos in inst.target_positions]
+            nof_pulses += 1
+        device.execute_instructions_headless([inst])
+    state = device.state
+    return (sites, nof_pulses, state.aod_qubit_ids.tolist(), state.slm_qubit_ids.tolist())
+
+
+@pytest.fixture
+def schedulers(monkeypatch):
+    # the SMTSchedulers made by the compiles of a test
+    made = []
+    init = SMTScheduler.__init__
+
+    def recorded(scheduler, *args, **kwargs):
+        init(scheduler, *args, **kwargs)
+        made.append(scheduler)
+
+    monkeypatch.setattr(SMTScheduler, '__init__', recorded)
+    return made
+
+
+def compile_and_compare(circuit, **smt_kwargs):
+    # the smt stream against the unscheduled and the greedy scheduled ones
+    sites, nof_pulses, *final_state = pulse_sites_and_final_state(*compile_overlapping_traps(circuit))
+    _, nof_greedy_pulses, *_ = pulse_sites_and_final_state(*compile_overlapping_traps(circuit, parallel=True))
+    smt_sites, nof_smt_pulses, *smt_final_state = pulse_sites_and_final_state(
+        *compile_overlapping_traps(circuit, **smt_kwargs))
+    assert all(len(site) == 2 for site in smt_sites)
+    assert sorted(smt_sites) == sorted(sites)
+    assert smt_final_state == final_state
+    return (nof_pulses, nof_greedy_pulses, nof_smt_pulses)
+
+
+@pytest.mark.parametrize('circuit', [random_layers_circuit(16, depth=4), qaoa_circuit(12)])
+def test_smt_streams_do_the_same(schedulers, circuit):
+    nof_pulses, nof_greedy_pulses, nof_smt_pulses = compile_and_compare(circuit, smt_window=2, smt_time_budget=5)
+    assert nof_smt_pulses <= nof_greedy_pulses <= nof_pulses
+    scheduler, = schedulers
+    assert sum(scheduler.window_counts.values()) == -(-len(circuit) // 2)
+    assert scheduler.window_counts['greedy'] == 0
+
+
+def test_windows_fall_back_to_the_greedy_schedule(schedulers, monkeypatch):
+    circuit = random_layers_circuit(16, depth=4)
+    _, nof_greedy_pulses, nof_smt_pulses = compile_and_compare(circuit, smt_window=2, smt_time_budget=0)
+    assert nof_smt_pulses == nof_greedy_pulses
+    nof_windows = -(-len(circuit) // 2)
+    assert schedulers[-1].window_counts == {'optimal': 0, 'unproven': 0, 'greedy': nof_windows}
+
+    # without z3 every window is scheduled greedily
+    monkeypatch.setattr(dpqa_smt, 'load_z3', lambda: None)
+    _, nof_greedy_pulses, nof_smt_pulses = compile_and_compare(circuit, smt_window=2)
+    assert nof_smt_pulses == nof_greedy_pulses
+    assert schedulers[-1].window_counts == {'optimal': 0, 'unproven': 0, 'greedy': nof_windows}
+
+
+def test_learned_stages_make_windows_unproven(schedulers, monkeypatch):
+    # the first stage of two or more gates the solver proposes fails on the
+    # device, the window is solved around it and counts as unproven
+    run_stages = SMTScheduler._run_stages
+    solve_window = SMTScheduler._solve_window
+    accept = SMTScheduler._accept
+    solving = []
+    accepting = []
+    rejected = []
+
+    def failing_once(scheduler, stages):
+        if solving and not accepting and not rejected:
+            shared = [stage for stage in stages if len(stage) >= 2]
+            if shared:
+                rejected.append([block.qubits for block in shared[0]])
+                return shared[0]
+        return run_stages(scheduler, stages)
+
+    def solved(scheduler, *args):
+        solving.append(True)
+        try:
+            return solve_window(scheduler, *args)
+        finally:
+            solving.pop()
+
+    def accepted(scheduler, *args):
+        accepting.append(True)
+        try:
+            return accept(scheduler, *args)
+        finally:
+            accepting.pop()
+
+    monkeypatch.setattr(SMTScheduler, '_run_stages', failing_once)
+    monkeypatch.setattr(SMTScheduler, '_solve_window', solved)
+    monkeypatch.setattr(SMTScheduler, '_accept', accepted)
+    circuit = qaoa_circuit(16)
+    compile_and_compare(circuit, smt_window=2, smt_time_budget=5)
+    scheduler, = schedulers
+    assert len(rejected) == 1 and scheduler.learned == rejected
+    assert scheduler.window_counts == {'optimal': -(-len(circuit) // 2) - 1, 'unproven': 1, 'greedy': 0}
@@ -0,0 +1,278 @@
+import itertools
+import math
+import random
+
+import cirq
+import numpy as np
+import pytest
+
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_instructions import (ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, Initialize,
+                                        MoveAODCol, MoveAODRow, RydbergLaser)
+from dpqa_src.dpqa_state import EMPTY
+from dpqa_src.dpqa_traps import AODTrap, AODTrapView, SLMTrap
+
+
+class ObjectDPQA:
+    # the device as it was before the array state: one object per trap and a
+    # scan over every slm trap for transfers and pulses
+    def __init__(self, device):
+        self.max_dim_x = device.max_dim_x
+        self.max_dim_y = device.max_dim_y
+        self.rydberg_radius = device.rydberg_radius
+        self.trap_transfer_radius = device.trap_transfer_radius
+        self.aod_traps = [[AODTrap(i, j) for j in range(device.aod_cols)] for i in range(device.aod_rows)]
+        self.slm_traps = [SLMTrap(x, y) for x, y in device.slm_positions_xy]
+
+    def column(self, col):
+        return [aod_row[col] for aod_row in self.aod_traps]
+
+    def move_row(self, row, offset):
+        new_y = self.aod_traps[row][0].y_pos + offset
+        assert new_y <= self.max_dim_y and new_y >= -self.max_dim_y
+        if offset < 0 and row != 0:
+            assert new_y > self.aod_traps[row - 1][0].y_pos
+        if offset > 0 and row != len(self.aod_traps) - 1:
+            assert new_y < self.aod_traps[row + 1][0].y_pos
+        for trap in self.aod_traps[row]:
+            trap.move_trap_by(0, offset)
+
+    def move_col(self, col, offset):
+        new_x = self.aod_traps[0][col].x_pos + offset
+        assert new_x <= self.max_dim_x and new_x >= -self.max_dim_x
+        if offset < 0 and col != 0:
+            assert new_x > self.aod_traps[0][col - 1].x_pos
+        if offset > 0 and col != len(self.aod_traps[0]) - 1:
+            assert new_x < self.aod_traps[0][col + 1].x_pos
+        for trap in self.column(col):
+            trap.move_trap_by(offset, 0)
+
+    def activate(self, traps):
+        for aod_trap in traps:
+            if len(aod_trap.qubits) == 0:
+                for slm_trap in self.slm_traps:
+                    if (math.dist(aod_trap.get_position_xy(), slm_trap.get_position_xy()) <= self.trap_transfer_radius
+                            and len(slm_trap.qubits) > 0):
+                        aod_trap.add_qubits(slm_trap.remove_qubits())
+                        break
+
+    def deactivate(self, traps):
+        for aod_trap in traps:
+            if len(aod_trap.qubits) > 0:
+                q = aod_trap.remove_qubits()
+                for slm_trap in self.slm_traps:
+                    if (math.dist(aod_trap.get_position_xy(), slm_trap.get_position_xy()) < self.trap_transfer_radius
+                            and len(slm_trap.qubits) == 0):
+                        slm_trap.add_qubits(q)
+                        break
+
+    def pulse(self, pos, operation):
+        affected_traps = [trap for trap in [t for row in self.aod_traps for t in row] + self.slm_traps
+                          if math.dist(trap.get_position_xy(), pos) < self.rydberg_radius]
+        affected_qubits = [q for trap in affected_traps for q in trap.qubits]
+        if operation == 'SWAP':
+            assert(len(affected_qubits) <= 2)
+            if len(affected_qubits) == 2:
+                q1 = affected_traps[0].remove_qubits()
+                q2 = affected_traps[1].remove_qubits()
+                affected_traps[0].add_qubits(q2)
+                affected_traps[1].add_qubits(q1)
+
+    def execute(self, inst):
+        if isinstance(inst, Initialize):
+            for q, (row, col) in zip(inst.aod_qubits, inst.aod_qubit_positions_rowcol):
+                self.aod_traps[row][col].add_qubits(q)
+            for q, index in zip(inst.slm_qubits, inst.slm_trap_indices):
+                self.slm_traps[index].add_qubits(q)
+        elif isinstance(inst, MoveAODRow):
+            self.move_row(inst.row_index, inst.offset)
+        elif isinstance(inst, MoveAODCol):
+            self.move_col(inst.col_index, inst.offset)
+        elif isinstance(inst, ActivateAODRow):
+            self.activate(self.aod_traps[inst.row_index])
+        elif isinstance(inst, ActivateAODCol):
+            self.activate(self.column(inst.col_index))
+        elif isinstance(inst, DeactivateAODRow):
+            self.deactivate(self.aod_traps[inst.row_index])
+        elif isinstance(inst, DeactivateAODCol):
+            self.deactivate(self.column(inst.col_index))
+        elif isinstance(inst, RydbergLaser):
+            self.pulse(inst.target_pos, inst.operation)
+
+
+def snapshot(aod_traps, slm_traps):
+    return ([(trap.get_position_xy(), list(trap.qubits)) for row in aod_traps for trap in row],
+            [list(trap.qubits) for trap in slm_traps])
+
+
+def assert_same_runs(device, instructions):
+    # every instruction on both engines: both refuse it (assert, leaving the
+    # state as it was) or both run it, and the states match after each
+    reference = ObjectDPQA(device)
+    for inst in instructions:
+        outcomes = []
+        for engine in (reference.execute, lambda inst: device.execute_instructions_headless([inst])):
+            try:
+                engine(inst)
+                outcomes.append(None)
+            except AssertionError:
+                outcomes.append('assert')
+        assert outcomes[0] == outcomes[1], inst
+        assert snapshot(reference.aod_traps, reference.slm_traps) == snapshot(device.aod_traps, device.slm_traps), inst
+
+
+def random_circuit(nof_qubits, nof_gates, seed, swaps=False):
+    rng = random.Random(seed)
+    qubits = cirq.LineQubit.range(nof_qubits)
+    circuit = cirq.Circuit(cirq.H.on_each(*qubits))
+    for _ in range(nof_gates):
+        a, b = rng.sample(qubits, 2)
+        circuit.append(cirq.SWAP(a, b) if swaps and rng.random() < 0.3 else cirq.CZ(a, b))
+    return circuit
+
+
+@pytest.mark.parametrize('compile_function', [compile, compile_overlapping_traps])
+@pytest.mark.parametrize('seed', range(3))
+def test_compiled_programs_run_the_same(compile_function, seed):
+    device, instructions = compile_function(random_circuit(9, 25, seed, swaps=compile_function is compile))
+    assert_same_runs(device, instructions)
+
+
+def drops_everything(device, rows, cols):
+    # every loaded aod trap of the lines lands in a free slm trap
+    state = device.state
+    free = state.slm_qubit_ids == EMPTY
+    for row, col in zip(*np.nonzero(state.aod_qubit_ids[np.ix_(rows, cols)] != EMPTY)):
+        distances = np.hypot(state.slm_x - state.aod_col_x[cols[col]], state.slm_y - state.aod_row_y[rows[row]])
+        if not np.any(free & (distances < device.trap_transfer_radius)):
+            return False
+    return True
+
+
+def random_instructions(device, rng, length):
+    # random moves, transfers and pulses, including ones the device refuses.
+    # deactivations that would lose qubits are rare, and pulses go halfway
+    # between a loaded aod trap and the closest loaded slm trap, so that they
+    # often meet two qubits.
+    offsets = [-1, -0.7, -0.5, -0.3, 0.3, 0.5, 0.7, 1]
+    all_rows, all_cols = list(range(device.aod_rows)), list(range(device.aod_cols))
+    state = device.state
+    while length > 0:
+        kind = rng.randrange(7)
+        row, col = rng.randrange(device.aod_rows), rng.randrange(device.aod_cols)
+        if kind == 0:
+            yield MoveAODRow(row, rng.choice(offsets))
+        elif kind == 1:
+            yield MoveAODCol(col, rng.choice(offsets))
+        elif kind == 2:
+            yield ActivateAODRow(row)
+        elif kind == 3:
+            yield ActivateAODCol(col)
+        elif kind == 4:
+            if not drops_everything(device, [row], all_cols) and rng.random() > 0.1:
+                continue
+            yield DeactivateAODRow(row)
+        elif kind == 5:
+            if not drops_everything(device, all_rows, [col]) and rng.random() > 0.1:
+                continue
+            yield DeactivateAODCol(col)
+        else:
+            rows, cols = np.nonzero(state.aod_qubit_ids != EMPTY)
+            occupied = np.flatnonzero(state.slm_qubit_ids != EMPTY)
+            if len(rows) == 0 or len(occupied) == 0:
+                continue
+            k = rng.randrange(len(rows))
+            x, y = state.aod_col_x[cols[k]].item(), state.aod_row_y[rows[k]].item()
+            near = occupied[np.argmin(np.hypot(state.slm_x[occupied] - x, state.slm_y[occupied] - y))]
+            target = ((x + state.slm_x[near].item()) / 2, (y + state.slm_y[near].item()) / 2)
+            yield RydbergLaser(target, operation=rng.choice(['CZ', 'SWAP']))
+        length -= 1
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_random_instructions_run_the_same(seed):
+    device, instructions = compile_overlapping_traps(random_circuit(9, 1, seed))
+    assert_same_runs(device, itertools.chain(instructions[:1], random_instructions(device, random.Random(seed), 300)))
+
+
+def test_trap_views_read_the_state():
+    device, instructions = compile_overlapping_traps(random_circuit(4, 3, 0))
+    device.execute_instructions_headless(instructions[:1])
+    trap = device.slm_traps[0]
+    assert trap.qubits == (device.state.qubits[device.state.slm_qubit_ids[0]],)
+    with pytest.raises(AttributeError):
+        trap.qubits.append(cirq.LineQubit(99))
+
+    aod_trap = device.aod_traps[0][0]
+    assert not isinstance(aod_trap, AODTrap) and isinstance(aod_trap, AODTrapView)
+    assert not hasattr(aod_trap, 'move_trap_by')
+    device.move_aod_row_by(0, 0.5)
+    assert aod_trap.get_position_xy() == (0.0, 0.5)
+    assert device.aod_traps[0][1].movement_vector == (0, 0.5)
+
+    q = trap.remove_qubits()
+    assert trap.qubits == ()
+    aod_trap.add_qubits(q)
+    assert aod_trap.qubits == (q,)
+
+
+def full_state(device):
+    # every array of the state and what the device keeps next to it
+    state = device.state
+    arrays = {name: value.copy() for name, value in vars(state).items() if isinstance(value, np.ndarray)}
+    return (arrays, list(state.qubits), dict(state.qubit_ids), state.move_counter, device.nof_qubits,
+            device.previous_rydberg_laser_pos, device.previous_rydberg_laser_op,
+            list(device.previous_rydberg_pulse_positions))
+
+
+def assert_same_full_state(a, b):
+    assert a[0].keys() == b[0].keys()
+    for name in a[0]:
+        assert np.array_equal(a[0][name], b[0][name]), name
+    assert a[1:] == b[1:]
+
+
+def run_refusing(device, instructions):
+    for inst in instructions:
+        try:
+            device.execute_instructions_headless([inst])
+        except AssertionError:
+            pass
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_nested_checkpoints_roll_back_exactly(seed):
+    rng = random.Random(seed)
+    device, instructions = compile_overlapping_traps(random_circuit(8, 1, seed))
+    device.execute_instructions_headless(instructions[:1])
+    outer_state = full_state(device)
+    outer = device.checkpoint()
+    run_refusing(device, random_instructions(device, rng, 100))
+    inner_state = full_state(device)
+    inner = device.checkpoint()
+    # a new qubit is registered inside the inner checkpoint
+    free = int(np.flatnonzero(device.state.slm_qubit_ids == EMPTY)[0])
+    run_refusing(device, [Initialize([], [], [cirq.LineQubit(99)], [free])])
+    run_refusing(device, random_instructions(device, rng, 100))
+    innermost = device.checkpoint()
+    run_refusing(device, random_instructions(device, rng, 50))
+
+    device.rollback(inner)
+    assert_same_full_state(full_state(device), inner_state)
+    assert len(device.state.open_checkpoints) == 2
+    with pytest.raises(AssertionError):
+        device.rollback(innermost)
+    # the inner checkpoint stays open and can be rolled back to again
+    run_refusing(device, random_instructions(device, rng, 100))
+    device.rollback(inner)
+    assert_same_full_state(full_state(device), inner_state)
+
+    run_refusing(device, random_instructions(device, rng, 100))
+    committed_state = full_state(device)
+    device.commit(inner)
+    assert_same_full_state(full_state(device), committed_state)
+    assert device.state.undo_log is not None
+    device.rollback(outer)
+    assert_same_full_state(full_state(device), outer_state)
+    device.commit(outer)
+    assert device.state.undo_log is None and device.state.open_checkpoints == []
@@ -0,0 +1,133 @@
+import random
+
+import cirq
+import numpy as np
+import pytest
+
+from dpqa_src.dpqa import DPQA
+from dpqa_src.dpqa_benchmark import random_layers_circuit
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_instructions import (ActivateAODCol, ActivateAODRow, DeactivateAODCol, DeactivateAODRow, DrawState,
+                                        Initialize, MoveAODCol, MoveAODCols, MoveAODRow, MoveAODRows, RydbergLaser,
+                                        RydbergPulse)
+from dpqa_src.dpqa_state import EMPTY
+from dpqa_src.dpqa_sweep import execute_sweep, initial_traps
+
+
+def with_placement(device, instructions, placement):
+    # the stream with its first Initialize moved to the traps of placement
+    output = []
+    for inst in instructions:
+        if isinstance(inst, Initialize) and placement is not None:
+            nof_aod = len(inst.aod_qubits)
+            inst = Initialize(inst.aod_qubits, [divmod(int(trap), device.aod_cols) for trap in placement[:nof_aod]],
+                              inst.slm_qubits, [int(trap) for trap in placement[nof_aod:]])
+            placement = None
+        output.append(inst)
+    return output
+
+
+def run_on_dpqa(device, instructions, trap_transfer_radius, rydberg_radius):
+    # (device after the run, index of the instruction that asserted or -1,
+    # (count, two lowest ids) of every pulse site) on a fresh DPQA
+    device = DPQA(device.aod_rows, device.aod_cols, device.slm_positions_xy, device.max_dim_x, device.max_dim_y,
+                  rydberg_radius, trap_transfer_radius)
+    pulses = []
+    interaction = device.rydberg_interaction_on_position
+
+    def recorded(pos, operation):
+        ids = device.qubit_ids_in_rydberg_range(pos)
+        pulses.append((len(ids), tuple((ids + [EMPTY, EMPTY])[:2])))
+        return interaction(pos, operation)
+
+    device.rydberg_interaction_on_position = recorded
+    for index, inst in enumerate(instructions):
+        try:
+            device.execute_instructions_headless([inst])
+        except AssertionError:
+            return (device, index, pulses)
+    return (device, -1, pulses)
+
+
+def assert_matches_dpqa(device, instructions, placements, trap_transfer_radii, rydberg_radii):
+    result = execute_sweep(device, instructions, placements, trap_transfer_radii, rydberg_radii)
+    for v in range(len(result)):
+        placed = with_placement(device, instructions, placements[v])
+        reference, failed_at, pulses = run_on_dpqa(device, placed, trap_transfer_radii[v], rydberg_radii[v])
+        assert bool(result.valid[v]) == (failed_at == -1)
+        assert result.failed_at[v] == failed_at
+        assert [(int(result.pulse_counts[v, k]), tuple(result.pulse_qubits[v, k].tolist()))
+                for k in range(len(pulses))] == pulses
+        if failed_at != -1:
+            if result.failures[v] == 'double_occupancy':
+                continue
+            # an invalid variant holds the state before the failing instruction
+            reference, _, _ = run_on_dpqa(device, placed[:failed_at], trap_transfer_radii[v], rydberg_radii[v])
+        assert np.array_equal(reference.state.aod_qubit_ids, result.aod_qubit_ids[v])
+        assert np.array_equal(reference.state.slm_qubit_ids, result.slm_qubit_ids[v])
+        assert np.allclose(reference.state.aod_row_y, result.aod_row_y[v])
+        assert np.allclose(reference.state.aod_col_x, result.aod_col_x[v])
+
+
+@pytest.mark.parametrize('compile_function', [compile, compile_overlapping_traps])
+@pytest.mark.parametrize('seed', range(3))
+def test_compiled_programs_sweep_like_dpqa(compile_function, seed):
+    device, instructions = compile_function(random_layers_circuit(9, depth=3, seed=seed))
+    rng = np.random.default_rng(seed)
+    base = initial_traps(device, instructions)
+    nof_variants = 12
+    placements = []
+    for v in range(nof_variants):
+        if v % 3 == 0:
+            placements.append(base)
+        elif v % 3 == 1:
+            placements.append(rng.permutation(base))
+        else:
+            placements.append(rng.choice(device.aod_rows * device.aod_cols, len(base), replace=v % 6 == 5))
+    trap_transfer_radii = rng.choice([0.01, 0.3, 0.6, 1.0, 1.5], nof_variants)
+    rydberg_radii = rng.choice([0.3, 0.5, 1.0, 1.6, 2.5], nof_variants)
+    assert_matches_dpqa(device, instructions, placements, trap_transfer_radii, rydberg_radii)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_streams_sweep_like_dpqa(seed):
+    # random moves (some out of bounds or out of order), transfers and
+    # pulses on an slm grid offset from the aod lines
+    rng = random.Random(seed)
+    slm_positions = [(x * 0.7 + 2, y * 0.7 + 3) for x in range(5) for y in range(4)]
+    device = DPQA(3, 3, slm_positions, 8, 8, 0.8, 0.5)
+    qubits = cirq.LineQubit.range(6)
+    instructions = [Initialize(qubits[:3], [(0, 0), (1, 1), (2, 2)], qubits[3:], [0, 5, 9])]
+    steps = [0.2, 0.3] * 20 + [9]
+    for _ in range(40):
+        kind = rng.randrange(9)
+        if kind == 0:
+            instructions.append(MoveAODRow(rng.randrange(3), rng.choice([-1, 1]) * rng.choice(steps)))
+        elif kind == 1:
+            instructions.append(MoveAODCol(rng.randrange(3), rng.choice([-1, 1]) * rng.choice(steps)))
+        elif kind == 2:
+            rows = rng.sample(range(3), rng.randint(1, 3))
+            instructions.append(MoveAODRows(rows, [rng.choice([0.1, 0.2] * 20 + [-9]) for _ in rows]))
+        elif kind == 3:
+            instructions.append(MoveAODCols([0, 1, 2], [0.25, 0.2, 0.15]))
+        elif kind == 4:
+            instructions.append(rng.choice([ActivateAODRow, DeactivateAODRow])(rng.randrange(3)))
+        elif kind == 5:
+            instructions.append(rng.choice([ActivateAODCol, DeactivateAODCol])(rng.randrange(3)))
+        elif kind == 6:
+            instructions.append(RydbergLaser((rng.uniform(0, 6), rng.uniform(0, 6)), rng.choice(['CZ', 'SWAP'])))
+        elif kind == 7:
+            instructions.append(RydbergPulse([(rng.uniform(0, 6), rng.uniform(0, 6)) for _ in range(2)],
+                                             ['CZ', 'SWAP']))
+        else:
+            instructions.append(DrawState())
+
+    nof_variants = 16
+    placements = []
+    for v in range(nof_variants):
+        placement_rng = np.random.default_rng(seed * 100 + v)
+        placements.append(placement_rng.choice(9, 3, replace=False).tolist()
+                          + placement_rng.choice(20, 3, replace=v % 5 == 4).tolist())
+    trap_transfer_radii = [rng.choice([0.3, 0.5, 0.7, 1.0, 1.4]) for _ in range(nof_variants)]
+    rydberg_radii = [rng.choice([0.5, 0.8, 1.2, 2.0]) for _ in range(nof_variants)]
+    assert_matches_dpqa(device, instructions, placements, trap_transfer_radii, rydberg_radii)
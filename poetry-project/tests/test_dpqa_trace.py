@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_instructions import RydbergLaser
+from dpqa_src.dpqa_program import Program
+from dpqa_src.dpqa_routing import qubit_positions
+from dpqa_src.dpqa_trace import TraceRecorder, load_trace
+
+
+def snapshotted(device, instructions, snapshots):
+    # the instructions, with the state after each appended to snapshots
+    for inst in instructions:
+        yield inst
+        state = device.state
+        snapshots.append((state.aod_row_y.copy(), state.aod_col_x.copy(), state.aod_qubit_ids.copy(),
+                          state.slm_qubit_ids.copy()))
+
+
+def assert_rebuilds(trace, snapshots):
+    assert trace.nof_steps == len(snapshots)
+    for step, (row_y, col_x, aod, slm) in enumerate(snapshots):
+        rebuilt_row_y, rebuilt_col_x = trace.line_positions(step)
+        rebuilt_aod, rebuilt_slm = trace.occupancy(step)
+        assert np.array_equal(rebuilt_row_y, row_y) and np.array_equal(rebuilt_col_x, col_x)
+        assert np.array_equal(rebuilt_aod, aod) and np.array_equal(rebuilt_slm, slm)
+
+
+@pytest.mark.parametrize('compile_function, circuit', [(compile_overlapping_traps, random_layers_circuit(9, depth=3)),
+                                                       (compile, qaoa_circuit(8))])
+def test_trace_rebuilds_every_step(compile_function, circuit, tmp_path):
+    device, instructions = compile_function(circuit)
+    snapshots = []
+    recorder = TraceRecorder()
+    run = device.copy()
+    run.execute_instructions_headless(snapshotted(run, instructions, snapshots), trace=recorder)
+    trace = recorder.trace()
+    assert_rebuilds(trace, snapshots)
+
+    # every pulse is recorded with the qubits it reached
+    pulses = [step for step, inst in enumerate(instructions) if isinstance(inst, RydbergLaser)]
+    assert trace.pulses['step'].tolist() == pulses
+    assert set(trace.pulses['nof_qubits'].tolist()) <= {1, 2}
+
+    recorder.save(tmp_path / 'trace.npz')
+    assert_rebuilds(load_trace(tmp_path / 'trace.npz'), snapshots)
+
+
+def test_trace_written_to_a_directory(tmp_path):
+    device, instructions = compile_overlapping_traps(random_layers_circuit(9, depth=3), collective_moves=True)
+    program = Program.from_instructions(instructions)
+    snapshots = []
+    run = device.copy()
+    run.execute_instructions_headless(snapshotted(run, instructions, snapshots))
+    recorder = TraceRecorder(tmp_path / 'trace')
+    device.execute_instructions_headless(program, trace=recorder)
+    recorder.close()
+    trace = load_trace(tmp_path / 'trace')
+    assert_rebuilds(trace, snapshots)
+    assert np.array_equal(trace.qubit_positions(trace.nof_steps - 1), qubit_positions(device))
@@ -0,0 +1,77 @@
+import cirq
+import numpy as np
+import pytest
+
+from dpqa_src.dpqa_benchmark import qaoa_circuit, random_layers_circuit
+from dpqa_src.dpqa_compiler import compile, compile_overlapping_traps
+from dpqa_src.dpqa_instructions import (ActivateAODRow, DeactivateAODCol, DeactivateAODRow, Initialize, MoveAODCol,
+                                        MoveAODRow, MoveAODRows, RydbergLaser)
+from dpqa_src.dpqa_state import EMPTY
+from dpqa_src.dpqa_sweep import execute_sweep, initial_traps
+from dpqa_src.dpqa_validator import StreamValidator, validate_instructions
+
+
+@pytest.mark.parametrize('compile_function', [compile, compile_overlapping_traps])
+@pytest.mark.parametrize('circuit', [random_layers_circuit(9, depth=4), qaoa_circuit(8)])
+def test_compiled_streams_are_valid(compile_function, circuit):
+    device, instructions = compile_function(circuit, collective_moves=True)
+    state = device.state.copy()
+    assert validate_instructions(device, instructions) == []
+    # the device is not touched
+    assert np.array_equal(device.state.slm_qubit_ids, state.slm_qubit_ids)
+    device.execute_instructions_headless(instructions)
+
+
+def broken_stream():
+    # every qubit of a 3x3 grid starts in its slm trap under the aod traps
+    device, instructions = compile_overlapping_traps(random_layers_circuit(9, depth=1))
+    return (device, instructions[:1] + [
+        MoveAODRow(0, 1.5),                # 1: past row 1
+        MoveAODRow(0, -1.5),
+        MoveAODCol(2, 100),                # 3: out of bounds
+        MoveAODCol(2, -100),
+        ActivateAODRow(0),
+        MoveAODRows([0], [0.5]),
+        DeactivateAODRow(0),               # 7: no slm trap under row 0
+        RydbergLaser((1, 1.5), 'CZ'),
+        ActivateAODRow(1),
+        MoveAODRow(1, 0.5),
+        MoveAODCol(0, 0.85),
+        RydbergLaser((0.95, 1.75), 'CZ'),  # 12: two row 1 qubits and one of row 2
+    ])
+
+
+def test_violations_are_reported_in_order():
+    device, instructions = broken_stream()
+    violations = validate_instructions(device, instructions)
+    assert [(violation.index, violation.kind) for violation in violations] == [
+        (1, 'ordering'), (3, 'bounds'), (7, 'lost_qubit'), (7, 'lost_qubit'), (7, 'lost_qubit'),
+        (12, 'rydberg_crowding')]
+    assert [(violation.index, violation.kind) for violation in validate_instructions(device, instructions, 2)] == [
+        (1, 'ordering'), (3, 'bounds')]
+
+
+def test_dpqa_asserts_at_the_first_violation():
+    device, instructions = broken_stream()
+    device.execute_instructions_headless(instructions[:1])
+    with pytest.raises(AssertionError):
+        device.execute_instructions_headless(instructions[1:2])
+
+
+def test_loaded_aod_traps_are_skipped_on_activation():
+    # the aod trap (0, 0) holds a qubit over the occupied slm trap 0. DPQA and
+    # the sweep executor leave it loaded and activate the rest of the row.
+    device, _ = compile_overlapping_traps(random_layers_circuit(9, depth=1))
+    qubits = cirq.LineQubit.range(3)
+    instructions = [Initialize([qubits[0]], [(0, 0)], qubits[1:], [0, 1]), ActivateAODRow(0), MoveAODRow(0, 0.5),
+                    ActivateAODRow(0), MoveAODRow(0, -0.5), DeactivateAODCol(1)]
+    validator = StreamValidator(device)
+    assert validator.validate(instructions) == []
+    result = execute_sweep(device, instructions, [initial_traps(device, instructions)],
+                           [device.trap_transfer_radius], [device.rydberg_radius])
+    assert result.valid[0]
+    device.execute_instructions_headless(instructions)
+    for state in (validator.state, device.state):
+        assert state.aod_qubit_ids.tolist() == [[0, EMPTY, EMPTY], [EMPTY] * 3, [EMPTY] * 3]
+        assert state.slm_qubit_ids[:2].tolist() == [1, 2]
+    assert np.array_equal(result.aod_qubit_ids[0], device.state.aod_qubit_ids)